@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import logs
+
+from engine import Engine
+from pacing import Pacer
+from presence import Presence
+from routes import RouteTable
+from sessions import SessionStore
+from utils import MsgType
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server._handle_datagram(data, addr)
+
+    def error_received(self, exc):
+        logging.debug('Socket error: %s', exc)
+
+class AsyncServer(Engine):
+    """
+    An alternative to server.Server that runs the UDP socket on an asyncio
+    event loop in a single thread. Relay handlers are cheap and run inline on
+    the loop, while every other handler may block on the database, password
+    hashing or haproxy, so it is run on a thread pool executor instead. The
+    rest of the server is the engine.Engine it shares with server.Server.
+    """
+
+    INLINE_TYPES = frozenset((MsgType.ACK, MsgType.MOVE, MsgType.SET_LED))
+
+    MAX_DATAGRAM = 1024
+
+    def __init__(self, host, port, db_name, workers=4, route_sync=None,
+            max_datagram=MAX_DATAGRAM, hasher=None,
+            session_ttl=SessionStore.TTL, video=None,
+            route_ttl=RouteTable.TTL, route_capacity=RouteTable.CAPACITY,
+            command_rate=Pacer.RATE, presence_ttl=Presence.TTL):
+        """
+        Create a new UDP server that will listen forever on an event loop
+        bound to the given host and port. Blocking handlers will be run on the
+        given number of executor threads. If a cluster.RouteSync is given, the
+        socket is bound with SO_REUSEPORT and routes and car changes are shared
+        with the other processes bound to the same port. Datagrams larger than
+        max_datagram bytes are rejected. Passwords are hashed by the given
+        hashing.PasswordHasher, or a default one, and session tokens expire
+        after session_ttl seconds. Registered cars' video streams are routed
+        by the given video.VideoRouter or mjpeg.MJPEGRelay or, without one,
+        passed on to the process that has one. Routes expire after route_ttl
+        seconds idle, and at most route_capacity are kept. MOVE and SET_LED
+        messages are sent to each car at most command_rate times per second,
+        or as they come if command_rate is 0. Cars are reported off once they
+        have sent no heartbeat for presence_ttl seconds.
+        """
+
+        self.executor = ThreadPoolExecutor(workers)
+        self.loop = asyncio.new_event_loop()
+        self.transport = None
+        self.address = None
+        self.max_datagram = max_datagram
+        super().__init__(db_name, route_sync, hasher, session_ttl, video,
+                         route_ttl, route_capacity, command_rate, presence_ttl)
+
+        self._bind_error = None
+
+        ready = threading.Event()
+        self.loop_thread = threading.Thread(
+            target=self._run_forever,
+            args=(host, port, ready),
+            daemon=True
+        )
+        self.loop_thread.start()
+        ready.wait()
+        if self._bind_error is not None:
+            raise self._bind_error
+        self._start()
+
+    def _run_forever(self, host, port, ready):
+        """
+        Bind the datagram endpoint and run the event loop until close() is
+        called.
+        """
+
+        asyncio.set_event_loop(self.loop)
+        try:
+            # An empty host means every interface, as with socket.bind
+            self.transport, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(
+                    lambda: _DatagramProtocol(self),
+                    local_addr=(host or '0.0.0.0', port),
+                    reuse_port=self.route_sync is not None
+                )
+            )
+        except OSError as e:
+            self._bind_error = e
+            ready.set()
+            self.loop.close()
+            return
+        self.address = self.transport.get_extra_info('sockname')
+        ready.set()
+
+        self.loop.run_forever()
+        self.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def _handle_datagram(self, data, addr):
+        """
+        Process a datagram received on the loop. Relay handlers are run
+        inline on the loop and everything else on the executor.
+        """
+
+        received = time.monotonic()
+        if len(data) > self.max_datagram:
+            self._reject_oversized(addr, self.max_datagram)
+            return
+        self._receive(data, addr, received)
+
+    def _dispatch(self, handler, body, addr, received):
+        if body['type'] in self.INLINE_TYPES:
+            self._run_handler(handler, body, addr, received)
+        else:
+            self.executor.submit(self._run_handler, handler, body, addr,
+                                 received)
+
+    def _run_handler(self, handler, body, addr, received):
+        msg_type = body['type']
+        try:
+            handler(self, body, addr)
+        except Exception:
+            logging.exception('Handler raised an exception',
+                              extra=logs.fields(msg_type, addr))
+        latency = time.monotonic() - received
+        self.metrics.observe('handler_seconds', msg_type, latency)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('Handled message',
+                          extra=logs.fields(msg_type, addr, latency))
+
+    def send(self, data, address):
+        """
+        Send a message containing the given data from the server's UDP socket
+        to the given address. Sends from executor threads are handed to the
+        event loop, since the transport is not thread-safe, and dropped once
+        the server is closed.
+        """
+
+        self.metrics.sent(data)
+        if threading.current_thread() is self.loop_thread:
+            self.transport.sendto(data, address)
+            return
+
+        try:
+            self.loop.call_soon_threadsafe(self.transport.sendto, data, address)
+        except RuntimeError:
+            # The pacer and the expiry threads may outlive close()
+            logging.debug('Failed to send to %s: server closed', address)
+
+    def join(self):
+        """
+        Block the calling thread for as long as the server is running.
+        """
+
+        # A signal caught by another thread does not interrupt a join without
+        # a timeout, so wake up regularly to let the main thread handle it
+        while self.loop_thread.is_alive():
+            self.loop_thread.join(1)
+
+    def close(self):
+        """
+        Stop the event loop and wait for it to release the socket.
+        """
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.executor.shutdown()
+        if self.route_sync is not None:
+            self.route_sync.stop()
@@ -0,0 +1,104 @@
+"""
+Compare the cost per message of encoding the server's replies and relayed
+messages and decoding its requests, for each message type, between the
+original per-message json.dumps and the codec module with each JSON backend.
+
+Run from the top-level directory of the repository:
+
+    python benchmarks/bench_codec.py --messages 100000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import codec
+
+from utils import MsgType, Error
+
+CARS = [{'id': i, 'name': 'car%d' % i, 'is_on': i % 2 == 0}
+        for i in range(10)]
+TOKEN = 'MTIzNDU2Nzg5MA.AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+
+def legacy_error(error_type, message):
+    body = {'type': MsgType.ERROR, 'error_type': error_type,
+            'error_msg': message}
+    return json.dumps(body).encode('utf-8')
+
+def legacy_dumps(body):
+    return json.dumps(body).encode('utf-8')
+
+# The messages sent by the server, each as the original encoding and the
+# codec's
+ENCODE = {
+    'ACK': (
+        lambda: ('{"type": %d}' % MsgType.ACK).encode('utf-8'),
+        lambda: codec.ACK),
+    'ACK login': (
+        lambda: legacy_dumps({'type': MsgType.ACK, 'user_id': 42,
+                              'token': TOKEN}),
+        lambda: codec.ack(user_id=42, token=TOKEN)),
+    'ACK cars': (
+        lambda: legacy_dumps({'type': MsgType.ACK, 'cars': CARS}),
+        lambda: codec.ack(cars=CARS)),
+    'ERROR': (
+        lambda: legacy_error(Error.BAD_REQ, 'car not connected'),
+        lambda: codec.error(Error.BAD_REQ, 'car not connected')),
+    'MOVE': (
+        lambda: legacy_dumps({'type': MsgType.MOVE, 'x': 512, 'y': 300}),
+        lambda: codec.dumps({'type': MsgType.MOVE, 'x': 512, 'y': 300})),
+}
+
+# The messages received by the server
+DECODE = {
+    'MOVE': b'{"type": 8, "x": 512, "y": 300}',
+    'SET_LED': b'{"type": 11, "state": 1}',
+    'LOGIN': b'{"type": 3, "name": "user", "password": "hunter22"}',
+    'LINK': b'{"type": 5, "car_id": 7, "token": "%s"}' % TOKEN.encode(),
+    'GET_CARS': b'{"type": 4, "user_id": 42}',
+}
+
+def measure(function, count):
+    """
+    Call a function count times and return the mean time per call in
+    microseconds.
+    """
+
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - start) / count * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    backends = ['json'] + (['orjson'] if codec.orjson is not None else [])
+
+    print('encode us/message')
+    print('%-10s %8s' % ('type', 'legacy') +
+          ''.join(' %8s' % b for b in backends))
+    for name, (legacy, current) in ENCODE.items():
+        row = [measure(legacy, args.messages)]
+        for backend in backends:
+            codec.use(backend)
+            row.append(measure(current, args.messages))
+        print('%-10s' % name + ''.join(' %8.2f' % us for us in row))
+
+    print()
+    print('decode us/message')
+    print('%-10s' % 'type' + ''.join(' %8s' % b for b in backends))
+    for name, data in DECODE.items():
+        row = []
+        for backend in backends:
+            codec.use(backend)
+            row.append(measure(lambda: codec.loads(data), args.messages))
+        print('%-10s' % name + ''.join(' %8.2f' % us for us in row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,463 @@
+"""
+Drive a running server with simulated apps and cars over loopback and
+measure its relay throughput, latency and loss at increasing offered load.
+
+Every app registers and logs in as one of a few users, every car registers
+and connects, and each app links to its own car. The apps then stream MOVE
+messages at the offered rate, shared evenly between them, and every car
+echoes an ACK back for each MOVE it receives. Each MOVE carries a sequence
+number in its x and y fields, so the canonical message still takes the
+server's relay fast path, and its latency from the app to the car is
+measured. The results of every step are written to a JSON file, so that runs
+on different commits can be compared.
+
+Cars must each have their own IP address and listen on port 8080, so they
+are bound to 127.0.x.y, which Linux routes to the loopback interface. The
+server paces MOVE messages to each car by default, so start it with
+--command-rate 0 to measure raw relay capacity, and in a scratch directory,
+since every run registers new users and cars:
+
+    python main.py 6006 --no-video --command-rate 0
+
+Then run from the top-level directory of the repository:
+
+    python benchmarks/bench_load.py --pairs 1000 --rate 5000 20000 50000
+    python benchmarks/bench_load.py --pairs 1000 --saturate
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from metrics import Histogram
+from utils import MsgType, Error
+
+CAR_PORT = 8080
+BUFFER_SIZE = 65536
+
+# MOVE coordinates hold 10 bits each, so sequence numbers wrap at 2 ** 20
+SEQUENCE_BITS = 20
+ACK = b'{"type": 0}'
+
+class SetupError(Exception):
+    pass
+
+def _raise_file_limit(needed):
+    # Every pair has two sockets, more than the usual soft limit of 1024 open
+    # files allows, so raise it as far as the hard limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY and hard < needed:
+            raise SetupError('%d open files needed, but the hard limit is %d; '
+                             'raise it or use fewer --pairs' % (needed, hard))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+def _car_ip(index):
+    # 127.0.0.0/24 is left alone, as the server usually listens there
+    return '127.%d.%d.%d' % (index // 64516 % 256, index // 254 % 254 + 1,
+                             index % 254 + 1)
+
+def _socket(host, port=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+def exchange(server, requests, window=64, timeout=1.0, retries=5):
+    """
+    Send every (socket, body) request to the server, with at most window of
+    them waiting for a reply, and return the replies in the same order.
+    Requests without a reply within the timeout, or refused with TRY_AGAIN,
+    are sent again, the latter after a short delay. Every socket may have
+    only one request.
+    """
+
+    replies = [None] * len(requests)
+    index_of = {sock: i for i, (sock, _) in enumerate(requests)}
+    attempts = [0] * len(requests)
+    waiting = {}
+    pending = list(range(len(requests) - 1, -1, -1))
+    selector = selectors.DefaultSelector()
+    for sock, _ in requests:
+        selector.register(sock, selectors.EVENT_READ)
+
+    try:
+        while pending or waiting:
+            now = time.monotonic()
+            for i, deadline in list(waiting.items()):
+                if deadline <= now:
+                    del waiting[i]
+                    pending.append(i)
+            while pending and len(waiting) < window:
+                i = pending.pop()
+                attempts[i] += 1
+                if attempts[i] > retries:
+                    raise SetupError('no reply to %s' % requests[i][1])
+                sock, body = requests[i]
+                sock.sendto(json.dumps(body).encode('utf-8'), server)
+                waiting[i] = now + timeout
+
+            for key, _ in selector.select(0.01):
+                try:
+                    data, _ = key.fileobj.recvfrom(BUFFER_SIZE)
+                except BlockingIOError:
+                    continue
+                i = index_of[key.fileobj]
+                if i in waiting:
+                    del waiting[i]
+                elif i in pending:
+                    # Answered after timing out, but before being sent again
+                    pending.remove(i)
+                else:
+                    # A late reply to a request that was sent again
+                    continue
+                reply = json.loads(data)
+                if reply['type'] == MsgType.ERROR:
+                    if reply['error_type'] == Error.TRY_AGAIN:
+                        # Back off before sending it again
+                        attempts[i] -= 1
+                        waiting[i] = time.monotonic() + 0.05
+                        continue
+                    raise SetupError('%s refused: %s' % (
+                        requests[i][1], reply['error_msg']))
+                replies[i] = reply
+    finally:
+        selector.close()
+    return replies
+
+class Fleet(object):
+    """
+    The simulated apps and cars, each app linked to the car of the same
+    index through the server.
+    """
+
+    def __init__(self, server, pairs, users, binary, window):
+        self.server = server
+        self.binary = binary
+        self.apps = [_socket('127.0.0.1') for _ in range(pairs)]
+        self.cars = [_socket(_car_ip(i), CAR_PORT) for i in range(pairs)]
+
+        run = '%08x' % random.getrandbits(32)
+        names = ['bench-%s-%d' % (run, u) for u in range(users)]
+        accounts = [(self.apps[u], {'type': MsgType.REG_USER, 'name': name,
+                                    'password': name})
+                    for u, name in enumerate(names)]
+        exchange(server, accounts, window)
+        logins = [(self.apps[u], {'type': MsgType.LOGIN, 'name': name,
+                                  'password': name})
+                  for u, name in enumerate(names)]
+        tokens = [reply['token'] for reply in exchange(server, logins, window)]
+
+        cars = exchange(server, [
+            (car, {'type': MsgType.REG_CAR, 'name': 'car%d' % i,
+                   'token': tokens[i % users]})
+            for i, car in enumerate(self.cars)
+        ], window)
+        car_ids = [reply['car_id'] for reply in cars]
+        exchange(server, [
+            (car, {'type': MsgType.CONN_CAR, 'car_id': car_ids[i],
+                   'binary': binary})
+            for i, car in enumerate(self.cars)
+        ], window)
+        exchange(server, [
+            (app, {'type': MsgType.LINK, 'car_id': car_ids[i],
+                   'token': tokens[i % users], 'binary': binary})
+            for i, app in enumerate(self.apps)
+        ], window)
+
+    def move(self, sequence):
+        """
+        Encode a MOVE message carrying the given sequence number.
+        """
+
+        x = sequence & 1023
+        y = (sequence >> 10) & 1023
+        if self.binary:
+            return bytes((0xA5, MsgType.MOVE, x >> 8, x & 255,
+                          y >> 8, y & 255))
+        return b'{"type": 8, "x": %d, "y": %d}' % (x, y)
+
+    def sequence(self, data):
+        """
+        Decode the sequence number of a MOVE message, or None if it is not
+        one.
+        """
+
+        if self.binary:
+            if len(data) != 6 or data[1] != MsgType.MOVE:
+                return None
+            return ((data[4] << 8 | data[5]) << 10) | (data[2] << 8 | data[3])
+        try:
+            body = json.loads(data)
+        except ValueError:
+            return None
+        if body.get('type') != MsgType.MOVE:
+            return None
+        return body['y'] << 10 | body['x']
+
+    def close(self):
+        for sock in self.apps + self.cars:
+            sock.close()
+
+class Step(object):
+    """
+    One period of sustained load at an offered rate, with the receiving
+    side run on its own thread.
+    """
+
+    def __init__(self, fleet, rate, duration, drain):
+        self.fleet = fleet
+        self.rate = rate
+        self.duration = duration
+        self.drain = drain
+        self.sent_at = {}
+        self.sent = 0
+        self.send_errors = 0
+        self.delivered = 0
+        self.acks_sent = 0
+        self.acks = 0
+        self.latency = Histogram()
+        self.running = True
+
+    def run(self):
+        receiver = threading.Thread(target=self._receive, daemon=True)
+        receiver.start()
+        start = time.monotonic()
+        self._send(start)
+        elapsed = time.monotonic() - start
+        time.sleep(self.drain)
+        self.running = False
+        receiver.join()
+
+        lost = len(self.sent_at)
+        return {
+            'offered_pps': self.rate,
+            'sent_pps': self.sent / elapsed,
+            'delivered_pps': self.delivered / elapsed,
+            'send_errors': self.send_errors,
+            'loss': lost / self.sent if self.sent else 0.0,
+            'ack_loss': (1 - self.acks / self.acks_sent
+                         if self.acks_sent else 0.0),
+            'latency_ms': {
+                'p50': self.latency.quantile(0.5) * 1e3,
+                'p99': self.latency.quantile(0.99) * 1e3,
+                'p999': self.latency.quantile(0.999) * 1e3,
+                'max': self.latency.max * 1e3,
+            },
+            # The generator could not keep up with the offered rate
+            'generator_limited': self.sent < self.rate * self.duration * 0.95,
+        }
+
+    def _send(self, start):
+        fleet = self.fleet
+        apps = fleet.apps
+        server = fleet.server
+        mask = (1 << SEQUENCE_BITS) - 1
+        sequences = [0] * len(apps)
+        pair = 0
+        end = start + self.duration
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            # Catch up with the offered rate, then wait for the next tick
+            due = int((now - start) * self.rate) - self.sent
+            for _ in range(due):
+                sequence = sequences[pair]
+                sequences[pair] = (sequence + 1) & mask
+                self.sent_at[(pair, sequence)] = time.monotonic()
+                try:
+                    apps[pair].sendto(fleet.move(sequence), server)
+                except OSError:
+                    del self.sent_at[(pair, sequence)]
+                    self.send_errors += 1
+                self.sent += 1
+                pair = (pair + 1) % len(apps)
+            time.sleep(0.0005)
+
+    def _receive(self):
+        fleet = self.fleet
+        selector = selectors.DefaultSelector()
+        for i, car in enumerate(fleet.cars):
+            selector.register(car, selectors.EVENT_READ, (True, i))
+        for app in fleet.apps:
+            selector.register(app, selectors.EVENT_READ, (False, None))
+
+        ack = bytes((0xA5, MsgType.ACK)) if fleet.binary else ACK
+        while self.running:
+            for key, _ in selector.select(0.05):
+                is_car, pair = key.data
+                while True:
+                    try:
+                        data = key.fileobj.recv(BUFFER_SIZE)
+                    except BlockingIOError:
+                        break
+                    if not is_car:
+                        self.acks += 1
+                        continue
+                    sequence = fleet.sequence(data)
+                    sent_at = self.sent_at.pop((pair, sequence), None)
+                    if sent_at is None:
+                        continue
+                    self.latency.record(time.monotonic() - sent_at)
+                    self.delivered += 1
+                    try:
+                        key.fileobj.sendto(ack, fleet.server)
+                        self.acks_sent += 1
+                    except OSError:
+                        pass
+        selector.close()
+
+def acceptable(result, max_loss, max_p99):
+    return result['loss'] <= max_loss and \
+        result['latency_ms']['p99'] <= max_p99
+
+def saturate(run_step, rate, growth, refine, max_loss, max_p99):
+    """
+    Raise the offered rate by the growth factor until loss or p99 latency
+    goes over its limit, then narrow down the highest acceptable rate by
+    bisection. Returns the steps run and the highest acceptable rate.
+    """
+
+    steps = []
+    good, bad = 0, None
+    while bad is None:
+        result = run_step(rate)
+        steps.append(result)
+        if acceptable(result, max_loss, max_p99) and \
+                not result['generator_limited']:
+            good = rate
+            rate = int(rate * growth)
+        elif acceptable(result, max_loss, max_p99):
+            # The generator is the bottleneck, so the server's limit is
+            # beyond what can be measured
+            return steps, good
+        else:
+            bad = rate
+
+    for _ in range(refine):
+        rate = (good + bad) // 2
+        if rate in (good, bad):
+            break
+        result = run_step(rate)
+        steps.append(result)
+        if acceptable(result, max_loss, max_p99):
+            good = rate
+        else:
+            bad = rate
+    return steps, good
+
+def server_stats(server):
+    """
+    Get the server's own metrics with a STATS message, or None if it does
+    not answer, e.g. because it is not on this host.
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(1)
+    try:
+        sock.sendto(b'{"type": %d}' % MsgType.STATS, server)
+        reply = json.loads(sock.recv(BUFFER_SIZE))
+        return reply.get('stats')
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', default='127.0.0.1:6006',
+                        help='HOST:PORT of the running server')
+    parser.add_argument('--pairs', type=int, default=1000,
+                        help='number of simulated app and car pairs')
+    parser.add_argument('--users', type=int, default=10,
+                        help='number of users the apps log in as')
+    parser.add_argument('--binary', action='store_true',
+                        help='use the binary encoding for MOVE and ACK')
+    parser.add_argument('--rate', type=int, nargs='+', default=[1000, 5000],
+                        help='offered MOVE messages per second, per step')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds of load per step')
+    parser.add_argument('--drain', type=float, default=0.5,
+                        help='seconds to wait for late messages after a step')
+    parser.add_argument('--window', type=int, default=64,
+                        help='most setup requests waiting for a reply')
+    parser.add_argument('--saturate', action='store_true',
+                        help='find the highest rate with acceptable loss '
+                             'and latency, starting from the first --rate')
+    parser.add_argument('--growth', type=float, default=1.5,
+                        help='rate increase per step when saturating')
+    parser.add_argument('--refine', type=int, default=4,
+                        help='bisection steps once saturated')
+    parser.add_argument('--max-loss', type=float, default=0.001,
+                        help='highest acceptable fraction of MOVEs lost')
+    parser.add_argument('--max-p99', type=float, default=10,
+                        help='highest acceptable p99 latency in ms')
+    parser.add_argument('--output', default='bench_load.json',
+                        help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    host, _, port = args.server.rpartition(':')
+    server = (host, int(port))
+
+    start = time.monotonic()
+    try:
+        # Two sockets per pair, and some to spare for everything else
+        _raise_file_limit(2 * args.pairs + 64)
+        fleet = Fleet(server, args.pairs, min(args.users, args.pairs),
+                      args.binary, args.window)
+    except SetupError as e:
+        sys.exit('setup failed: %s' % e)
+    print('set up %d pairs in %.1f s' % (args.pairs, time.monotonic() - start))
+
+    def run_step(rate):
+        result = Step(fleet, rate, args.duration, args.drain).run()
+        print('%8d pps offered  %8.0f delivered  loss %6.2f%%  '
+              'p50 %6.2f ms  p99 %6.2f ms  p999 %6.2f ms%s' % (
+                  rate, result['delivered_pps'], result['loss'] * 100,
+                  result['latency_ms']['p50'], result['latency_ms']['p99'],
+                  result['latency_ms']['p999'],
+                  '  (generator limited)'
+                  if result['generator_limited'] else ''))
+        return result
+
+    results = {
+        'commit': commit(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'parameters': vars(args),
+    }
+    if args.saturate:
+        steps, best = saturate(run_step, args.rate[0], args.growth,
+                               args.refine, args.max_loss, args.max_p99)
+        results['max_sustainable_pps'] = best
+        print('max sustainable: %d pps' % best)
+    else:
+        steps = [run_step(rate) for rate in args.rate]
+    results['steps'] = steps
+    results['server_stats'] = server_stats(server)
+    fleet.close()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to %s' % args.output)
@@ -0,0 +1,163 @@
+"""
+Compare the cost per relayed datagram of the original receive loop, which
+calls recvfrom and sendto once per datagram, with the batched
+netio.DatagramReader and DatagramWriter used by server.Server.
+
+Run from the top-level directory of the repository:
+
+    python benchmarks/bench_recv.py --packets 20000
+"""
+
+import argparse
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from netio import DatagramReader, DatagramWriter
+
+MOVE = b'{"type": 8, "x": 512, "y": 512}'
+
+class CountingSocket(socket.socket):
+    """
+    A UDP socket that counts the system calls made through it.
+    """
+
+    def __init__(self):
+        super().__init__(socket.AF_INET, socket.SOCK_DGRAM)
+        self.syscalls = 0
+
+    def recvfrom(self, *args):
+        self.syscalls += 1
+        return super().recvfrom(*args)
+
+    def recvfrom_into(self, *args):
+        self.syscalls += 1
+        return super().recvfrom_into(*args)
+
+    def sendto(self, *args):
+        self.syscalls += 1
+        return super().sendto(*args)
+
+class CountingPoll(object):
+    def __init__(self, poller, sock):
+        self.poller = poller
+        self.sock = sock
+
+    def poll(self, *args):
+        self.sock.syscalls += 1
+        return self.poller.poll(*args)
+
+# Datagrams queued per round, small enough to fit in the default socket
+# receive buffer so that none are dropped before the loop reads them
+ROUND = 128
+
+class LegacyLoop(object):
+    def __init__(self, sock):
+        self.sock = sock
+
+    def run(self, dest, packets, measure):
+        for _ in range(packets):
+            measure.begin()
+            data, _ = self.sock.recvfrom(1024)
+            self.sock.sendto(data, dest)
+            measure.end()
+
+class BatchedLoop(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = DatagramReader(sock, 1024, 32)
+        self.reader._poller = CountingPoll(self.reader._poller, sock)
+        self.writer = DatagramWriter(sock)
+
+    def run(self, dest, packets, measure):
+        received = 0
+        while received < packets:
+            measure.begin()
+            count = self.reader.drain()
+            for i in range(count):
+                self.writer.queue(self.reader.datagram(i), dest)
+            self.writer.flush()
+            measure.end()
+            received += count
+
+class Allocations(object):
+    """
+    Estimates the bytes allocated per iteration from tracemalloc's peak,
+    which is reset at the start of every iteration.
+    """
+
+    def __init__(self):
+        self.total = 0
+
+    def begin(self):
+        tracemalloc.reset_peak()
+        self.start = tracemalloc.get_traced_memory()[0]
+
+    def end(self):
+        self.total += tracemalloc.get_traced_memory()[1] - self.start
+
+class NoMeasure(object):
+    total = 0
+
+    def begin(self):
+        pass
+
+    def end(self):
+        pass
+
+def run(loop_class, packets, trace):
+    sock = CountingSocket()
+    sock.bind(('127.0.0.1', 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    loop = loop_class(sock)
+    dest = sink.getsockname()
+
+    measure = Allocations() if trace else NoMeasure()
+    elapsed = 0
+    for _ in range(packets // ROUND):
+        # Queue a round of datagrams up front so the loop has work waiting
+        for _ in range(ROUND):
+            sender.sendto(MOVE, sock.getsockname())
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        loop.run(dest, ROUND, measure)
+        elapsed += time.perf_counter() - start
+        if trace:
+            tracemalloc.stop()
+        # Empty the sink so it never overflows
+        sink.setblocking(False)
+        try:
+            while True:
+                sink.recv(1024)
+        except BlockingIOError:
+            pass
+
+    for s in (sock, sender, sink):
+        s.close()
+    packets = packets // ROUND * ROUND
+    return {
+        'us_per_packet': elapsed / packets * 1e6,
+        'syscalls_per_packet': sock.syscalls / packets,
+        'bytes_allocated_per_packet': measure.total / packets,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--packets', type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, loop in (('legacy', LegacyLoop), ('batched', BatchedLoop)):
+        timing = run(loop, args.packets, trace=False)
+        allocs = run(loop, args.packets, trace=True)
+        print('%-8s %6.2f us/packet  %5.2f syscalls/packet  '
+              '%6.1f bytes allocated/packet' % (
+                  name, timing['us_per_packet'],
+                  timing['syscalls_per_packet'],
+                  allocs['bytes_allocated_per_packet']))
@@ -0,0 +1,94 @@
+"""
+Compare the car queries run by the handlers on the schema without indexes
+(migration 2) and on the current schema, over a database of 100,000 users
+with 10 cars each.
+
+Run from the top-level directory of the repository:
+
+    python benchmarks/bench_schema.py --users 100000 --cars-per-user 10
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import schema
+
+from utils import Database
+
+def populate(db, users, cars_per_user):
+    with db as (dbconnect, cursor):
+        cursor.executemany(
+            schema.INSERT_USER,
+            (('user%d' % i, 'salt', 'password') for i in range(users))
+        )
+        cursor.executemany(
+            schema.INSERT_CAR,
+            (('car%d' % c, '10.0.%d.%d' % (c, u % 256), u + 1)
+             for u in range(users) for c in range(cars_per_user))
+        )
+        dbconnect.commit()
+
+def measure(db, queries):
+    """
+    Run every query and return the mean time per query in microseconds.
+    """
+
+    with db.read() as (_, cursor):
+        start = time.perf_counter()
+        for query, params in queries:
+            cursor.execute(query, params).fetchall()
+        elapsed = time.perf_counter() - start
+    return elapsed / len(queries) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--cars-per-user', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(0)
+    queries = {
+        'cars by user': [
+            (schema.CARS_BY_USER, (random.randrange(args.users) + 1,))
+            for _ in range(args.queries)
+        ],
+        'car by name': [
+            (schema.CAR_BY_NAME,
+             (random.randrange(args.users) + 1,
+              'car%d' % random.randrange(args.cars_per_user)))
+            for _ in range(args.queries)
+        ],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(directory, 'bench.db'))
+        schema.migrate(db, 2)
+
+        start = time.perf_counter()
+        populate(db, args.users, args.cars_per_user)
+        print('populated %d users, %d cars in %.1f s' % (
+            args.users, args.users * args.cars_per_user,
+            time.perf_counter() - start))
+
+        before = {name: measure(db, q) for name, q in queries.items()}
+
+        start = time.perf_counter()
+        schema.migrate(db)
+        print('migrated to version %d in %.1f s' % (
+            len(schema.MIGRATIONS), time.perf_counter() - start))
+
+        after = {name: measure(db, q) for name, q in queries.items()}
+
+    print('%-14s %14s %14s' % ('query', 'unindexed us', 'indexed us'))
+    for name in queries:
+        print('%-14s %14.1f %14.1f' % (name, before[name], after[name]))
+
+if __name__ == '__main__':
+    main()
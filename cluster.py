@@ -0,0 +1,74 @@
+import logging
+import multiprocessing
+import threading
+
+class RouteSync(object):
+    """
+    Replicates route table changes between server worker processes that share
+    a port with SO_REUSEPORT. The kernel spreads datagrams across the workers,
+    so the app and car of a single route may be served by different
+    processes. Every worker keeps a full local copy of the route table, so
+    lookups on the relay path never leave the process, and each change made
+    locally is pushed to the inbox queue of every other worker, where a
+    listener thread applies it.
+    """
+
+    def __init__(self, index, inboxes):
+        """
+        Create the route synchronizer for the worker at the given index in the
+        list of every worker's inbox queue.
+        """
+
+        self.index = index
+        self.inboxes = inboxes
+
+    @staticmethod
+    def create_inboxes(workers):
+        """
+        Create one inbox queue per worker, to be shared by all of them.
+        """
+
+        return [multiprocessing.Queue() for _ in range(workers)]
+
+    def start(self, server):
+        """
+        Start the listener thread that applies changes published by the other
+        workers to the given server.
+        """
+
+        listener = threading.Thread(
+            target=self._listen_forever,
+            args=(server,),
+            name='route-sync',
+            daemon=True
+        )
+        listener.start()
+
+    def publish(self, operation, *args):
+        """
+        Send a route table change to every other worker. The operation is the
+        name of the server method that applies the change locally.
+        """
+
+        for i, inbox in enumerate(self.inboxes):
+            if i != self.index:
+                inbox.put((operation, args))
+
+    def stop(self):
+        """
+        Stop the listener thread.
+        """
+
+        self.inboxes[self.index].put(None)
+
+    def _listen_forever(self, server):
+        inbox = self.inboxes[self.index]
+        while True:
+            change = inbox.get()
+            if change is None:
+                return
+            operation, args = change
+            try:
+                getattr(server, operation)(*args)
+            except Exception:
+                logging.exception('Failed to apply route change %s', operation)
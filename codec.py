@@ -0,0 +1,110 @@
+import json
+
+from utils import MsgType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The JSON libraries that can encode and decode messages; 'auto' picks orjson
+# if it is installed
+BACKENDS = ('auto', 'orjson', 'json')
+
+# Most distinct error replies kept encoded. Handlers only send a fixed set of
+# messages, so this is a bound against the few built from untrusted input.
+ERROR_CACHE_SIZE = 1024
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+def _orjson_dumps(obj):
+    # The standard library turns non-string keys into strings, so do the same
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+# The selected backend's functions. dumps() returns UTF-8 bytes, and loads()
+# raises ValueError for anything that is not valid UTF-8 encoded JSON.
+backend = None
+dumps = _json_dumps
+loads = json.loads
+
+def use(name='auto'):
+    """
+    Select the JSON library used by dumps() and loads(), one of BACKENDS.
+    Raises ValueError if it is unknown or not installed.
+    """
+
+    global backend, dumps, loads
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        dumps, loads = _orjson_dumps, orjson.loads
+    elif name == 'json':
+        dumps, loads = _json_dumps, json.loads
+    else:
+        raise ValueError('unknown JSON backend: %s' % name)
+    backend = name
+
+use()
+
+# Responses that never change are encoded once, by the standard library so
+# that they are the same whichever backend is selected
+ACK = json.dumps({'type': MsgType.ACK}).encode('utf-8')
+
+class Encoded(bytes):
+    """
+    A value that is already encoded as JSON, which ack() splices into a
+    message as it is.
+    """
+
+def array(items):
+    """
+    Join values already encoded as JSON into an encoded array.
+    """
+
+    return Encoded(b'[' + b', '.join(items) + b']')
+
+_ACK_START = ACK[:-1]
+_ACK_KEYS = {}
+_errors = {}
+
+def error(error_type, message):
+    """
+    Get an encoded ERROR message with the given error code and message. Each
+    distinct error is only encoded the first time it is sent.
+    """
+
+    key = (error_type, message)
+    data = _errors.get(key)
+    if data is None:
+        body = {'type': MsgType.ERROR, 'error_type': error_type,
+                'error_msg': message}
+        data = json.dumps(body).encode('utf-8')
+        if len(_errors) < ERROR_CACHE_SIZE:
+            _errors[key] = data
+    return data
+
+def ack(**fields):
+    """
+    Get an encoded ACK message with the given fields. The message is spliced
+    together from pre-encoded keys, so only the values are encoded, integers
+    without going through a JSON library and Encoded values not at all.
+    """
+
+    parts = [_ACK_START]
+    for name, value in fields.items():
+        key = _ACK_KEYS.get(name)
+        if key is None:
+            key = _ACK_KEYS[name] = (', %s: ' % json.dumps(name)).encode(
+                'utf-8')
+        parts.append(key)
+        if type(value) is int:
+            parts.append(b'%d' % value)
+        elif type(value) is Encoded:
+            parts.append(value)
+        else:
+            parts.append(dumps(value))
+    parts.append(b'}')
+    return b''.join(parts)
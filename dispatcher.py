@@ -0,0 +1,281 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from enum import Enum
+
+import codec
+import logs
+
+from utils import MsgType, Error
+
+class Overload(Enum):
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    REJECT = 'reject'
+
+    def __str__(self):
+        return self.value
+
+class Scheduling(Enum):
+    STRICT = 'strict'
+    WEIGHTED = 'weighted'
+
+    def __str__(self):
+        return self.value
+
+class MessageClass(object):
+    """
+    A class of message types that share a queue in the dispatcher. Under
+    weighted scheduling, the classes with messages waiting get workers in
+    proportion to their weights. A class can also have workers reserved for
+    it alone, and a target for how long its messages should wait for a
+    worker, against which late messages are counted.
+    """
+
+    def __init__(self, name, types, weight=1, target=1.0, reserved=0):
+        """
+        Create a class with the given name for the given message types.
+        """
+
+        self.name = name
+        self.types = frozenset(types)
+        self.weight = weight
+        self.target = target
+        self.reserved = reserved
+
+# The default classes, from highest to lowest priority. Control messages must
+# be relayed quickly; heartbeats only need handling within the presence TTL,
+# and have a queue of their own so that a flood of them cannot crowd out
+# sessions; authentication requests are slow to handle anyway, as they hash
+# passwords and write to the database.
+CLASSES = (
+    MessageClass('control', (MsgType.ACK, MsgType.MOVE, MsgType.SET_LED),
+                 weight=8, target=0.005, reserved=1),
+    MessageClass('session', (MsgType.LINK, MsgType.UNLINK, MsgType.CONN_CAR,
+                             MsgType.GET_CARS, MsgType.STATS),
+                 weight=4, target=0.05),
+    MessageClass('presence', (MsgType.HEARTBEAT,), weight=2, target=1.0),
+    MessageClass('auth', (MsgType.REG_USER, MsgType.LOGIN, MsgType.REG_CAR),
+                 weight=1, target=1.0),
+)
+
+def reassign(classes, msg_type, name):
+    """
+    Get a copy of the given classes with a message type moved to the class
+    with the given name. Raises ValueError if there is no such class.
+    """
+
+    if name not in [c.name for c in classes]:
+        raise ValueError('unknown message class: %s' % name)
+    return tuple(
+        MessageClass(c.name,
+                     (c.types | {msg_type}) if c.name == name
+                     else (c.types - {msg_type}),
+                     c.weight, c.target, c.reserved)
+        for c in classes
+    )
+
+class _Job(object):
+    __slots__ = ('handler', 'body', 'address', 'queued')
+
+    def __init__(self, handler, body, address, queued):
+        self.handler = handler
+        self.body = body
+        self.address = address
+        self.queued = queued
+
+class Dispatcher(object):
+    """
+    A fixed pool of worker threads that run message handlers. Incoming
+    messages are placed on bounded queues, one per message class. Under
+    strict scheduling, workers always take from the highest priority queue
+    that has messages waiting; under weighted scheduling, they share
+    themselves between the queues with messages waiting in proportion to
+    their classes' weights, so that no class is starved. Workers reserved
+    for a class only take from its queue, so it is served even while every
+    other worker is busy with slow handlers.
+
+    When a queue is full, the configured overload policy decides whether the
+    oldest queued message is dropped, the new message is dropped, or the new
+    message is rejected with a "busy" error sent back to its source.
+    """
+
+    def __init__(self, server, workers=4, queue_size=256,
+            overload=Overload.DROP_OLDEST, classes=CLASSES,
+            scheduling=Scheduling.WEIGHTED, metrics=None):
+        """
+        Create a dispatcher that runs handlers for the given server on a pool
+        of the given number of shared worker threads, plus those reserved by
+        each message class. Messages of types in none of the classes belong
+        to the last one. If a metrics.Metrics is given, the time from
+        receiving each message to its handler returning is recorded.
+        """
+
+        self.server = server
+        self.queue_size = queue_size
+        self.overload = overload
+        self.classes = classes
+        self.scheduling = scheduling
+        self.metrics = metrics
+        self.class_of = {msg_type: i for i, c in enumerate(classes)
+                         for msg_type in c.types}
+        self.queues = [deque() for _ in classes]
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # The current weights of a smooth weighted round robin
+        self._current = [0] * len(classes)
+
+        self.dispatched = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.late = [0] * len(classes)
+        self.max_wait = [0.0] * len(classes)
+
+        self.workers = []
+        for i in range(workers):
+            self._start_worker('worker-%d' % i, None)
+        for index, c in enumerate(classes):
+            for i in range(c.reserved):
+                self._start_worker('%s-worker-%d' % (c.name, i), index)
+
+    def _start_worker(self, name, index):
+        worker = threading.Thread(
+            target=self._work_forever,
+            args=(index,),
+            name=name,
+            daemon=True
+        )
+        worker.start()
+        self.workers.append(worker)
+
+    def submit(self, handler, body, address, received=None):
+        """
+        Queue a handler to be run by a worker, for a message received at the
+        given time.monotonic() time, or now. Returns False if the message was
+        dropped or rejected because its queue was full.
+        """
+
+        if received is None:
+            received = time.monotonic()
+        index = self.class_of.get(body['type'], len(self.classes) - 1)
+        job = _Job(handler, body, address, received)
+        with self.cond:
+            queue = self.queues[index]
+            if len(queue) >= self.queue_size:
+                if self.overload is Overload.DROP_OLDEST:
+                    queue.popleft()
+                    self.dropped += 1
+                elif self.overload is Overload.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                else:
+                    self.rejected += 1
+                    queue = None
+            if queue is not None:
+                queue.append(job)
+                self.dispatched += 1
+                # Reserved workers wait on the same condition, so make sure
+                # one that can take the job wakes up
+                self.cond.notify_all()
+                return True
+
+        logging.debug('Dispatcher queue full, rejecting request')
+        self.server.send(codec.error(Error.SERVER_ERR, 'server busy'), address)
+        return False
+
+    def close(self):
+        """
+        Stop the workers once they have run the messages already queued, and
+        wait for them to finish.
+        """
+
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def stats(self):
+        """
+        Get a snapshot of the dispatcher's queue depths and counters, with the
+        per-class ones keyed by class name.
+        """
+
+        names = [c.name for c in self.classes]
+        with self.cond:
+            return {
+                'workers': len(self.workers),
+                'depth': dict(zip(names, map(len, self.queues))),
+                'dispatched': self.dispatched,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+                'late': dict(zip(names, self.late)),
+                'max_wait': dict(zip(names, self.max_wait)),
+            }
+
+    def _next(self, index):
+        if index is None:
+            index = self._pick()
+        if index is None or not self.queues[index]:
+            return None
+
+        job = self.queues[index].popleft()
+        wait = time.monotonic() - job.queued
+        if wait > self.classes[index].target:
+            self.late[index] += 1
+        if wait > self.max_wait[index]:
+            self.max_wait[index] = wait
+        return job
+
+    def _pick(self):
+        if self.scheduling is Scheduling.STRICT:
+            for index, queue in enumerate(self.queues):
+                if queue:
+                    return index
+            return None
+
+        # Smooth weighted round robin over the classes with messages waiting
+        best = None
+        total = 0
+        for index, queue in enumerate(self.queues):
+            if queue:
+                weight = self.classes[index].weight
+                self._current[index] += weight
+                total += weight
+                if best is None or self._current[index] > self._current[best]:
+                    best = index
+        if best is not None:
+            self._current[best] -= total
+        return best
+
+    def _work_forever(self, index=None):
+        """
+        Start a loop that waits for queued messages and runs their handlers
+        one at a time, taking them from the queue of the class at the given
+        index only, if one is given, until the dispatcher is closed.
+        """
+
+        while True:
+            with self.cond:
+                job = self._next(index)
+                while job is None:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                    job = self._next(index)
+
+            msg_type = job.body['type']
+            try:
+                job.handler(self.server, job.body, job.address)
+            except Exception:
+                logging.exception('Handler raised an exception',
+                                  extra=logs.fields(msg_type, job.address))
+            latency = time.monotonic() - job.queued
+            if self.metrics is not None:
+                self.metrics.observe('handler_seconds', msg_type, latency)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug('Handled message', extra=logs.fields(
+                    msg_type, job.address, latency))
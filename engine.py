@@ -0,0 +1,372 @@
+import functools
+import logging
+import threading
+import time
+
+import codec
+import relay
+import schema
+import logs
+import validation
+import wire
+
+from hashing import PasswordHasher
+from metrics import Metrics
+from pacing import Pacer
+from presence import Presence
+from registry import CarRegistry
+from routes import RouteTable
+from sessions import SessionStore
+from utils import Error, Database
+
+class Engine(object):
+    """
+    The parts of the UDP server that do not depend on how its socket is run,
+    shared by server.Server and aioserver.AsyncServer: the database, routes,
+    sessions, car registry and presence, and the path every received message
+    takes up to its handler. Each engine subclass owns its socket, sends with
+    send(), and runs handlers with _dispatch().
+
+    This is also the interface the functions in handlers.py are given, so
+    they work unchanged with either engine.
+    """
+
+    def __init__(self, db_name, route_sync=None, hasher=None,
+            session_ttl=SessionStore.TTL, video=None,
+            route_ttl=RouteTable.TTL, route_capacity=RouteTable.CAPACITY,
+            command_rate=Pacer.RATE, presence_ttl=Presence.TTL):
+        """
+        Set up the state of a server using the given database. The arguments
+        are described by the engine subclasses.
+        """
+
+        self.routes = RouteTable(route_ttl, route_capacity)
+        self.binary_peers = set()
+        self.handlers = {}
+        self.metrics = Metrics()
+        self.db = Database(db_name)
+        self.db.metrics = self.metrics
+        schema.migrate(self.db)
+        self.hasher = hasher if hasher is not None else PasswordHasher()
+        self.sessions = SessionStore(self.db, session_ttl)
+        self.registry = CarRegistry(self.db)
+        self.presence = Presence(self.registry, self.db, presence_ttl)
+        self.video = video
+        self.pacer = Pacer(self.send, command_rate) if command_rate else None
+        self.route_sync = route_sync
+
+        if route_sync is not None:
+            self.registry.publish = functools.partial(
+                route_sync.publish, '_apply_car')
+            route_sync.start(self)
+
+    def _start(self):
+        """
+        Start the background work of the server, once its socket is bound.
+        """
+
+        self._add_gauges()
+        expiry = threading.Thread(
+            target=self._expire_routes_forever,
+            name='route-expiry',
+            daemon=True
+        )
+        expiry.start()
+        presence = threading.Thread(
+            target=self._expire_presence_forever,
+            name='presence',
+            daemon=True
+        )
+        presence.start()
+
+    def _add_gauges(self):
+        metrics = self.metrics
+        metrics.gauge('routes', lambda: len(self.routes),
+                      description='Routes between apps and cars')
+        metrics.gauge('live_cars', lambda: len(self.presence),
+                      description='Cars tracked as on by their heartbeats')
+        metrics.gauge('binary_peers', lambda: len(self.binary_peers),
+                      description='Peers using the binary encoding')
+        metrics.gauge('threads', threading.active_count,
+                      description='Threads in the server process')
+        if self.pacer is not None:
+            metrics.gauge('paced_destinations',
+                          lambda: self.pacer.stats()['destinations'],
+                          description='Cars with paced commands')
+
+    def _reject_oversized(self, addr, max_datagram):
+        self.metrics.count('packets_in', 'invalid')
+        logging.debug('Received oversized datagram',
+                      extra=logs.fields(source=addr))
+        msg = 'datagram larger than %d bytes' % max_datagram
+        self.send(codec.error(Error.BAD_REQ, msg), addr)
+
+    def _receive(self, data, addr, received):
+        """
+        Process a single message, received at the given time.monotonic()
+        time. Control messages from a source with a route are forwarded as-is
+        from the calling thread. Otherwise, if the message is JSON-formatted
+        or binary-encoded and matches the schema of its type, it is given to
+        _dispatch() with its handler.
+        """
+
+        dest = self.routes.get_destination(addr)
+        if dest is not None:
+            msg_type = relay.relay_type(data, dest in self.binary_peers)
+            if msg_type is not None:
+                self.metrics.count('packets_in', msg_type)
+                self.relay(data, dest, msg_type)
+                latency = time.monotonic() - received
+                self.metrics.observe('handler_seconds', msg_type, latency)
+                if logging.root.isEnabledFor(logging.DEBUG):
+                    logging.debug('Relayed message', extra=logs.fields(
+                        msg_type, addr, latency))
+                return
+
+        # The data may be a view of a reused receive buffer, so handlers need
+        # their own copy
+        data = bytes(data)
+        if wire.is_binary(data):
+            try:
+                body = wire.decode(data)
+            except ValueError as e:
+                self.metrics.count('packets_in', 'invalid')
+                logging.debug('Received invalid binary message',
+                              extra=logs.fields(source=addr))
+                self.send(codec.error(Error.BAD_REQ, str(e)), addr)
+                return
+        else:
+            try:
+                body = codec.loads(data)
+            except ValueError:
+                self.metrics.count('packets_in', 'invalid')
+                logging.debug('Received invalid JSON',
+                              extra=logs.fields(source=addr))
+                self.send(codec.error(Error.BAD_REQ, 'invalid JSON'), addr)
+                return
+
+        error = validation.validate(body)
+        if error is not None:
+            self.metrics.count('packets_in', 'invalid')
+            logging.debug('Received invalid message',
+                          extra=logs.fields(source=addr))
+            self.send(error, addr)
+            return
+
+        handler = self.handlers.get(body['type'])
+        if handler is None:
+            self.metrics.count('packets_in', 'unknown')
+            logging.debug('Invalid message type',
+                          extra=logs.fields(source=addr))
+            self.send(validation.INVALID_TYPE, addr)
+            return
+
+        self.metrics.count('packets_in', body['type'])
+        self._dispatch(handler, body, addr, received)
+
+    def _dispatch(self, handler, body, addr, received):
+        """
+        Run the handler of a valid message, received at the given
+        time.monotonic() time.
+        """
+
+        raise NotImplementedError
+
+    def send(self, data, address):
+        """
+        Send a message containing the given data from the server's UDP socket
+        to the given address.
+        """
+
+        raise NotImplementedError
+
+    def get_db(self):
+        """
+        Get the Database object.
+        """
+
+        return self.db
+
+    def get_hasher(self):
+        """
+        Get the PasswordHasher object.
+        """
+
+        return self.hasher
+
+    def get_sessions(self):
+        """
+        Get the SessionStore object.
+        """
+
+        return self.sessions
+
+    def get_registry(self):
+        """
+        Get the CarRegistry object.
+        """
+
+        return self.registry
+
+    def get_presence(self):
+        """
+        Get the presence.Presence object.
+        """
+
+        return self.presence
+
+    def get_metrics(self):
+        """
+        Get the metrics.Metrics object.
+        """
+
+        return self.metrics
+
+    def get_video(self):
+        """
+        Get the video.VideoRouter or mjpeg.MJPEGRelay object, or None if
+        video routing is off.
+        """
+
+        return self.video
+
+    def route_video(self, car_id, ip):
+        """
+        Route the video stream of a newly registered car. Only one of the
+        processes sharing the port has a VideoRouter, so the others pass the
+        car on to it.
+        """
+
+        if self.video is not None:
+            self.video.add_car(car_id, ip)
+        elif self.route_sync is not None:
+            self.route_sync.publish('_route_video', car_id, ip)
+
+    def _route_video(self, car_id, ip):
+        if self.video is not None:
+            self.video.add_car(car_id, ip)
+
+    def _apply_car(self, operation, *args):
+        self.registry.apply(operation, *args)
+
+    def add_route(self, address1, address2):
+        """
+        Cache the source and destination addresses for a proxied-connection
+        between a client application and a car, with this server acting as the
+        proxy, replacing any route either of them already has. The route is
+        replicated to the other worker processes, if any.
+        """
+
+        for route in self.routes.link(address1, address2):
+            self._forget_route(route)
+        if self.route_sync is not None:
+            self.route_sync.publish('_set_route', address1, address2)
+
+    def _set_route(self, address1, address2):
+        self.routes.link(address1, address2, owned=False)
+
+    def remove_route(self, address):
+        """
+        Remove the route from the given address, returning False if it has no
+        route. The removal is replicated to the other worker processes, if
+        any.
+        """
+
+        route = self.routes.unlink(address)
+        if route is None:
+            return False
+        self._forget_route(route)
+        return True
+
+    def _forget_route(self, route):
+        self._drop_route_state(route.app, route.car)
+        if self.route_sync is not None:
+            self.route_sync.publish('_unlink_route', route.app, route.car)
+
+    def _unlink_route(self, app, car):
+        # The app may have linked again since, so only remove the same route
+        if self.routes.unlink(app, car) is not None:
+            self._drop_route_state(app, car)
+
+    def _drop_route_state(self, app, car):
+        # The app negotiated its encoding when it linked, so that goes too
+        self._set_binary_peer(app, False)
+        if self.pacer is not None:
+            self.pacer.forget(car)
+
+    def _expire_routes_forever(self):
+        """
+        Start an infinite loop that removes the routes left idle for longer
+        than the route TTL.
+        """
+
+        while True:
+            time.sleep(self.routes.tick)
+            for route in self.routes.expire():
+                logging.debug('Route expired',
+                              extra=logs.fields(source=route.app))
+                self._forget_route(route)
+
+    def _expire_presence_forever(self):
+        """
+        Start an infinite loop that turns off the cars that have stopped
+        sending heartbeats and writes the changes in which cars are on to the
+        database.
+        """
+
+        while True:
+            time.sleep(self.presence.tick)
+            for car_id in self.presence.expire():
+                logging.debug('Car %d stopped sending heartbeats', car_id)
+            self.presence.flush()
+
+    def relay(self, data, address, msg_type):
+        """
+        Forward a control message of the given type to the given address.
+        MOVE and SET_LED messages are paced, so only the latest of them may
+        be sent.
+        """
+
+        if self.pacer is not None and msg_type in Pacer.PACED_TYPES:
+            self.pacer.submit(data, address, msg_type)
+        else:
+            self.send(data, address)
+
+    def get_destination(self, address):
+        """
+        Get the cached destination address that corresponds to a given source
+        address, and record activity on the route.
+        """
+
+        return self.routes.get_destination(address)
+
+    def set_binary(self, address, enabled):
+        """
+        Record whether the peer at the given address has negotiated the
+        binary encoding for the control messages relayed to it.
+        """
+
+        self._set_binary_peer(address, enabled)
+        if self.route_sync is not None:
+            self.route_sync.publish('_set_binary_peer', address, enabled)
+
+    def _set_binary_peer(self, address, enabled):
+        if enabled:
+            self.binary_peers.add(address)
+        else:
+            self.binary_peers.discard(address)
+
+    def is_binary(self, address):
+        """
+        Check whether the peer at the given address uses the binary encoding.
+        """
+
+        return address in self.binary_peers
+
+    def add_handler(self, message_type, handler):
+        """
+        Register a handler function that will be called whenever a message of
+        message_type is received.
+        """
+
+        self.handlers[message_type] = handler
@@ -1,22 +1,79 @@
+import ipaddress
 import logging
-import json
-import re
-import subprocess
-import hashlib, os
+import os
+
+import codec
+import schema
+import wire
+
+from hashing import Busy
 
 from base64 import b64encode, b64decode
 from utils import MsgType, Error
 
 CAR_PORT = 8080 # Assume each car is listening on this port
 
-HAPROXY_CFG = '/etc/haproxy/haproxy.cfg'
-ACL_START_REGEX = r'(#ACL_START\n)'
-RULE_START_REGEX = r'(#RULE_START\n)'
-BACKEND_START_REGEX = r'(#BACKEND_START\n)'
+# Cars sent per GET_CARS reply unless a "limit" is given, few enough for the
+# reply to fit in one packet
+CARS_PAGE = 20
+
+# Largest streamed GET_CARS chunk, which fits in one packet on any IPv4 or
+# IPv6 path, and most chunks streamed per request, so that one small request
+# cannot be answered with an unbounded burst towards its claimed source
+STREAM_CHUNK = 1200
+STREAM_CHUNKS = 8
+_CHUNK_OVERHEAD = len(codec.ack(seq=STREAM_CHUNKS - 1, done=False,
+                                next=2**63 - 1, cars=codec.array([])))
+
+# The servers only call a handler with a body that matches its type's schema
+# in utils.SCHEMAS, so the fields declared there need no checks here
+
+def _relay(server, dest, body):
+    # Forward a control message in the encoding the destination negotiated
+    if server.is_binary(dest):
+        data = wire.encode(body)
+    else:
+        data = codec.dumps(body)
+    server.relay(data, dest, body['type'])
+
+def _hash_password(server, password, salt, source):
+    # Hash on the server's hashing pool. Returns None after sending an error
+    # if the pool is too busy to take the request.
+    try:
+        return server.get_hasher().hash(password, salt, source)
+    except Busy:
+        msg = 'server busy, try again'
+        logging.debug(msg)
+        server.send(codec.error(Error.TRY_AGAIN, msg), source)
+        return None
+
+def _get_user_id(server, body, source):
+    # Get the user making a request from its session token, or from its
+    # "user_id" field. Returns None after sending an error.
+    if 'token' in body:
+        user_id = server.get_sessions().verify(body['token'])
+        if user_id is None or body.get('user_id', user_id) != user_id:
+            msg = 'invalid or expired token'
+            logging.debug(msg)
+            server.send(codec.error(Error.UNAUTHORIZED, msg), source)
+            return None
+        return user_id
 
-def _send_JSON(server, source, JSON):
-    data = json.dumps(JSON)
-    server.send(data.encode('utf-8'), source)
+    if 'user_id' not in body:
+        msg = 'missing field: "user_id" or "token" required'
+        logging.debug(msg)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
+        return None
+    return body['user_id']
+
+def _committed(server, future, source):
+    # Check that a submitted database mutation was committed. Returns False
+    # after sending an error if it was not.
+    if future.exception() is not None:
+        logging.debug('Database mutation failed: %s', future.exception())
+        server.send(codec.error(Error.SERVER_ERR, 'database error'), source)
+        return False
+    return True
 
 def _format_error_JSON(message):
     logging.debug(message)
@@ -27,96 +84,68 @@ def _format_error_JSON(message):
     return returnJSON
 
 def handle_movement(server, body, source):
-    logging.debug('MOVEMENT')
     '''
     1. Get desination IP from cache (if not in cache, get from 'cars' table)
     2. Forward the message
     '''
 
-    # Check data is valid
-    if 'x' not in body or 'y' not in body:
-        message = 'missing field: "x", "y" required'
-        logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
-        return
-
-    # Get JSON data
-    x = body['x']
-    y = body['y']
-
-    if not isinstance(x, int) or not isinstance(y, int) or \
-            x < 0 or x > 1023 or y < 0 or y > 1023:
-        msg = '"x" and "y" values must be within the range [0, 1023]'
-        logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), addr)
-        return
-
     # Check cache for car ip address
     car_addr = server.get_destination(source)
     if car_addr is None:
     # Return bad request.
         message = 'car not connected'
         logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
+        server.send(codec.error(Error.BAD_REQ, message), source)
         return
 
     # Send movement data to car
-    _send_JSON(server, car_addr, body)
+    _relay(server, car_addr, body)
 
 def handle_register_user(server, body, source):
-    logging.debug('REGISTER USER')
     '''
     1. Store username, salt, and salted-and-hashed-password in 'users' table
     2. Send a confirmation (ACK) back to the app
     '''
 
-    # Check data is valid. if not, send an error packet
-    if 'name' not in body or 'password' not in body:
-        message = 'missing field: "name", "password" required'
-        logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
-        return
-
     # Get JSON data
     name = body['name']
     password = body['password']
 
-    if not isinstance(name, str) or not isinstance(password, str):
-        msg = '"name" and "password" must be strings'
-        logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
-        return
-
     # Salt password
     salt =  os.urandom(32)
-    password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, 100000)
+    password = _hash_password(server, password, salt, source)
+    if password is None:
+        return
 
     # Create user in db. Send an error if user already exists.
-    with server.get_db() as (dbconnect, cursor):
-        cursor.execute("select * from users where name=(?)", [name])
+    def insert_user(cursor):
+        cursor.execute(schema.USER_BY_NAME, (name,))
         entry = cursor.fetchone()
-        if entry is None:
-            cursor.execute("insert into users (name,salt,password) values (?,?,?)",\
-            (name,b64encode(salt).decode('utf-8'), b64encode(password).decode('utf-8')))
-            dbconnect.commit()
-        else:
+        if entry is not None:
+            return None
+        cursor.execute(schema.INSERT_USER, (name,
+            b64encode(salt).decode('utf-8'), b64encode(password).decode('utf-8')))
+        return cursor.lastrowid
+
+    # Only confirm once the user has been committed
+    def on_commit(future):
+        if not _committed(server, future, source):
+            return
+
+        user_id = future.result()
+        if user_id is None:
             message = "User already exists"
             logging.debug(message)
-            server.send(Error.json(Error.BAD_REQ, message), source)
+            server.send(codec.error(Error.BAD_REQ, message), source)
             return
 
-        user_id = cursor.lastrowid
+        # Send Confirmation to App
+        logging.debug("User registration successful")
+        server.send(codec.ack(user_id=user_id), source)
 
-    # Send Confirmation to App
-    logging.debug("User registration successful")
-    ackJSON = {
-      "type": MsgType.ACK,
-      "user_id": user_id,
-    }
-    _send_JSON(server, source, ackJSON)
+    server.get_db().submit(insert_user).add_done_callback(on_commit)
 
 def handle_register_car(server, body, source):
-    logging.debug('REGISTER CAR')
     '''
     1. Add a row in the 'cars' table
     2. Send a confirmation (ACK) back to the car
@@ -124,161 +153,142 @@ def handle_register_car(server, body, source):
 
     ip = source[0]
 
-    # Check data is valid. if not, send an error packet
-    if 'name' not in body or 'user_id' not in body:
-        message = 'missing field: "name", "user_id" required'
-        logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
-        return
-
     # Get JSON data
     name = body['name']
-    user_id = body['user_id']
 
-    if not isinstance(name, str) or not isinstance(user_id, int):
-        msg = '"name" must be a string and "user_id" must be an integer'
-        logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+    user_id = _get_user_id(server, body, source)
+    if user_id is None:
         return
 
-    with server.get_db() as (dbconnect, cursor):
+    def insert_car(cursor):
         # Check that the user exists in the database
-        cursor.execute("select * from users where id=(?)", [user_id])
+        cursor.execute(schema.USER_EXISTS, (user_id,))
         entry = cursor.fetchone()
-        # Send error packet
         if entry is None:
-            message = "User is not registered"
-            logging.debug(message)
-            server.send(Error.json(Error.BAD_REQ, message), source)
-            return
+            return None, "User is not registered"
 
         # Check that the user does not already have car with that name
-        cursor.execute("select * from cars where name=(?) and userID=(?)", (name, user_id))
+        cursor.execute(schema.CAR_BY_NAME, (user_id, name))
         entry = cursor.fetchone()
-        # Send error if car already exists
-        if entry is None:
-            cursor.execute("insert into cars (name,ip,userID,isOn) values(?,?,?,?)", (name, ip, user_id, 0))
-            dbconnect.commit()
-        else:
-            message = "Car name already registered"
-            logging.debug(message)
-            server.send(Error.json(Error.BAD_REQ, message), source)
-            return
-
-        car_id = cursor.lastrowid
-
-    with open(HAPROXY_CFG, 'r+') as cfg:
-        content = cfg.read()
-
-        cfg.seek(0)
-        cfg.truncate()
+        if entry is not None:
+            return None, "Car name already registered"
 
-        # Insert ACL based on car ID
-        acl_regex = r'\1    acl url_car{0} path_beg /{0}\n'.format(car_id)
-        content = re.sub(ACL_START_REGEX, acl_regex, content)
+        cursor.execute(schema.INSERT_CAR, (name, ip, user_id))
+        return cursor.lastrowid, None
 
-        # Insert rule based on ACL
-        rule_regex = r'\1    use_backend car{0} if url_car{0}\n'.format(car_id)
-        content = re.sub(RULE_START_REGEX, rule_regex, content)
+    # Wait for the car to be committed before routing its video
+    future = server.get_db().submit(insert_car)
+    if not _committed(server, future, source):
+        return
 
-        # Insert backend based on car IP
-        backend_regex = \
-r'''\1backend car{0}
-    mode http
-    reqrep ^([^\ ]*\ /){0}[/]?(.*)     \\1\\2
-    server car{0}_app {1}:8000 check\n\n'''.format(car_id, ip)
-        content = re.sub(BACKEND_START_REGEX, backend_regex, content)
+    car_id, message = future.result()
+    # Send error packet
+    if car_id is None:
+        logging.debug(message)
+        server.send(codec.error(Error.BAD_REQ, message), source)
+        return
 
-        cfg.write(content)
+    server.get_registry().add(car_id, name, ip, user_id)
 
-    subprocess.run(['systemctl', 'restart', 'haproxy'])
+    # Video routing is applied in the background, so confirm right away
+    server.route_video(car_id, ip)
 
     # Send Confirmation to App
     logging.debug("Car registration successful")
-    ackJSON = {
-      "type": MsgType.ACK,
-      "car_id": car_id
-    }
-    _send_JSON(server, source, ackJSON)
+    server.send(codec.ack(car_id=car_id), source)
 
 def handle_connect_car(server, body, source):
-    logging.debug('CONNECT CAR')
-
-    if 'car_id' not in body:
-        logging.debug('missing field: car_id')
-        server.send(Error.json(Error.BAD_REQ, 'missing field: car_id'), source)
-        return
 
     car_id = body['car_id']
+    binary = body.get('binary', False)
 
-    if not isinstance(car_id, int):
-        msg = '"car_id" must be an integer'
+    request_ip = source[0]
+
+    car = server.get_registry().get(car_id)
+    if car is None:
+        msg = 'car does not exist'
+        logging.debug(msg)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
+        return
+    elif car.ip != request_ip:
+        msg = 'IP address does not match car ID'
         logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
         return
 
-    with server.get_db() as (dbconnect, cursor):
-        cursor.execute('select * from cars where (id=?)', (car_id,))
-        entry = cursor.fetchone()
+    # Connecting counts as the car's first heartbeat; it stays on for as long
+    # as it keeps sending them
+    server.get_presence().beat(car)
+    server.set_binary((request_ip, CAR_PORT), binary)
+    server.send(codec.ACK, source)
 
-        request_ip = source[0]
-        if entry is None:
-            msg = 'car does not exist'
-            logging.debug(msg)
-            server.send(Error.json(Error.BAD_REQ, msg), source)
-        elif entry[2] != request_ip:
-            msg = 'IP address does not match car ID'
-            logging.debug(msg)
-            server.send(Error.json(Error.BAD_REQ, msg), source)
-        else:
-            cursor.execute('update cars set isOn=1 where (id=?)', (car_id,))
-            dbconnect.commit()
-            data = '{"type": %d}' % MsgType.ACK
-            server.send(data.encode('utf-8'), source)
+def handle_heartbeat(server, body, source):
+    """
+    Records a heartbeat from a car, which keeps it on. Nothing is sent back
+    unless the heartbeat is rejected.
+    """
+
+    car = server.get_registry().get(body['car_id'])
+    if car is None:
+        msg = 'car does not exist'
+        logging.debug(msg)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
+        return
+    elif car.ip != source[0]:
+        msg = 'IP address does not match car ID'
+        logging.debug(msg)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
+        return
+
+    server.get_presence().beat(car)
 
 def handle_login(server, body, source):
-    logging.debug('LOGIN')
     '''
     1. Compare salted-and-hashed passwords
     2. If success: get car list from database and send to the app
        If failure: send failed login message
     '''
 
+    # Resume a session from its token without hashing the password again
+    if 'token' in body and 'password' not in body:
+        user_id = _get_user_id(server, body, source)
+        if user_id is not None:
+            logging.debug("Session resumed")
+            data = codec.ack(user_id=user_id, token=body['token'])
+            server.send(data, source)
+        return
+
     # Check data is valid. if not, send an error packet
     if 'name' not in body or 'password' not in body:
         message = 'missing field: "name", "password" required'
         logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
+        server.send(codec.error(Error.BAD_REQ, message), source)
         return
 
     # Get JSON data
     name = body['name']
     password = body['password']
 
-    if not isinstance(name, str) or not isinstance(password, str):
-        msg = '"name" and "password" must be strings'
-        logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
-        return
-
     # Get user from db. Send an error if user doesn't exist.
-    with server.get_db() as (dbconnect, cursor):
-        cursor.execute("select * from users where name=(?)", [name])
+    with server.get_db().read() as (_, cursor):
+        cursor.execute(schema.USER_BY_NAME, (name,))
         entry = cursor.fetchone()
 
     if entry is None:
         message = "User does not exist"
         logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
+        server.send(codec.error(Error.BAD_REQ, message), source)
         return
 
     # Get salt as bytes
-    salt =  entry[2]
+    salt =  entry[1]
     b_salt = b64decode(salt.encode('utf-8'))
     # Get salted password string from database
-    salted_password = entry[3]
+    salted_password = entry[2]
     # Salt the login password
-    new_password = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), b_salt, 100000)
+    new_password = _hash_password(server, password, b_salt, source)
+    if new_password is None:
+        return
     str_new_password = b64encode(new_password).decode('utf-8')
 
     # Compare two passwords as strings
@@ -286,142 +296,152 @@ def handle_login(server, body, source):
         # Send Confirmation to App
         logging.debug("User login successful")
         user_id = entry[0]
-        ackJSON = {
-          "type": MsgType.ACK,
-          "user_id": user_id
-        }
-        _send_JSON(server, source, ackJSON)
+        token = server.get_sessions().issue(user_id)
+        server.send(codec.ack(user_id=user_id, token=token), source)
     else:
         message = "Password is incorrect"
         logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
+        server.send(codec.error(Error.BAD_REQ, message), source)
 
 def handle_link(server, body, source):
-    logging.debug('LINK')
-
-    if 'car_id' not in body or 'user_id' not in body:
-        msg = 'missing field: "car_id", "user_id" required'
-        logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
-        return
 
     car_id = body['car_id']
-    user_id = body['user_id']
+    binary = body.get('binary', False)
 
-    if not isinstance(car_id, int) or not isinstance(user_id, int):
-        msg = '"car_id" and "user_id" must be integers'
-        logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+    user_id = _get_user_id(server, body, source)
+    if user_id is None:
         return
 
-    with server.get_db() as (_, cursor):
-        cursor.execute('select * from cars where id=? and userID=?', (car_id, user_id))
-        entry = cursor.fetchone()
-
-    if entry == None:
+    car = server.get_registry().get(car_id)
+    if car is None or car.user_id != user_id:
         msg = 'car does not exist'
         logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
-    elif not entry[3]: # Check the isOn column
+        server.send(codec.error(Error.BAD_REQ, msg), source)
+    elif not car.is_on:
         msg = 'car is not available'
         logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
     else:
-        server.add_route(source, (entry[2], CAR_PORT))
-        data = '{"type": %d}' % MsgType.ACK
-        server.send(data.encode('utf-8'), source)
+        server.add_route(source, (car.ip, CAR_PORT))
+        server.set_binary(source, binary)
+        server.send(codec.ACK, source)
 
-def handle_set_led(server, body, source):
+def handle_unlink(server, body, source):
     """
-    Sends SET_LED message to the destination that corresponds with the source
-    address in the cache.
+    Removes the route from the source address, so that it no longer relays
+    messages to or from its car.
     """
-    logging.debug('SET_LED')
 
-    if 'state' not in body:
-        msg = 'missing field: "state" required'
+    if not server.remove_route(source):
+        msg = 'not linked'
         logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
         return
 
-    state = body['state']
+    server.send(codec.ACK, source)
 
-    if not isinstance(state, int) or state < 0 or state > 2:
-        msg = 'state must be an int in range [0,2]'
-        logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
-        return
+def handle_set_led(server, body, source):
+    """
+    Sends SET_LED message to the destination that corresponds with the source
+    address in the cache.
+    """
 
     car_addr = server.get_destination(source)
     if car_addr == None:
         msg = 'invalid destination'
         logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
         return
 
-    server.send(json.dumps(body).encode('utf-8'), car_addr)
+    _relay(server, car_addr, body)
 
 def handle_ack(server, body, source):
     """
     Sends ACK message to the destination that corresponds with the source
     address in the cache.
     """
-    logging.debug('ACK')
 
     dest = server.get_destination(source)
     if dest == None:
         msg = 'invalid destination'
         logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+        server.send(codec.error(Error.BAD_REQ, msg), source)
         return
 
-    server.send(json.dumps(body).encode('utf-8'), dest)
+    _relay(server, dest, body)
+
+def _car_json(car):
+    return {"id": car.id, "name": car.name, "is_on": car.is_on}
+
+def _stream_cars(server, cars, source):
+    # Send the cars in ACKs of at most STREAM_CHUNK bytes, numbered by "seq"
+    # from 0, with "done" set on the last one. After STREAM_CHUNKS chunks the
+    # stream stops, and the last one has the ID to stream on from in "next".
+    # Each car is only encoded once, and only one chunk's worth is held at a
+    # time.
+    seq = 0
+    chunk = []
+    size = _CHUNK_OVERHEAD
+    last_id = None
+    for car in cars:
+        data = codec.dumps(_car_json(car))
+        if chunk and size + len(data) > STREAM_CHUNK:
+            if seq == STREAM_CHUNKS - 1:
+                server.send(codec.ack(seq=seq, done=True, next=last_id,
+                                      cars=codec.array(chunk)), source)
+                return
+            server.send(codec.ack(seq=seq, done=False,
+                                  cars=codec.array(chunk)), source)
+            seq += 1
+            chunk = []
+            size = _CHUNK_OVERHEAD
+        chunk.append(data)
+        size += len(data) + 2
+        last_id = car.id
+    server.send(codec.ack(seq=seq, done=True, cars=codec.array(chunk)),
+                source)
 
 def handle_get_cars(server, body, source):
-    logging.debug('GET CARS')
     '''
-    1. Get list of cars from databse
-    2. If successful: send list of cars to app
+    1. Get a page of the user's cars, after the car with ID "after_id", from
+       the car registry
+    2. If successful: send the page to the app, with the ID to ask for the
+       next page after in "next" if there are more cars. If "stream" is
+       true, send the cars in up to STREAM_CHUNKS numbered chunks instead,
+       with "next" in the last one if there are more cars.
     '''
 
     # Check data is valid
-    if 'user_id' not in body:
-        message = 'missing field: "user_id" required'
-        logging.debug(message)
-        server.send(Error.json(Error.BAD_REQ, message), source)
+    user_id = _get_user_id(server, body, source)
+    if user_id is None:
         return
 
-    # Get JSON data
-    user_id = body["user_id"]
+    registry = server.get_registry()
+    after_id = body.get('after_id', 0)
+    if body.get('stream', False):
+        _stream_cars(server, registry.iter_user_cars(user_id, after_id),
+                     source)
+        return
+
+    # Get one car more than asked for, to know whether there is a next page
+    limit = body.get('limit', CARS_PAGE)
+    cars = registry.get_user_cars_page(user_id, after_id, limit + 1)
+    page = {"cars": [_car_json(car) for car in cars[:limit]]}
+    if len(cars) > limit:
+        page["next"] = cars[limit - 1].id
+    server.send(codec.ack(**page), source)
 
-    if not isinstance(user_id, int):
-        msg = '"user_id" must be an integer'
+def handle_stats(server, body, source):
+    """
+    Sends a snapshot of the server's metrics. Only allowed from the same host,
+    since the metrics describe every user's traffic.
+    """
+
+    if not ipaddress.ip_address(source[0]).is_loopback:
+        msg = 'stats are only available from localhost'
         logging.debug(msg)
-        server.send(Error.json(Error.BAD_REQ, msg), source)
+        server.send(codec.error(Error.UNAUTHORIZED, msg), source)
         return
 
-    # Create cars list
-    cars = []
-    with server.get_db() as (_, cursor):
-        cursor.execute("select * from cars where userID=(?)", [user_id])
-        entry = cursor.fetchall()
-        # Return error if no cars are under userID
-        if entry is None:
-            message = "User has no registered cars"
-            logging.debug(message)
-            server.send(Error.json(Error.BAD_REQ, message), source)
-            return
-        else:
-            # Add car_name and car_id to list for each car returned
-            for row in entry:
-                cars.append({
-                    "id": row[0],
-                    "name": row[1],
-                    "is_on": bool(row[3])
-                })
-
-            carsJSON = {
-              "type": MsgType.ACK,
-              "cars": cars
-             }
-            _send_JSON(server,source,carsJSON)
+    stats = server.get_metrics().snapshot()
+    server.send(codec.ack(stats=stats), source)
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+class Busy(Exception):
+    """
+    Raised when a password cannot be hashed right now because the hashing
+    pool, or the source's share of it, is already fully booked, or because
+    the pool broke while hashing it.
+    """
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+def pool_size(cpu_share):
+    """
+    Get the number of hashing processes that use the given fraction of the
+    host's CPUs, and at least one.
+    """
+
+    return max(1, int((os.cpu_count() or 1) * cpu_share))
+
+class PasswordHasher(object):
+    """
+    Runs PBKDF2 password hashing in a dedicated pool of processes, so that a
+    burst of logins or registrations cannot starve the threads relaying
+    control messages. The pool size caps the share of the host's CPUs spent
+    on hashing; server processes that share a port also share that cap
+    through a semaphore of the same size. Admission is bounded both overall
+    and per source IP address; a request over either limit fails immediately
+    with Busy rather than waiting in an unbounded queue.
+
+    If a pool process dies, the pool is replaced and the requests it was
+    running fail with Busy.
+    """
+
+    ITERATIONS = 100000
+
+    def __init__(self, cpu_share=0.25, queue_size=8, per_source=2,
+            iterations=ITERATIONS, slots=None):
+        """
+        Create a hasher using the given fraction of the host's CPUs (at least
+        one process), that admits at most queue_size requests beyond the ones
+        being hashed, and at most per_source requests from one IP address.
+        If slots is given, a semaphore from create_slots shared with the
+        hashers of other server processes, every hash also holds one of its
+        slots, so that together they use no more than the same fraction.
+        """
+
+        self.processes = pool_size(cpu_share)
+        self.limit = self.processes + queue_size
+        self.per_source = per_source
+        self.iterations = iterations
+        self.slots = slots
+        self.pool = self._create_pool()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.pending = 0
+        self.rejected = 0
+        self.restarts = 0
+
+    @staticmethod
+    def create_slots(cpu_share=0.25):
+        """
+        Create the semaphore that the hashers of several server processes
+        share to keep their hashing within the given fraction of the host's
+        CPUs between them. It must be created before the processes are.
+        """
+
+        return multiprocessing.BoundedSemaphore(pool_size(cpu_share))
+
+    def _create_pool(self):
+        # forkserver children do not inherit locks held by the server's
+        # other threads at the time of the fork. They ignore SIGINT and exit
+        # when the server shuts the pool down.
+        return ProcessPoolExecutor(
+            self.processes,
+            mp_context=multiprocessing.get_context('forkserver'),
+            initializer=signal.signal,
+            initargs=(signal.SIGINT, signal.SIG_IGN)
+        )
+
+    def hash(self, password, salt, source):
+        """
+        Hash a password string with the given salt bytes on behalf of the
+        given source address, blocking until the hash is ready. Raises Busy
+        if the request is not admitted.
+        """
+
+        ip = source[0]
+        self._admit(ip)
+        try:
+            if self.slots is None:
+                return self._run(password, salt)
+            # Held by this process rather than the pool's, so that a pool
+            # process that dies cannot take a slot with it
+            with self.slots:
+                return self._run(password, salt)
+        finally:
+            self._release(ip)
+
+    def _run(self, password, salt):
+        pool = self.pool
+        try:
+            future = pool.submit(
+                _pbkdf2, password.encode('utf-8'), salt, self.iterations)
+            return future.result()
+        except BrokenProcessPool:
+            self._replace_pool(pool)
+            raise Busy()
+
+    def _replace_pool(self, pool):
+        # A broken pool refuses all further work, so the first request to
+        # find it broken starts a new one
+        with self.lock:
+            if self.pool is not pool:
+                return
+            logging.error('A password hashing process died, restarting '
+                          'the pool')
+            self.pool = self._create_pool()
+            self.restarts += 1
+        pool.shutdown(wait=False)
+
+    def _admit(self, ip):
+        with self.lock:
+            if self.pending >= self.limit or \
+                    self.active.get(ip, 0) >= self.per_source:
+                self.rejected += 1
+                raise Busy()
+            self.pending += 1
+            self.active[ip] = self.active.get(ip, 0) + 1
+
+    def _release(self, ip):
+        with self.lock:
+            self.pending -= 1
+            if self.active[ip] == 1:
+                del self.active[ip]
+            else:
+                self.active[ip] -= 1
+
+    def stats(self):
+        """
+        Get a snapshot of the hasher's load and counters.
+        """
+
+        with self.lock:
+            return {
+                'processes': self.processes,
+                'pending': self.pending,
+                'rejected': self.rejected,
+                'restarts': self.restarts,
+            }
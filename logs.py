@@ -0,0 +1,136 @@
+import itertools
+import logging
+import logging.handlers
+import queue
+
+from utils import MsgType
+
+FORMAT = '%(asctime)s, msg: %(message)s, level: %(levelname)s%(fields)s'
+DATE_FORMAT = '%m/%d/%Y %H:%M:%S'
+
+QUEUE_SIZE = 10000
+
+# Records of these message types are kept one in every so many by default
+SAMPLE_RATES = {MsgType.ACK: 100, MsgType.MOVE: 100, MsgType.SET_LED: 100}
+
+# The structured fields a record may carry, given through the extra
+# argument of the logging calls
+FIELDS = ('msg_type', 'source', 'latency', 'sampled')
+
+def fields(msg_type=None, source=None, latency=None):
+    """
+    Get the extra argument of a logging call that gives a record the
+    structured fields of a message: its type, its source address and the
+    seconds taken to handle it.
+    """
+
+    return {'msg_type': msg_type, 'source': source, 'latency': latency}
+
+class StructuredFormatter(logging.Formatter):
+    """
+    A formatter that appends a record's structured fields to it as key=value
+    pairs, after the message.
+    """
+
+    def format(self, record):
+        pairs = []
+        for name in FIELDS:
+            value = getattr(record, name, None)
+            if value is None:
+                continue
+            if name == 'msg_type':
+                try:
+                    value = MsgType(value).name
+                except ValueError:
+                    pass
+            elif name == 'source':
+                value = '%s:%s' % value
+            elif name == 'latency':
+                value = '%.3fms' % (value * 1e3)
+            pairs.append('%s=%s' % (name, value))
+        record.fields = (', ' + ' '.join(pairs)) if pairs else ''
+        return super().format(record)
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only one in every so many debug records of high-rate message
+    types, as given by a dict of sample rates by message type, and marks the
+    records kept with their rate so that counts can be scaled back up.
+    Records above debug level or without a message type are always kept.
+    """
+
+    def __init__(self, rates=SAMPLE_RATES):
+        super().__init__()
+        self.rates = dict(rates)
+        self.counters = {msg_type: itertools.count()
+                         for msg_type in self.rates}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        msg_type = getattr(record, 'msg_type', None)
+        rate = self.rates.get(msg_type)
+        if rate is None or rate <= 1:
+            return True
+        if next(self.counters[msg_type]) % rate:
+            return False
+        record.sampled = rate
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A queue handler that only merges a record's arguments into its message
+    before queueing it, leaving the rest of the formatting to the writer
+    thread, and drops records rather than block when the queue is full. The
+    number dropped is logged once there is room again.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The writer runs in the same process, so the record can be passed
+        # as is once its arguments, which may change later, are merged
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                dropped = logging.makeLogRecord({
+                    'name': 'logs', 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': 'Dropped %d log records' % self.dropped,
+                })
+                self.queue.put_nowait(dropped)
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure(filename, level=logging.INFO, rates=SAMPLE_RATES,
+        queue_size=QUEUE_SIZE):
+    """
+    Send the records of the root logger at the given level or above to a
+    queue, sampling high-rate message types at the given rates, and start a
+    background thread that writes them to the given file. Logging calls
+    then only pay for a level check and, if enabled, putting a record on the
+    queue. Returns the logging.handlers.QueueListener running the thread,
+    which should be stopped to flush the queue before exiting.
+    """
+
+    records = queue.Queue(queue_size)
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(StructuredFormatter(FORMAT, DATE_FORMAT))
+    listener = logging.handlers.QueueListener(records, file_handler)
+
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(SamplingFilter(rates))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    listener.start()
+    return listener
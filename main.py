@@ -1,33 +1,265 @@
 import logging
 import argparse
+import multiprocessing
+import codec
+import dispatcher
 import handlers
+import logs
 
+from aioserver import AsyncServer
+from cluster import RouteSync
+from dispatcher import Overload, Scheduling
+from hashing import PasswordHasher
+from mjpeg import MJPEGRelay
+from pacing import Pacer
+from presence import Presence
+from routes import RouteTable
 from server import Server
+from sessions import SessionStore
 from utils import MsgType
+from video import VideoRouter
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='RC Camera Car Server.')
-    parser.add_argument('port', type=int, help='port to listen on')
+HOST = ''
+DB_NAME = 'RCCar.db'
+
+def video_path(value):
+    """
+    Check a --video-path argument, which must be an absolute HTTP path.
+    """
+
+    if not value.startswith('/') or any(c.isspace() for c in value) or \
+            not value.isascii():
+        raise argparse.ArgumentTypeError('invalid path: %r' % value)
+    return value
+
+def priority(value):
+    """
+    Parse a TYPE=CLASS message priority argument into a message type and the
+    name of the class it is moved to.
+    """
+
+    msg_type, _, name = value.partition('=')
+    try:
+        return MsgType[msg_type.upper()], name
+    except KeyError:
+        raise argparse.ArgumentTypeError('unknown message type: %s' % msg_type)
+
+def sample_rate(value):
+    """
+    Parse a TYPE=N log sampling argument into a message type and the number
+    of its records out of which one is kept.
+    """
+
+    msg_type, _, rate = value.partition('=')
+    try:
+        return MsgType[msg_type.upper()], int(rate)
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError('invalid sample rate: %s' % value)
+
+def run_server(args, route_sync=None, hash_slots=None):
+    """
+    Create a server with every handler registered and run it until the
+    process is interrupted. The server processes sharing a port share the
+    given hashing slots.
+    """
+
+    rates = dict(logs.SAMPLE_RATES)
+    rates.update(args.log_sample)
+    listener = logs.configure('server.log', args.log_level, rates)
+    codec.use(args.json)
+
+    hasher = PasswordHasher(args.hash_cpu_share, args.hash_queue_size,
+                            args.hash_per_source, slots=hash_slots)
+    # Every process shares one haproxy, so only the first one updates it
+    video = None
+    if not args.no_video and (route_sync is None or route_sync.index == 0):
+        if args.video_relay:
+            video = MJPEGRelay(HOST, args.video_port,
+                               car_path=args.video_path)
+        else:
+            video = VideoRouter(args.haproxy_map,
+                                debounce=args.video_debounce)
+    if args.asyncio:
+        server = AsyncServer(HOST, args.port, DB_NAME, args.workers,
+                             route_sync, max_datagram=args.max_datagram,
+                             hasher=hasher, session_ttl=args.session_ttl,
+                             video=video, route_ttl=args.route_ttl,
+                             route_capacity=args.route_capacity,
+                             command_rate=args.command_rate,
+                             presence_ttl=args.presence_ttl)
+    else:
+        server = Server(HOST, args.port, DB_NAME, args.workers,
+                        args.queue_size, args.overload, route_sync,
+                        max_datagram=args.max_datagram,
+                        batch_size=args.batch_size, hasher=hasher,
+                        session_ttl=args.session_ttl, video=video,
+                        route_ttl=args.route_ttl,
+                        route_capacity=args.route_capacity,
+                        command_rate=args.command_rate,
+                        presence_ttl=args.presence_ttl,
+                        classes=args.classes, scheduling=args.scheduling)
+
+    # Cars left on by the last run go off unless they beat again, which one
+    # process is enough to check
+    if route_sync is None or route_sync.index == 0:
+        server.get_presence().adopt(server.get_registry().cars.values())
+
+    if video is not None:
+        cars = server.get_registry().cars.values()
+        try:
+            video.load((car.id, car.ip) for car in cars)
+        except OSError as e:
+            logging.error('Failed to write haproxy map: %s', e)
 
-    args = parser.parse_args()
-    PORT = args.port
-    HOST = ''
-    DB_NAME = 'RCCar.db'
-
-    logging.basicConfig(
-        filename='server.log',
-        level=logging.DEBUG,
-        format='%(asctime)s, msg: %(message)s, level: %(levelname)s',
-        datefmt='%m/%d/%Y %H:%M:%S'
-    )
-
-    server = Server(HOST, PORT, DB_NAME)
     server.add_handler(MsgType.ACK, handlers.handle_ack)
     server.add_handler(MsgType.REG_USER, handlers.handle_register_user)
     server.add_handler(MsgType.REG_CAR, handlers.handle_register_car)
     server.add_handler(MsgType.LOGIN, handlers.handle_login)
     server.add_handler(MsgType.LINK, handlers.handle_link)
+    server.add_handler(MsgType.UNLINK, handlers.handle_unlink)
     server.add_handler(MsgType.CONN_CAR, handlers.handle_connect_car)
     server.add_handler(MsgType.MOVE, handlers.handle_movement)
     server.add_handler(MsgType.SET_LED, handlers.handle_set_led)
     server.add_handler(MsgType.GET_CARS, handlers.handle_get_cars)
+    server.add_handler(MsgType.STATS, handlers.handle_stats)
+    server.add_handler(MsgType.HEARTBEAT, handlers.handle_heartbeat)
+
+    if args.metrics_file is not None:
+        path = args.metrics_file
+        if route_sync is not None:
+            # Every process has its own metrics
+            path = '%s.%d' % (path, route_sync.index)
+        server.get_metrics().start_dump(path, args.metrics_interval)
+
+    # Executors refuse new work once the main thread has exited, so it has to
+    # stay alive for as long as the server runs
+    try:
+        server.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RC Camera Car Server.')
+    parser.add_argument('port', type=int, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of handler worker threads')
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help='maximum queued messages per message class')
+    parser.add_argument('--overload', type=Overload,
+                        default=Overload.DROP_OLDEST,
+                        choices=list(Overload),
+                        help='policy when a queue is full: '
+                             'drop-oldest, drop-newest or reject')
+    parser.add_argument('--scheduling', type=Scheduling,
+                        choices=list(Scheduling),
+                        help='how workers share themselves between message '
+                             'classes: strict priority or weighted (the '
+                             'default); not with --asyncio')
+    parser.add_argument('--priority', type=priority, action='append',
+                        default=[], metavar='TYPE=CLASS',
+                        help='move a message type to the control, session, '
+                             'presence or auth class; may be repeated; not '
+                             'with --asyncio')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='run the server on an asyncio event loop')
+    parser.add_argument('--max-datagram', type=int,
+                        default=Server.MAX_DATAGRAM,
+                        help='largest accepted datagram in bytes')
+    parser.add_argument('--batch-size', type=int, default=Server.BATCH_SIZE,
+                        help='most datagrams received per wakeup')
+    parser.add_argument('--hash-cpu-share', type=float, default=0.25,
+                        help='fraction of CPUs used for password hashing, '
+                             'shared by all server processes')
+    parser.add_argument('--hash-queue-size', type=int, default=8,
+                        help='most password hashes waiting for a process')
+    parser.add_argument('--hash-per-source', type=int, default=2,
+                        help='most concurrent password hashes per IP address')
+    parser.add_argument('--session-ttl', type=int, default=SessionStore.TTL,
+                        help='seconds before a session token expires')
+    parser.add_argument('--route-ttl', type=float, default=RouteTable.TTL,
+                        help='seconds before an idle route expires')
+    parser.add_argument('--route-capacity', type=int,
+                        default=RouteTable.CAPACITY,
+                        help='most routes kept before the least recently '
+                             'used is evicted')
+    parser.add_argument('--command-rate', type=float, default=Pacer.RATE,
+                        help='most MOVE and SET_LED messages sent per second '
+                             'to each car, or 0 for no limit')
+    parser.add_argument('--presence-ttl', type=float, default=Presence.TTL,
+                        help='seconds without a heartbeat before a car is '
+                             'reported off')
+    parser.add_argument('--haproxy-map', default=VideoRouter.MAP_FILE,
+                        help='haproxy map file of car IDs to IP addresses')
+    parser.add_argument('--video-debounce', type=float, default=0.05,
+                        help='seconds to wait for more cars before updating '
+                             'haproxy')
+    parser.add_argument('--no-video', action='store_true',
+                        help='do not route video streams through haproxy')
+    parser.add_argument('--video-relay', action='store_true',
+                        help='relay video streams from the server itself, '
+                             'with one connection per car, instead of '
+                             'through haproxy')
+    parser.add_argument('--video-port', type=int, default=MJPEGRelay.PORT,
+                        help='port the video relay listens on')
+    parser.add_argument('--video-path', type=video_path,
+                        default=MJPEGRelay.CAR_PATH,
+                        help='path, and query string if any, of the MJPEG '
+                             'stream on each car, read by the video relay')
+    parser.add_argument('--metrics-file',
+                        help='file to write metrics to in the Prometheus '
+                             'text format')
+    parser.add_argument('--metrics-interval', type=float, default=10,
+                        help='seconds between metrics file updates')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        type=str.upper,
+                        help='lowest level of records written to server.log')
+    parser.add_argument('--log-sample', type=sample_rate, action='append',
+                        default=[], metavar='TYPE=N',
+                        help='keep one in N debug records of a message type, '
+                             'by default 100 for ACK, MOVE and SET_LED; may '
+                             'be repeated')
+    parser.add_argument('--json', default='auto', choices=codec.BACKENDS,
+                        help='JSON library used to encode and decode '
+                             'messages; auto uses orjson if it is installed')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of server processes sharing the port '
+                             'with SO_REUSEPORT')
+
+    args = parser.parse_args()
+    # The asyncio engine has no dispatcher, so nothing to schedule
+    if args.asyncio and (args.priority or args.scheduling is not None):
+        parser.error('--priority and --scheduling cannot be used with '
+                     '--asyncio')
+    if args.scheduling is None:
+        args.scheduling = Scheduling.WEIGHTED
+    args.classes = dispatcher.CLASSES
+    for msg_type, name in args.priority:
+        try:
+            args.classes = dispatcher.reassign(args.classes, msg_type, name)
+        except ValueError as e:
+            parser.error(str(e))
+    try:
+        codec.use(args.json)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.processes > 1:
+        inboxes = RouteSync.create_inboxes(args.processes)
+        # The CPU share for hashing is for every process together
+        hash_slots = PasswordHasher.create_slots(args.hash_cpu_share)
+        processes = [
+            multiprocessing.Process(
+                target=run_server,
+                args=(args, RouteSync(i, inboxes), hash_slots)
+            )
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        run_server(args)
@@ -0,0 +1,375 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import wire
+
+from utils import MsgType, Error
+
+# Histogram buckets have 2 ** (SUB_BUCKET_BITS - 1) linear sub-buckets per
+# power of two, so any recorded value is within 1.6% of its bucket's bounds
+SUB_BUCKET_BITS = 7
+
+# Histograms record whole microseconds
+UNIT = 1e-6
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# Every counter and histogram, with the name of its label, the enum its label
+# values belong to and a description
+COUNTERS = {
+    'packets_in': ('type', MsgType, 'Datagrams received, by message type'),
+    'packets_out': ('type', MsgType, 'Datagrams sent, by message type'),
+    'errors': ('error', Error, 'Error replies sent, by error code'),
+}
+
+HISTOGRAMS = {
+    'handler_seconds': ('type', MsgType,
+                        'Time from receiving a message to its handler or '
+                        'relay returning, by message type'),
+    'db_lock_wait_seconds': (None, None,
+                             'Time spent waiting for the database writer'),
+    'db_lock_hold_seconds': (None, None,
+                             'Time the database writer was held for'),
+}
+
+# The start of a JSON message sent by the server, with the error code if it
+# is an error
+_SENT_PATTERN = re.compile(
+    rb'\s*\{\s*"type"\s*:\s*(\d+)(?:\s*,\s*"error_type"\s*:\s*(\d+))?')
+
+def _bucket(value):
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    if shift <= 0:
+        return value
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+def _highest(bucket):
+    # The highest value that falls in the given bucket
+    if bucket < 1 << SUB_BUCKET_BITS:
+        return bucket
+    shift = (bucket >> (SUB_BUCKET_BITS - 1)) - 1
+    mantissa = bucket - (shift << (SUB_BUCKET_BITS - 1))
+    return ((mantissa + 1) << shift) - 1
+
+def _label(enum, value):
+    # Labels are recorded raw, which for sent messages is the bytes of the
+    # number, and only named when read
+    if enum is None or value is None:
+        return value
+    try:
+        return enum(int(value)).name
+    except ValueError:
+        return value if isinstance(value, str) else str(int(value))
+
+class Histogram(object):
+    """
+    A log-linear histogram of durations in the style of HdrHistogram, with a
+    fixed relative precision over an unbounded range and a constant cost per
+    recorded value. Histograms are not thread-safe; Metrics keeps one per
+    thread and merges them when read.
+    """
+
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """
+        Record a duration in seconds.
+        """
+
+        bucket = _bucket(int(seconds / UNIT))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """
+        Add the values recorded by another histogram to this one.
+        """
+
+        # Copying first keeps the other histogram's owner free to record
+        for bucket, count in dict(other.buckets).items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        Get the duration in seconds that at least a fraction q of the
+        recorded values are no greater than, to the histogram's precision.
+        """
+
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        return min(_highest(bucket) * UNIT, self.max)
+
+    def summary(self):
+        """
+        Get the count, sum, maximum and quantiles of the recorded values.
+        """
+
+        summary = {'count': self.count, 'sum': self.sum, 'max': self.max}
+        for q in QUANTILES:
+            summary['p%g' % (q * 100)] = self.quantile(q)
+        return summary
+
+class _Shard(object):
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+class Metrics(object):
+    """
+    The server's counters, latency histograms and gauges. Every thread
+    records into its own shard without taking a lock, and the shards are
+    merged when the metrics are read, so recording stays cheap enough for
+    every packet. Gauges are functions called when the metrics are read.
+
+    The metrics can be read as a snapshot of plain values, for the admin
+    STATS message, or rendered in the Prometheus text format, which can also
+    be written to a file periodically for a node exporter to pick up.
+    """
+
+    PREFIX = 'rccar_'
+
+    def __init__(self):
+        """
+        Create a set of metrics with nothing recorded.
+        """
+
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._gauges = {}
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def count(self, name, label=None, value=1):
+        """
+        Add a value to the counter with the given name and label.
+        """
+
+        counters = self._shard().counters
+        key = (name, label)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, label, seconds):
+        """
+        Record a duration in the histogram with the given name and label.
+        """
+
+        histograms = self._shard().histograms
+        key = (name, label)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.record(seconds)
+
+    def sent(self, data):
+        """
+        Count a datagram sent by the server by its message type, and by its
+        error code if it is an error.
+        """
+
+        if wire.is_binary(data):
+            msg_type = data[1] if len(data) > 1 else 'invalid'
+        else:
+            match = _SENT_PATTERN.match(data)
+            if match is None:
+                self.count('packets_out', 'invalid')
+                return
+            msg_type, error = match.groups()
+            if error is not None:
+                self.count('errors', error)
+        self.count('packets_out', msg_type)
+
+    def gauge(self, name, function, label=None, description=''):
+        """
+        Add a gauge whose value is got by calling the given function when the
+        metrics are read. If a label name is given, the function returns a
+        dict of values by label value instead.
+        """
+
+        self._gauges[name] = (function, label, description)
+
+    def _merged(self):
+        # Merge the shards into counters and histograms keyed by name and
+        # label name
+        with self._lock:
+            shards = list(self._shards)
+        counters = {}
+        histograms = {}
+        for shard in shards:
+            # Copying a dict is atomic, so its owner can go on recording
+            for (name, label), value in dict(shard.counters).items():
+                _, enum, _ = COUNTERS.get(name, (None, None, None))
+                key = (name, _label(enum, label))
+                counters[key] = counters.get(key, 0) + value
+            for (name, label), histogram in dict(shard.histograms).items():
+                _, enum, _ = HISTOGRAMS.get(name, (None, None, None))
+                key = (name, _label(enum, label))
+                if key not in histograms:
+                    histograms[key] = Histogram()
+                histograms[key].merge(histogram)
+        return counters, histograms
+
+    def _gauge_values(self):
+        values = {}
+        for name, (function, label, _) in self._gauges.items():
+            try:
+                values[name] = function()
+            except Exception:
+                logging.exception('Gauge %s failed', name)
+        return values
+
+    def snapshot(self):
+        """
+        Get the current value of every metric as a dict of plain values that
+        can be encoded as JSON. Labelled metrics are dicts by label value.
+        """
+
+        counters, histograms = self._merged()
+        snapshot = {'counters': {}, 'histograms': {},
+                    'gauges': self._gauge_values()}
+        for (name, label), value in counters.items():
+            if label is None:
+                snapshot['counters'][name] = value
+            else:
+                snapshot['counters'].setdefault(name, {})[label] = value
+        for (name, label), histogram in histograms.items():
+            if label is None:
+                snapshot['histograms'][name] = histogram.summary()
+            else:
+                values = snapshot['histograms'].setdefault(name, {})
+                values[label] = histogram.summary()
+        return snapshot
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+        Histograms are rendered as summaries with precomputed quantiles.
+        """
+
+        counters, histograms = self._merged()
+        lines = []
+
+        def header(name, kind, description):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        def labels(*pairs):
+            pairs = [p for p in pairs if p[0] is not None]
+            if not pairs:
+                return ''
+            return '{%s}' % ','.join('%s="%s"' % p for p in pairs)
+
+        for name, (label_name, _, description) in sorted(COUNTERS.items()):
+            full = self.PREFIX + name + '_total'
+            header(full, 'counter', description)
+            for (key, label), value in sorted(counters.items(), key=str):
+                if key == name:
+                    lines.append('%s%s %d' % (
+                        full, labels((label_name, label)), value))
+
+        for name, (label_name, _, description) in sorted(HISTOGRAMS.items()):
+            full = self.PREFIX + name
+            header(full, 'summary', description)
+            for (key, label), histogram in sorted(histograms.items(),
+                                                  key=str):
+                if key != name:
+                    continue
+                pair = (label_name, label)
+                for q in QUANTILES:
+                    lines.append('%s%s %.6f' % (
+                        full, labels(pair, ('quantile', '%g' % q)),
+                        histogram.quantile(q)))
+                lines.append('%s_sum%s %.6f' % (full, labels(pair),
+                                                histogram.sum))
+                lines.append('%s_count%s %d' % (full, labels(pair),
+                                                histogram.count))
+
+        values = self._gauge_values()
+        for name, (_, label_name, description) in sorted(self._gauges.items()):
+            if name not in values:
+                continue
+            full = self.PREFIX + name
+            header(full, 'gauge', description)
+            value = values[name]
+            if label_name is None:
+                lines.append('%s %s' % (full, value))
+            else:
+                for label, v in sorted(value.items()):
+                    lines.append('%s%s %s' % (
+                        full, labels((label_name, label)), v))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """
+        Write the metrics in the Prometheus text format to the given file,
+        replacing it atomically so that readers never see a partial dump.
+        """
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def start_dump(self, path, interval):
+        """
+        Start a thread that dumps the metrics to the given file every
+        interval seconds.
+        """
+
+        dumper = threading.Thread(
+            target=self._dump_forever,
+            args=(path, interval),
+            name='metrics-dump',
+            daemon=True
+        )
+        dumper.start()
+
+    def _dump_forever(self, path, interval):
+        """
+        Start an infinite loop that dumps the metrics to a file.
+        """
+
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump(path)
+            except OSError as e:
+                logging.error('Failed to write metrics to %s: %s', path, e)
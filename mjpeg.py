@@ -0,0 +1,412 @@
+import asyncio
+import logging
+import re
+import threading
+
+# The boundary between the frames sent to viewers
+BOUNDARY = b'frame'
+
+_STREAM_HEADER = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: multipart/x-mixed-replace; boundary=' + BOUNDARY + b'\r\n'
+    b'Cache-Control: no-cache, private\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+)
+
+_REQUEST_LINE = re.compile(rb'(\S+) /(\d+)(/[^ ?]*)?(?:\?\S*)? HTTP/1\.[01]')
+_BOUNDARY_PARAM = re.compile(rb'boundary="?([^";\s]+)"?', re.IGNORECASE)
+
+def _response(status, content_type=b'text/plain', body=None):
+    if body is None:
+        body = status + b'\r\n'
+    return (b'HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+            b'Cache-Control: no-cache, private\r\nConnection: close\r\n\r\n'
+            % (status, content_type, len(body)), body)
+
+class Frame(object):
+    """
+    A JPEG frame, stored once as the multipart part sent to viewers. Viewers
+    and snapshots are given memoryview slices of it, so it is never copied
+    however many of them there are.
+    """
+
+    __slots__ = ('data', 'part', 'jpeg')
+
+    def __init__(self, jpeg):
+        header = (b'--%s\r\nContent-Type: image/jpeg\r\n'
+                  b'Content-Length: %d\r\n\r\n' % (BOUNDARY, len(jpeg)))
+        self.data = header + jpeg + b'\r\n'
+        self.part = memoryview(self.data)
+        self.jpeg = self.part[len(header):len(header) + len(jpeg)]
+
+class _Viewer(object):
+    __slots__ = ('frame', 'ready')
+
+    def __init__(self):
+        self.frame = None
+        self.ready = asyncio.Event()
+
+class _Feed(object):
+    # One car's upstream connection, latest frame and viewers
+    __slots__ = ('car_id', 'viewers', 'frame', 'waiters', 'task', 'idle')
+
+    def __init__(self, car_id):
+        self.car_id = car_id
+        self.viewers = set()
+        self.frame = None
+        self.waiters = []
+        self.task = None
+        self.idle = None
+
+class MJPEGRelay(object):
+    """
+    An HTTP server that relays each car's MJPEG video stream, from port 8000
+    of the car, to any number of viewers, as a replacement for routing every
+    viewer's connection to the car through haproxy. "/<car_id>/snapshot"
+    gets the car's latest frame as a JPEG and any other "/<car_id>/..." path
+    its live stream. Unlike haproxy, the relay does not pass the rest of the
+    viewer's path on to the car: every car's stream is read from the same
+    path, which may include a query string, such as "/?action=stream".
+
+    Only one connection is made to each car, however many viewers it has.
+    It is opened by the first viewer and closed once the car has had none
+    for idle seconds. Every frame received is stored once and handed to
+    each viewer, and a viewer that has not finished sending the previous
+    frame when the next one arrives skips to it, so a slow viewer costs
+    dropped frames rather than memory.
+
+    The relay runs on its own event loop thread. Its interface for the
+    server is the same as video.VideoRouter's.
+    """
+
+    PORT = 5000
+    CAR_PORT = 8000
+    CAR_PATH = '/'
+    IDLE = 5.0
+
+    # Seconds a viewer has to send its request, and a snapshot waits for a
+    # frame when the car has none yet
+    REQUEST_TIMEOUT = 5.0
+    SNAPSHOT_TIMEOUT = 5.0
+
+    # Largest request header and frame accepted
+    MAX_REQUEST = 8192
+    MAX_FRAME = 4 * 2**20
+
+    RETRY_MIN = 0.5
+    RETRY_MAX = 10.0
+
+    def __init__(self, host='', port=PORT, car_port=CAR_PORT,
+            car_path=CAR_PATH, idle=IDLE):
+        """
+        Start a relay listening on the given host and port, that gets each
+        car's stream from car_path on car_port of the car and closes it idle
+        seconds after its last viewer leaves. Raises OSError if the port
+        cannot be bound.
+        """
+
+        self.car_port = car_port
+        self.car_path = car_path
+        self.idle = idle
+        self.cars = {}
+        self.feeds = {}
+        self.address = None
+
+        self._frames = 0
+        self._dropped = 0
+        self._upstream_errors = 0
+
+        self.loop = asyncio.new_event_loop()
+        self._server = None
+        self._bind_error = None
+        ready = threading.Event()
+        self.loop_thread = threading.Thread(
+            target=self._run_forever,
+            args=(host, port, ready),
+            name='video-relay',
+            daemon=True
+        )
+        self.loop_thread.start()
+        ready.wait()
+        if self._bind_error is not None:
+            raise self._bind_error
+
+    def _run_forever(self, host, port, ready):
+        """
+        Start listening and run the event loop until close() is called.
+        """
+
+        asyncio.set_event_loop(self.loop)
+        try:
+            self._server = self.loop.run_until_complete(asyncio.start_server(
+                self._serve, host or None, port, limit=self.MAX_REQUEST))
+        except OSError as e:
+            self._bind_error = e
+            ready.set()
+            self.loop.close()
+            return
+        self.address = self._server.sockets[0].getsockname()
+        ready.set()
+
+        self.loop.run_forever()
+        self._server.close()
+        for feed in list(self.feeds.values()):
+            if feed.task is not None:
+                feed.task.cancel()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def load(self, cars):
+        """
+        Replace the relay's cars with the given (car ID, IP address) pairs.
+        """
+
+        self.cars = dict(cars)
+
+    def add_car(self, car_id, ip):
+        """
+        Relay the video stream of a newly registered car.
+        """
+
+        self.cars[car_id] = ip
+
+    def stats(self):
+        """
+        Get a snapshot of the relay's connections and counters. Dropped
+        frames are those skipped by viewers too slow to take them.
+        """
+
+        return {
+            'feeds': sum(1 for feed in list(self.feeds.values())
+                         if feed.task is not None),
+            'viewers': sum(len(feed.viewers)
+                           for feed in list(self.feeds.values())),
+            'frames': self._frames,
+            'dropped': self._dropped,
+            'upstream_errors': self._upstream_errors,
+        }
+
+    def close(self):
+        """
+        Close every connection and stop the event loop.
+        """
+
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+
+    async def _serve(self, reader, writer):
+        """
+        Serve one viewer's request.
+        """
+
+        try:
+            try:
+                request = await asyncio.wait_for(
+                    reader.readuntil(b'\r\n\r\n'), self.REQUEST_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                    asyncio.TimeoutError):
+                return
+
+            match = _REQUEST_LINE.match(request)
+            if match is None:
+                writer.writelines(_response(b'400 Bad Request'))
+                return
+            method, car_id, path = match.groups()
+            if method != b'GET':
+                writer.writelines(_response(b'405 Method Not Allowed'))
+                return
+            car_id = int(car_id)
+            if car_id not in self.cars:
+                writer.writelines(_response(b'404 Not Found'))
+                return
+
+            feed = self.feeds.get(car_id)
+            if feed is None:
+                feed = self.feeds[car_id] = _Feed(car_id)
+            if path in (b'/snapshot', b'/snapshot.jpg'):
+                await self._snapshot(feed, writer)
+            else:
+                await self._stream(feed, reader, writer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _use(self, feed):
+        # Keep the car's connection open, opening it if needed
+        if feed.idle is not None:
+            feed.idle.cancel()
+            feed.idle = None
+        if feed.task is None:
+            feed.task = self.loop.create_task(self._feed_forever(feed))
+
+    def _release(self, feed):
+        # Close the car's connection once it has had no viewers for a while
+        if feed.viewers or feed.waiters or feed.idle is not None:
+            return
+        feed.idle = self.loop.call_later(self.idle, self._close_feed, feed)
+
+    def _close_feed(self, feed):
+        feed.idle = None
+        if feed.task is not None:
+            feed.task.cancel()
+            feed.task = None
+        feed.frame = None
+
+    async def _snapshot(self, feed, writer):
+        frame = feed.frame
+        if frame is None:
+            self._use(feed)
+            waiter = self.loop.create_future()
+            feed.waiters.append(waiter)
+            try:
+                frame = await asyncio.wait_for(waiter, self.SNAPSHOT_TIMEOUT)
+            except asyncio.TimeoutError:
+                writer.writelines(_response(b'504 Gateway Timeout'))
+                return
+            finally:
+                if waiter in feed.waiters:
+                    feed.waiters.remove(waiter)
+                self._release(feed)
+        header, _ = _response(b'200 OK', b'image/jpeg', frame.jpeg)
+        writer.writelines((header, frame.jpeg))
+        await writer.drain()
+
+    async def _stream(self, feed, reader, writer):
+        viewer = _Viewer()
+        feed.viewers.add(viewer)
+        self._use(feed)
+        try:
+            writer.write(_STREAM_HEADER)
+            # Start with the latest frame rather than wait for the next one
+            if feed.frame is not None:
+                viewer.frame = feed.frame
+                viewer.ready.set()
+            sender = self.loop.create_task(self._send_frames(viewer, writer))
+            closed = self.loop.create_task(self._wait_closed(reader))
+            try:
+                await asyncio.wait((sender, closed),
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                sender.cancel()
+                closed.cancel()
+        finally:
+            feed.viewers.discard(viewer)
+            self._release(feed)
+
+    async def _send_frames(self, viewer, writer):
+        while True:
+            await viewer.ready.wait()
+            viewer.ready.clear()
+            frame, viewer.frame = viewer.frame, None
+            writer.write(frame.part)
+            await writer.drain()
+
+    @staticmethod
+    async def _wait_closed(reader):
+        # Viewers send nothing after their request, so reading only ends
+        # once they disconnect
+        while await reader.read(4096):
+            pass
+
+    def _publish(self, feed, frame):
+        # Hand a new frame to every viewer, replacing any frame they have not
+        # started sending yet
+        self._frames += 1
+        feed.frame = frame
+        for viewer in feed.viewers:
+            if viewer.frame is not None:
+                self._dropped += 1
+            viewer.frame = frame
+            viewer.ready.set()
+        waiters, feed.waiters = feed.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(frame)
+
+    async def _feed_forever(self, feed):
+        """
+        Keep the car's stream connected, retrying with a growing delay,
+        until its feed is closed.
+        """
+
+        delay = self.RETRY_MIN
+        while True:
+            ip = self.cars.get(feed.car_id)
+            try:
+                if await self._read_feed(feed, ip):
+                    delay = self.RETRY_MIN
+            except (OSError, ValueError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError) as e:
+                self._upstream_errors += 1
+                logging.debug('Video stream of car %d failed: %s',
+                              feed.car_id, e)
+            feed.frame = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RETRY_MAX)
+
+    async def _read_feed(self, feed, ip):
+        """
+        Read frames from the car's stream until it ends. Returns whether any
+        frame was read.
+        """
+
+        if ip is None:
+            raise ValueError('car is no longer registered')
+        reader, writer = await asyncio.open_connection(
+            ip, self.car_port, limit=self.MAX_FRAME)
+        try:
+            # HTTP/1.0, so that the car does not use chunked encoding
+            writer.write(b'GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (
+                self.car_path.encode('ascii'), ip.encode('ascii')))
+            head = await reader.readuntil(b'\r\n\r\n')
+            status, _, headers = head.partition(b'\r\n')
+            if status.split()[1:2] != [b'200']:
+                raise ValueError('car replied %r' %
+                                 status.decode('latin-1'))
+            match = _BOUNDARY_PARAM.search(headers)
+            if match is None:
+                raise ValueError('not a multipart stream')
+            delimiter = b'--' + match.group(1)
+
+            read = False
+            line = b''
+            while True:
+                # Skip to the next boundary, unless the end of the previous
+                # frame was found by searching for it
+                while not line.startswith(delimiter):
+                    line = (await reader.readline()).strip()
+                    if not line and reader.at_eof():
+                        return read
+                if line.startswith(delimiter + b'--'):
+                    return read
+
+                length = None
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = header.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+
+                if length is not None:
+                    if length > self.MAX_FRAME:
+                        raise ValueError('frame of %d bytes' % length)
+                    jpeg = await reader.readexactly(length)
+                    line = b''
+                else:
+                    data = await reader.readuntil(b'\r\n' + delimiter)
+                    jpeg = data[:-len(delimiter) - 2]
+                    line = delimiter + (await reader.readline()).strip()
+
+                self._publish(feed, Frame(jpeg))
+                read = True
+        finally:
+            writer.close()
@@ -0,0 +1,104 @@
+import logging
+import select
+
+class DatagramReader(object):
+    """
+    Receives datagrams from a non-blocking UDP socket in batches, into a ring
+    of buffers that are allocated once and reused for every batch. Each
+    buffer is one byte larger than the maximum datagram size, so a datagram
+    that would otherwise be silently truncated can be detected and rejected.
+    The views returned for a batch are only valid until the next call to
+    drain().
+    """
+
+    def __init__(self, sock, max_datagram=1024, batch_size=32):
+        """
+        Create a reader for the given socket, which will be made non-blocking.
+        """
+
+        self.socket = sock
+        self.max_datagram = max_datagram
+        self.buffers = [bytearray(max_datagram + 1) for _ in range(batch_size)]
+        self.views = [memoryview(buf) for buf in self.buffers]
+        self.sizes = [0] * batch_size
+        self.addresses = [None] * batch_size
+        self.oversized = 0
+
+        self._poller = select.poll()
+        self._poller.register(sock, select.POLLIN)
+        self._full = False
+        sock.setblocking(False)
+
+    def drain(self, timeout=None):
+        """
+        Wait up to timeout milliseconds (or forever if None) for the socket to
+        be readable, then receive as many datagrams as are waiting, up to the
+        batch size. Returns the number of datagrams received. If the previous
+        batch was full, more datagrams are likely waiting and the wait is
+        skipped.
+        """
+
+        if not self._full and not self._poller.poll(timeout):
+            return 0
+
+        recvfrom_into = self.socket.recvfrom_into
+        count = 0
+        for view in self.views:
+            try:
+                self.sizes[count], self.addresses[count] = recvfrom_into(view)
+            except BlockingIOError:
+                break
+            count += 1
+
+        self._full = count == len(self.views)
+        return count
+
+    def datagram(self, index):
+        """
+        Get a view of a datagram from the last batch, or None if it was larger
+        than the maximum datagram size.
+        """
+
+        size = self.sizes[index]
+        if size > self.max_datagram:
+            self.oversized += 1
+            return None
+        return self.views[index][:size]
+
+class DatagramWriter(object):
+    """
+    Collects the datagrams sent while a batch is being processed so they can
+    be sent together once the batch is done. Datagrams that cannot be sent
+    because the socket's send buffer is full are dropped, as UDP would.
+    """
+
+    def __init__(self, sock):
+        """
+        Create a writer for the given socket.
+        """
+
+        self.socket = sock
+        self.pending = []
+        self.dropped = 0
+
+    def queue(self, data, address):
+        """
+        Queue a datagram to be sent on the next flush. The data must remain
+        valid until then.
+        """
+
+        self.pending.append((data, address))
+
+    def flush(self):
+        """
+        Send every queued datagram.
+        """
+
+        sendto = self.socket.sendto
+        for data, address in self.pending:
+            try:
+                sendto(data, address)
+            except OSError as e:
+                self.dropped += 1
+                logging.debug('Failed to send to %s: %s', address, e)
+        self.pending.clear()
@@ -0,0 +1,148 @@
+import heapq
+import itertools
+import threading
+import time
+
+from utils import MsgType
+
+class _Output(object):
+    """
+    The pacing state of one destination: when it may next be sent to, and
+    the latest MOVE and SET_LED waiting until then.
+    """
+
+    __slots__ = ('next_send', 'move', 'led', 'scheduled')
+
+    def __init__(self):
+        self.next_send = 0.0
+        self.move = None
+        self.led = None
+        self.scheduled = False
+
+class Pacer(object):
+    """
+    Paces the MOVE and SET_LED messages relayed to each car, so that a car
+    whose link cannot keep up with its app is not sent a backlog of stale
+    joystick positions. A message for a destination that has not been sent
+    to within the last interval goes out at once. Otherwise it waits for the
+    interval to pass, and replaces any message of the same type that is
+    already waiting, so that only the latest position and LED state are
+    sent. A message is therefore delayed by at most one interval, however
+    fast the app sends.
+    """
+
+    RATE = 50.0
+    PACED_TYPES = frozenset((MsgType.MOVE, MsgType.SET_LED))
+
+    def __init__(self, send, rate=RATE):
+        """
+        Create a pacer that sends with the given function, called with the
+        data and the address, at most rate times per second per destination.
+        """
+
+        self.send = send
+        self.interval = 1.0 / rate
+        self.outputs = {}
+        self.cond = threading.Condition()
+        self.schedule = []
+        self.sequence = itertools.count()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        flusher = threading.Thread(
+            target=self._flush_forever,
+            name='pacer',
+            daemon=True
+        )
+        flusher.start()
+
+    def submit(self, data, address, msg_type):
+        """
+        Send a MOVE or SET_LED message to the given address, now or once the
+        pacing interval has passed.
+        """
+
+        now = time.monotonic()
+        with self.cond:
+            output = self.outputs.get(address)
+            if output is None:
+                output = self.outputs[address] = _Output()
+
+            if not output.scheduled and now >= output.next_send:
+                output.next_send = now + self.interval
+                self.sent += 1
+            else:
+                # The data may be a view of a reused receive buffer
+                if msg_type == MsgType.MOVE:
+                    if output.move is not None:
+                        self.coalesced += 1
+                    output.move = bytes(data)
+                else:
+                    if output.led is not None:
+                        self.coalesced += 1
+                    output.led = bytes(data)
+                if not output.scheduled:
+                    output.scheduled = True
+                    heapq.heappush(self.schedule, (output.next_send,
+                                   next(self.sequence), address))
+                    self.cond.notify()
+                return
+
+        self.send(data, address)
+
+    def forget(self, address):
+        """
+        Drop the state of a destination that is no longer routed to, along
+        with any message waiting for it.
+        """
+
+        with self.cond:
+            output = self.outputs.pop(address, None)
+            if output is not None:
+                self.dropped += (output.move is not None) + \
+                                (output.led is not None)
+
+    def _flush_forever(self):
+        """
+        Start an infinite loop that sends the waiting messages of each
+        destination once its interval has passed.
+        """
+
+        while True:
+            with self.cond:
+                while True:
+                    if not self.schedule:
+                        self.cond.wait()
+                        continue
+                    delay = self.schedule[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+
+                _, _, address = heapq.heappop(self.schedule)
+                output = self.outputs.get(address)
+                if output is None or not output.scheduled:
+                    # Forgotten in the meantime
+                    continue
+                batch = [data for data in (output.move, output.led)
+                         if data is not None]
+                output.move = output.led = None
+                output.scheduled = False
+                output.next_send = time.monotonic() + self.interval
+                self.sent += len(batch)
+
+            for data in batch:
+                self.send(data, address)
+
+    def stats(self):
+        """
+        Get a snapshot of the pacer's counters.
+        """
+
+        with self.cond:
+            return {
+                'destinations': len(self.outputs),
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+            }
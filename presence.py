@@ -0,0 +1,155 @@
+import logging
+import math
+import threading
+import time
+
+import schema
+
+from wheel import TimingWheel
+
+class _Live(object):
+    """
+    A car that is on, and when its last heartbeat was received.
+    """
+
+    __slots__ = ('car_id', 'last_seen')
+
+    def __init__(self, car_id, last_seen):
+        self.car_id = car_id
+        self.last_seen = last_seen
+
+class Presence(object):
+    """
+    Tracks which cars are on from the heartbeats they send, without writing
+    to the database on every beat. The time of each live car's last beat is
+    kept in memory, and a timing wheel checks each one once per TTL rather
+    than on every beat. Only changes, a car coming on or going off, are
+    recorded: at once in the CarRegistry, which the handlers read, and in the
+    cars table when flushed, all of them in one group commit.
+
+    A beat from a car that is already on takes no lock. Each server process
+    tracks the cars whose beats it receives, so a car whose beats move to
+    another process is reported off when the first process expires it, until
+    its next beat.
+    """
+
+    TTL = 5.0
+    TICK = 1.0
+
+    def __init__(self, registry, db, ttl=TTL, tick=TICK, clock=time.monotonic):
+        """
+        Create a tracker that turns cars on and off in the given CarRegistry
+        and Database, turning them off once they have not beaten for ttl
+        seconds, measured with the given clock. Expiry is checked every tick
+        seconds.
+        """
+
+        self.registry = registry
+        self.db = db
+        self.ttl = ttl
+        self.tick = tick
+        self.clock = clock
+        self.live = {}
+        self.changes = {}
+        self.lock = threading.Lock()
+        self.wheel = TimingWheel(tick, math.ceil(ttl / tick) + 1, clock())
+
+    def __len__(self):
+        return len(self.live)
+
+    def adopt(self, cars):
+        """
+        Track the given registry.Car objects that are on as if they had just
+        beaten, so that cars left on by a previous run of the server go off
+        unless they beat again within the TTL.
+        """
+
+        now = self.clock()
+        with self.lock:
+            for car in cars:
+                if car.is_on and car.id not in self.live:
+                    self._track(car.id, now)
+
+    def beat(self, car):
+        """
+        Record a heartbeat from the given registry.Car, turning it on if it is
+        not on already.
+        """
+
+        now = self.clock()
+        live = self.live.get(car.id)
+        if live is not None and car.is_on:
+            live.last_seen = now
+            return
+
+        with self.lock:
+            live = self.live.get(car.id)
+            if live is None:
+                self._track(car.id, now)
+            else:
+                live.last_seen = now
+            if not car.is_on:
+                self._change(car.id, True)
+
+    def _track(self, car_id, now):
+        live = _Live(car_id, now)
+        self.live[car_id] = live
+        self.wheel.schedule(live, now + self.ttl)
+
+    def _change(self, car_id, is_on):
+        self.changes[car_id] = is_on
+        self.registry.set_on(car_id, is_on)
+
+    def expire(self):
+        """
+        Turn off the cars that have not beaten for the TTL, and return their
+        IDs.
+        """
+
+        now = self.clock()
+        expired = []
+        with self.lock:
+            for live in self.wheel.advance(now):
+                if self.live.get(live.car_id) is not live:
+                    # Replaced since it was scheduled
+                    continue
+                deadline = live.last_seen + self.ttl
+                if deadline <= now:
+                    del self.live[live.car_id]
+                    self._change(live.car_id, False)
+                    expired.append(live.car_id)
+                else:
+                    self.wheel.schedule(live, deadline)
+        return expired
+
+    def flush(self):
+        """
+        Write the changes made since the last flush to the cars table, and
+        return the concurrent.futures.Future of their commit, or None if there
+        were none. A car that came on and went off again in between is written
+        once. Changes whose commit fails are kept for the next flush.
+        """
+
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        if not changes:
+            return None
+
+        rows = [(int(is_on), car_id) for car_id, is_on in changes.items()]
+
+        def set_on(cursor):
+            cursor.executemany(schema.SET_CAR_ON, rows)
+
+        def on_commit(future):
+            if future.exception() is None:
+                return
+            logging.error('Failed to write car presence: %s',
+                          future.exception())
+            with self.lock:
+                # Changes made since are newer, so they take precedence
+                for car_id, is_on in changes.items():
+                    self.changes.setdefault(car_id, is_on)
+
+        future = self.db.submit(set_on)
+        future.add_done_callback(on_commit)
+        return future
@@ -0,0 +1,185 @@
+import threading
+
+from collections import OrderedDict
+
+import schema
+
+class Car(object):
+    """
+    A row of the cars table.
+    """
+
+    __slots__ = ('id', 'name', 'ip', 'user_id', 'is_on')
+
+    def __init__(self, id, name, ip, user_id, is_on):
+        self.id = id
+        self.name = name
+        self.ip = ip
+        self.user_id = user_id
+        self.is_on = bool(is_on)
+
+class CarRegistry(object):
+    """
+    An in-memory index of the cars table, so the handlers that look cars up
+    on every request do not need to query sqlite. Every car is loaded by ID
+    at startup. Each user's list of cars is built on first use and kept for
+    the most recently used users only, unless it is too long to fit in one
+    page, in which case it is read a page at a time. The handlers that change
+    cars write through to the registry once their change is committed.
+
+    Lookups take no lock; changes are made under one. If publish is set, it
+    is called with the name and arguments of every change, so the change can
+    be applied to the registries of other server processes.
+    """
+
+    MAX_USERS = 10000
+    PAGE_SIZE = 100
+
+    def __init__(self, db, max_users=MAX_USERS):
+        """
+        Create a registry loaded from the given Database that keeps the car
+        lists of at most max_users users.
+        """
+
+        self.db = db
+        self.max_users = max_users
+        self.cars = {}
+        self.user_cars = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.publish = None
+
+        with db.read() as (_, cursor):
+            cursor.execute(schema.ALL_CARS)
+            for row in cursor.fetchall():
+                self.cars[row[0]] = Car(*row)
+
+    def get(self, car_id):
+        """
+        Get the car with the given ID, or None if there is no such car.
+        """
+
+        car = self.cars.get(car_id)
+        if car is None:
+            car = self._load(car_id)
+        return car
+
+    def _load(self, car_id):
+        # A car can be missing if it was registered by another server process
+        # whose change has not arrived yet, so fall back to the database
+        with self.db.read() as (_, cursor):
+            cursor.execute(schema.CAR_BY_ID, (car_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        with self.lock:
+            return self.cars.setdefault(car_id, Car(*row))
+
+    def get_user_cars(self, user_id):
+        """
+        Get the list of cars owned by the given user.
+        """
+
+        return list(self.iter_user_cars(user_id))
+
+    def get_user_cars_page(self, user_id, after_id=0, limit=PAGE_SIZE):
+        """
+        Get up to limit of the cars owned by the given user with an ID greater
+        than after_id, in order of ID. A page is sliced from the user's list
+        if it is kept, and otherwise read with an indexed query that seeks
+        straight to it, so its cost does not depend on how many cars the
+        user has. A user's list is only kept if it fits in its first page.
+        """
+
+        cars = self.user_cars.get(user_id)
+        if cars is not None:
+            try:
+                self.user_cars.move_to_end(user_id)
+            except KeyError:
+                # Evicted by another thread in the meantime
+                pass
+            # Cars are listed in order of ID, so find the first after after_id
+            low, high = 0, len(cars)
+            while low < high:
+                middle = (low + high) // 2
+                if cars[middle].id <= after_id:
+                    low = middle + 1
+                else:
+                    high = middle
+            return cars[low:low + limit]
+
+        # A car added while the page is being read may be missing from it,
+        # so the page is only kept if no car was added to the user since
+        generation = self.generations.get(user_id, 0)
+        with self.db.read() as (_, cursor):
+            cursor.execute(schema.CARS_BY_USER_AFTER,
+                           (user_id, after_id, limit))
+            rows = cursor.fetchall()
+
+        with self.lock:
+            cars = []
+            for row in rows:
+                car = self.cars.get(row[0])
+                if car is None:
+                    car = self.cars[row[0]] = Car(*row)
+                cars.append(car)
+            if after_id == 0 and len(cars) < limit and \
+                    self.generations.get(user_id, 0) == generation:
+                # The user's whole list, small enough to keep
+                self.user_cars[user_id] = cars
+                while len(self.user_cars) > self.max_users:
+                    self.user_cars.popitem(last=False)
+        return cars
+
+    def iter_user_cars(self, user_id, after_id=0, page_size=PAGE_SIZE):
+        """
+        Iterate over the cars owned by the given user with an ID greater than
+        after_id, in order of ID, reading them a page at a time.
+        """
+
+        while True:
+            cars = self.get_user_cars_page(user_id, after_id, page_size)
+            yield from cars
+            if len(cars) < page_size:
+                return
+            after_id = cars[-1].id
+
+    def add(self, car_id, name, ip, user_id, is_on=False):
+        """
+        Add a newly registered car.
+        """
+
+        self._add(car_id, name, ip, user_id, is_on)
+        if self.publish is not None:
+            self.publish('add', car_id, name, ip, user_id, is_on)
+
+    def _add(self, car_id, name, ip, user_id, is_on):
+        car = Car(car_id, name, ip, user_id, is_on)
+        with self.lock:
+            self.cars[car_id] = car
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            cars = self.user_cars.get(user_id)
+            if cars is not None:
+                # Copy so that readers never see a list being changed
+                self.user_cars[user_id] = cars + [car]
+
+    def set_on(self, car_id, is_on):
+        """
+        Record whether a car is on.
+        """
+
+        self._set_on(car_id, is_on)
+        if self.publish is not None:
+            self.publish('set_on', car_id, is_on)
+
+    def _set_on(self, car_id, is_on):
+        car = self.cars.get(car_id)
+        if car is not None:
+            car.is_on = is_on
+
+    def apply(self, operation, *args):
+        """
+        Apply a change published by another registry.
+        """
+
+        getattr(self, '_' + operation)(*args)
@@ -0,0 +1,64 @@
+import re
+
+import wire
+
+from utils import MsgType
+
+# Matches an integer in the range [0, 1023] with no leading zeros
+_COORD = rb'(?:0|[1-9]\d{0,2}|10[01]\d|102[0-3])'
+
+def _field(name, value):
+    return rb'"' + name + rb'"\s*:\s*' + value
+
+def _message(msg_type, *fields):
+    parts = [_field(b'type', str(int(msg_type)).encode('ascii'))]
+    parts.extend(fields)
+    return rb'\{\s*' + rb'\s*,\s*'.join(parts) + rb'\s*\}'
+
+# A single precompiled pattern covering the canonical encodings of every
+# proxied control message. Anything that does not match, e.g. extra fields or
+# a different key order, is left to the regular JSON path and its handler.
+_RELAY_MESSAGES = (
+    (MsgType.MOVE,
+     _message(MsgType.MOVE, _field(b'x', _COORD), _field(b'y', _COORD))),
+    (MsgType.MOVE,
+     _message(MsgType.MOVE, _field(b'y', _COORD), _field(b'x', _COORD))),
+    (MsgType.SET_LED, _message(MsgType.SET_LED, _field(b'state', rb'[0-2]'))),
+    (MsgType.ACK, _message(MsgType.ACK)),
+)
+
+# Each message is a group, so the group that matched gives the type
+_RELAY_TYPES = tuple(msg_type for msg_type, _ in _RELAY_MESSAGES)
+RELAY_PATTERN = re.compile(
+    rb'\s*(?:' +
+    rb'|'.join(rb'(' + message + rb')' for _, message in _RELAY_MESSAGES) +
+    rb')\s*'
+)
+
+def relay_type(data, binary=False):
+    """
+    Get the type of a datagram that is a valid MOVE, SET_LED or ACK message
+    that can be forwarded as-is, without being decoded, to a peer that uses
+    the binary encoding if binary is True or JSON otherwise. Returns None for
+    any other datagram.
+    """
+
+    if wire.is_binary(data):
+        if binary and wire.is_relay(data):
+            return data[1]
+        return None
+    if binary:
+        return None
+    match = RELAY_PATTERN.fullmatch(data)
+    if match is None:
+        return None
+    return _RELAY_TYPES[match.lastindex - 1]
+
+def is_relay(data, binary=False):
+    """
+    Check whether the raw bytes of a datagram are a valid MOVE, SET_LED or ACK
+    message that can be forwarded as-is, without being decoded, to a peer
+    that uses the binary encoding if binary is True or JSON otherwise.
+    """
+
+    return relay_type(data, binary) is not None
@@ -0,0 +1,147 @@
+import math
+import threading
+import time
+
+from collections import OrderedDict
+
+from wheel import TimingWheel
+
+class Route(object):
+    """
+    A proxied connection between a client application and a car. A route is
+    owned by the server process that linked it; the other processes hold
+    replicas.
+    """
+
+    __slots__ = ('app', 'car', 'last_active', 'owned')
+
+    def __init__(self, app, car, last_active, owned):
+        self.app = app
+        self.car = car
+        self.last_active = last_active
+        self.owned = owned
+
+class RouteTable(object):
+    """
+    The routes between client applications and cars, indexed by both of
+    their addresses. Looking up a destination refreshes the route's last
+    activity time and takes no lock, so it is cheap enough for every
+    relayed packet. Routes that have been idle for the TTL are expired by a
+    timing wheel, which checks each route once per TTL rather than on every
+    packet. The table holds at most capacity routes, evicting the least
+    recently used when full.
+
+    Linking an app or a car that already has a route replaces that route.
+    Only the owned routes expire; replicas are removed when their owner
+    publishes the removal.
+    """
+
+    TTL = 300
+    CAPACITY = 65536
+    TICK = 1.0
+
+    def __init__(self, ttl=TTL, capacity=CAPACITY, tick=TICK,
+            clock=time.monotonic):
+        """
+        Create a table whose routes expire after ttl seconds idle, measured
+        with the given clock, that holds at most capacity routes. Expiry is
+        checked every tick seconds.
+        """
+
+        self.ttl = ttl
+        self.capacity = capacity
+        self.tick = tick
+        self.clock = clock
+        self.routes = {}
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.wheel = TimingWheel(tick, math.ceil(ttl / tick) + 1, clock())
+
+    def __len__(self):
+        return len(self.lru)
+
+    def get_destination(self, address):
+        """
+        Get the address at the other end of the route from the given address,
+        or None if it has no route, and record activity on the route.
+        """
+
+        route = self.routes.get(address)
+        if route is None:
+            return None
+        route.last_active = self.clock()
+        try:
+            self.lru.move_to_end(route.app)
+        except KeyError:
+            # Removed by another thread in the meantime
+            pass
+        return route.car if address == route.app else route.app
+
+    def link(self, app, car, owned=True):
+        """
+        Add a route between the given app and car addresses, replacing any
+        route either of them already has. Returns the routes it replaced,
+        followed by the least recently used routes evicted to make room for
+        it.
+        """
+
+        now = self.clock()
+        route = Route(app, car, now, owned)
+        with self.lock:
+            replaced = [old for old in (self._remove(app), self._remove(car))
+                        if old is not None]
+            evicted = []
+            self.routes[app] = self.routes[car] = route
+            self.lru[app] = route
+            if owned:
+                self.wheel.schedule(route, now + self.ttl)
+            while len(self.lru) > self.capacity:
+                # Lookups reorder the LRU without the lock, so take the
+                # oldest route in one call rather than iterate over it
+                _, oldest = self.lru.popitem(last=False)
+                del self.routes[oldest.app]
+                del self.routes[oldest.car]
+                evicted.append(oldest)
+        return replaced + evicted
+
+    def unlink(self, address, destination=None):
+        """
+        Remove the route from the given address, and return it, or None if it
+        has no route. If a destination is given, the route is only removed if
+        it leads there.
+        """
+
+        with self.lock:
+            route = self.routes.get(address)
+            if route is None or destination is not None and \
+                    destination not in (route.app, route.car):
+                return None
+            return self._remove(address)
+
+    def _remove(self, address):
+        route = self.routes.get(address)
+        if route is None:
+            return None
+        del self.routes[route.app]
+        del self.routes[route.car]
+        del self.lru[route.app]
+        return route
+
+    def expire(self):
+        """
+        Remove and return the owned routes that have been idle for the TTL.
+        """
+
+        now = self.clock()
+        expired = []
+        with self.lock:
+            for route in self.wheel.advance(now):
+                if self.routes.get(route.app) is not route:
+                    # Already unlinked or replaced
+                    continue
+                deadline = route.last_active + self.ttl
+                if deadline <= now:
+                    expired.append(self._remove(route.app))
+                else:
+                    self.wheel.schedule(route, deadline)
+        return expired
@@ -0,0 +1,91 @@
+"""
+The database schema, as a list of versioned migrations that are applied at
+startup, and the named SQL statements the server runs against it. sqlite3
+keeps each connection's compiled statements in a cache keyed by their text,
+so running the same named statement again skips parsing and planning it.
+"""
+
+MIGRATIONS = [
+    # 1: the original users and cars tables
+    (
+        '''create table if not exists users(
+            id INTEGER PRIMARY KEY,
+            name varchar(50) UNIQUE,
+            salt varchar(32),
+            password varchar(50)
+        )''',
+        '''create table if not exists cars(
+            id integer PRIMARY KEY,
+            name varchar(50),
+            ip varchar(12),
+            isOn integer,
+            userID integer,
+            FOREIGN KEY(userID) references users(id)
+        )''',
+    ),
+    # 2: session tokens and their signing key
+    (
+        '''create table if not exists settings(
+            name varchar(32) PRIMARY KEY,
+            value blob
+        )''',
+        '''create table if not exists sessions(
+            id varchar(16) PRIMARY KEY,
+            userID integer,
+            expires integer,
+            FOREIGN KEY(userID) references users(id)
+        )''',
+    ),
+    # 3: car names are unique per user. The index also serves lookups of a
+    # user's cars by userID alone.
+    (
+        'create unique index if not exists cars_user_name '
+        'on cars(userID, name)',
+    ),
+    # 4: pages of a user's cars are read in order of ID after a given one,
+    # which the index on names cannot seek to
+    (
+        'create index if not exists cars_user_id on cars(userID, id)',
+    ),
+]
+
+USER_BY_NAME = 'select id,salt,password from users where name=?'
+USER_EXISTS = 'select 1 from users where id=?'
+INSERT_USER = 'insert into users (name,salt,password) values (?,?,?)'
+
+CAR_BY_NAME = 'select id from cars where userID=? and name=?'
+INSERT_CAR = 'insert into cars (name,ip,userID,isOn) values (?,?,?,0)'
+SET_CAR_ON = 'update cars set isOn=? where id=?'
+ALL_CARS = 'select id,name,ip,userID,isOn from cars'
+CAR_BY_ID = 'select id,name,ip,userID,isOn from cars where id=?'
+CARS_BY_USER = 'select id,name,ip,userID,isOn from cars where userID=? ' \
+               'order by id'
+CARS_BY_USER_AFTER = 'select id,name,ip,userID,isOn from cars ' \
+                     'where userID=? and id>? order by id limit ?'
+
+def migrate(db, version=len(MIGRATIONS)):
+    """
+    Bring the given Database's schema up to the given version, by applying
+    the migrations it has not had yet in one transaction. Several server
+    processes can migrate the same database at once; the first one to start
+    does the work and the rest find it done.
+    """
+
+    with db as (dbconnect, cursor):
+        # Take the write lock before reading the version, so that no other
+        # process can apply the same migrations in the meantime
+        cursor.execute('begin immediate')
+        try:
+            current = cursor.execute('pragma user_version').fetchone()[0]
+            if current > len(MIGRATIONS):
+                raise RuntimeError('database schema version %d is newer than '
+                                   'this server supports' % current)
+            for statements in MIGRATIONS[current:version]:
+                for statement in statements:
+                    cursor.execute(statement)
+            if version > current:
+                cursor.execute('pragma user_version=%d' % version)
+            dbconnect.commit()
+        except BaseException:
+            dbconnect.rollback()
+            raise
@@ -1,101 +1,151 @@
-import json
 import socket
 import threading
+import time
 import logging
 
-from utils import MsgType, Error, Database
+from dispatcher import CLASSES, Dispatcher, Overload, Scheduling
+from engine import Engine
+from netio import DatagramReader, DatagramWriter
+from pacing import Pacer
+from presence import Presence
+from routes import RouteTable
+from sessions import SessionStore
 
-class Server(object):
+class Server(Engine):
     """
     A class that encapsulates the UDP server for the Remote-Controlled Camera
     Car system. This server uses a single UDP socket for all incoming and
     outgoing messages. Once started, it will indefinitely listen on its single
     socket, expecting all UDP messages to be JSON-formatted with a "type" which
     it will use to decide which registered handler to call. This server also
-    makes its socket available for thread-safe sending.
+    makes its socket available for thread-safe sending. Handlers are run by a
+    fixed pool of worker threads rather than a new thread per message.
     """
 
-    BUFFER_SIZE = 100
+    MAX_DATAGRAM = 1024
+    BATCH_SIZE = 32
 
-    def __init__(self, host, port, db_name):
+    # How often, in milliseconds, an idle receive loop checks for close()
+    POLL_TIMEOUT = 100
+
+    def __init__(self, host, port, db_name, workers=4, queue_size=256,
+            overload=Overload.DROP_OLDEST, route_sync=None,
+            max_datagram=MAX_DATAGRAM, batch_size=BATCH_SIZE, hasher=None,
+            session_ttl=SessionStore.TTL, video=None,
+            route_ttl=RouteTable.TTL, route_capacity=RouteTable.CAPACITY,
+            command_rate=Pacer.RATE, presence_ttl=Presence.TTL,
+            classes=CLASSES, scheduling=Scheduling.WEIGHTED):
         """
         Create a new UDP server that will listen forever on a single socket
-        bound to the given host and port.
+        bound to the given host and port. Handlers will be run by the given
+        number of shared workers, plus those reserved by each of the given
+        dispatcher.MessageClass classes, with at most queue_size messages
+        waiting per class before the overload policy is applied. Workers
+        share themselves between the classes by the given scheduling. If a
+        cluster.RouteSync is given, the socket is bound with SO_REUSEPORT and
+        routes and car changes are shared with the other processes bound to the
+        same port.
+        Datagrams larger than max_datagram bytes are rejected, and up to
+        batch_size datagrams are received per wakeup. Passwords are hashed by
+        the given hashing.PasswordHasher, or a default one, and session tokens
+        expire after session_ttl seconds. Registered cars' video streams are
+        routed by the given video.VideoRouter or mjpeg.MJPEGRelay or,
+        without one, passed on to the process that has one. Routes expire
+        after route_ttl seconds idle, and at most route_capacity are kept.
+        MOVE and SET_LED messages are sent to each car at most command_rate
+        times per second, or as they come if command_rate is 0. Cars are
+        reported off once they have sent no heartbeat for presence_ttl
+        seconds.
         """
 
-        self.routes = {}
-        self.handlers = {}
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.send_lock = threading.Lock()
-        self.db = Database(db_name)
+        super().__init__(db_name, route_sync, hasher, session_ttl, video,
+                         route_ttl, route_capacity, command_rate, presence_ttl)
+        self.dispatcher = Dispatcher(self, workers, queue_size, overload,
+                                     classes, scheduling, self.metrics)
 
+        if route_sync is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind((host, port))
-        recv_thread = threading.Thread(target=self._receive_forever)
-        recv_thread.start()
-
-    def _receive_forever(self):
+        self.address = self.socket.getsockname()
+        self.closing = threading.Event()
+        self.reader = DatagramReader(self.socket, max_datagram, batch_size)
+        self.writer = DatagramWriter(self.socket)
+        self.recv_thread = threading.Thread(
+            target=self._receive_forever,
+            daemon=True
+        )
+        self.recv_thread.start()
+        self._start()
+
+    def join(self):
         """
-        Start an infinite loop that will indefinitely block on a receive until
-        a new message comes in. If the message is JSON-formatted and has a
-        "type" key, then the corresponding handler will be run in a new thread.
+        Block the calling thread for as long as the server is running.
         """
 
-        while True:
-            data, addr = self.socket.recvfrom(self.BUFFER_SIZE)
-            try:
-                body = json.loads(data)
-            except json.JSONDecodeError:
-                logging.debug('Received invalid JSON')
-                self.send(Error.json(Error.BAD_REQ, 'invalid JSON'), addr)
-                continue
-            if body['type'] in self.handlers:
-                handler_thread = threading.Thread(
-                    target=self.handlers[body['type']],
-                    args=(self, body, addr)
-                )
-                handler_thread.start()
-            else:
-                logging.debug('Invalid message type', body)
-                self.send(Error.json(Error.BAD_REQ, 'invalid message type'), addr)
+        # A signal caught by another thread does not interrupt a join without
+        # a timeout, so wake up regularly to let the main thread handle it
+        while self.recv_thread.is_alive():
+            self.recv_thread.join(1)
 
-    def send(self, data, address):
+    def close(self):
         """
-        Send a message containing the given data from the server's UDP socket
-        to the given address.
+        Stop receiving, wait for the workers to run the messages already
+        queued, and release the socket.
         """
 
-        with self.send_lock:
-            self.socket.sendto(data, address)
-
-    def get_db(self):
-        """
-        Get the Database object.
-        """
+        self.closing.set()
+        self.recv_thread.join()
+        self.dispatcher.close()
+        self.socket.close()
+        if self.route_sync is not None:
+            self.route_sync.stop()
 
-        return self.db
+    def _add_gauges(self):
+        super()._add_gauges()
+        self.metrics.gauge('queue_depth',
+                           lambda: self.dispatcher.stats()['depth'], 'class',
+                           'Messages waiting for a worker, by message class')
 
-    def add_route(self, address1, address2):
+    def _receive_forever(self):
         """
-        Cache the source and destination addresses for a proxied-connection
-        between a client application and a car, with this server acting as the
-        proxy.
+        Start a loop that waits until new messages come in, then receives and
+        processes them as a batch, until close() is called. Replies and
+        relayed messages sent while processing the batch are sent together at
+        the end of it.
         """
 
-        self.routes[address1] = address2
-        self.routes[address2] = address1
+        reader = self.reader
+        while not self.closing.is_set():
+            count = reader.drain(self.POLL_TIMEOUT)
+            received = time.monotonic()
+            for i in range(count):
+                data = reader.datagram(i)
+                addr = reader.addresses[i]
+                if data is None:
+                    self._reject_oversized(addr, reader.max_datagram)
+                else:
+                    self._receive(data, addr, received)
+            self.writer.flush()
+
+    def _dispatch(self, handler, body, addr, received):
+        self.dispatcher.submit(handler, body, addr, received)
 
-    def get_destination(self, address):
+    def send(self, data, address):
         """
-        Get the cached destination address that corresponds to a given source
-        address.
+        Send a message containing the given data from the server's UDP socket
+        to the given address. Messages sent from the receive thread are
+        queued and sent at the end of the current batch.
         """
 
-        return self.routes[address] if address in self.routes else None
+        self.metrics.sent(data)
+        if threading.current_thread() is self.recv_thread:
+            self.writer.queue(data, address)
+            return
 
-    def add_handler(self, message_type, handler):
-        """
-        Register a handler function that will be called whenever a message of
-        message_type is received.
-        """
-
-        self.handlers[message_type] = handler
+        with self.send_lock:
+            try:
+                self.socket.sendto(data, address)
+            except OSError as e:
+                logging.debug('Failed to send to %s: %s', address, e)
@@ -0,0 +1,136 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+class SessionStore(object):
+    """
+    Issues and verifies the session tokens handed out on login, so that
+    clients can prove who they are without sending their password again.
+
+    A token has the form "<id>.<user_id>.<expires>.<signature>", where the
+    signature is an HMAC of the rest of the token. Verifying a token checks
+    the signature and expiry, then looks the id up in an in-memory table of
+    live sessions, which is bounded by evicting the oldest sessions. Sessions
+    are also written to sqlite, along with the signing key, so that they
+    survive restarts and are visible to every server process.
+    """
+
+    TTL = 24 * 60 * 60
+    CAPACITY = 100000
+
+    def __init__(self, db, ttl=TTL, capacity=CAPACITY):
+        """
+        Create a session store backed by the given Database, which must have
+        been migrated, loading the signing key and unexpired sessions from it.
+        """
+
+        self.db = db
+        self.ttl = ttl
+        self.capacity = capacity
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+        with db as (dbconnect, cursor):
+            cursor.execute('insert or ignore into settings (name,value) '
+                           'values (?,?)', ('session_key', os.urandom(32)))
+            cursor.execute('select value from settings where name=?',
+                           ('session_key',))
+            self.key = cursor.fetchone()[0]
+
+            now = int(time.time())
+            cursor.execute('delete from sessions where expires<=?', (now,))
+            cursor.execute('select id,userID,expires from sessions '
+                           'order by expires limit ?', (capacity,))
+            for token_id, user_id, expires in cursor.fetchall():
+                self.sessions[token_id] = (user_id, expires)
+            dbconnect.commit()
+
+    def _sign(self, payload):
+        digest = hmac.new(self.key, payload.encode('ascii'), hashlib.sha256)
+        return _b64(digest.digest()[:16])
+
+    def issue(self, user_id):
+        """
+        Create a new session for the given user and return its token.
+        """
+
+        token_id = _b64(os.urandom(8))
+        expires = int(time.time()) + self.ttl
+        payload = '%s.%d.%d' % (token_id, user_id, expires)
+
+        evicted = []
+        with self.lock:
+            self.sessions[token_id] = (user_id, expires)
+            while len(self.sessions) > self.capacity:
+                evicted.append(self.sessions.popitem(last=False)[0])
+
+        def insert_session(cursor):
+            cursor.execute('insert into sessions (id,userID,expires) '
+                           'values (?,?,?)', (token_id, user_id, expires))
+            cursor.executemany('delete from sessions where id=?',
+                               [(e,) for e in evicted])
+
+        # Wait for the commit, so a token is never handed out before it is
+        # durable
+        self.db.submit(insert_session).result()
+
+        return '%s.%s' % (payload, self._sign(payload))
+
+    def verify(self, token):
+        """
+        Get the user ID for a token, or None if the token is malformed,
+        forged, expired or revoked.
+        """
+
+        if not isinstance(token, str) or not token.isascii():
+            return None
+        payload, _, signature = token.rpartition('.')
+        parts = payload.split('.')
+        if len(parts) != 3 or not hmac.compare_digest(
+                signature, self._sign(payload)):
+            return None
+
+        token_id = parts[0]
+        session = self.sessions.get(token_id)
+        if session is None:
+            session = self._load(token_id)
+        if session is None:
+            return None
+        if session[1] <= time.time():
+            with self.lock:
+                self.sessions.pop(token_id, None)
+            return None
+        return session[0]
+
+    def _load(self, token_id):
+        # A session can be missing from memory if it was issued by another
+        # server process or evicted, so fall back to the database
+        with self.db.read() as (_, cursor):
+            cursor.execute('select userID,expires from sessions where id=?',
+                           (token_id,))
+            session = cursor.fetchone()
+        if session is not None:
+            with self.lock:
+                self.sessions[token_id] = session
+                while len(self.sessions) > self.capacity:
+                    self.sessions.popitem(last=False)
+        return session
+
+    def revoke(self, token):
+        """
+        End the session for a token.
+        """
+
+        token_id = token.split('.', 1)[0]
+        with self.lock:
+            self.sessions.pop(token_id, None)
+        self.db.submit(lambda cursor: cursor.execute(
+            'delete from sessions where id=?', (token_id,))).result()
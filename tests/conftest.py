@@ -5,7 +5,7 @@ import subprocess
 import signal
 import socket
 
-from time import sleep
+from time import sleep, time
 from utils import MsgType
 
 LOG_FILENAME = 'server.log'
@@ -18,6 +18,19 @@ with open(LOG_FILENAME, 'a') as f:
     f.write('NEW TEST RUN\n')
     f.write('------------\n')
 
+def _wait_for_server(timeout=5):
+    # The port is in use once the server has bound its socket
+    deadline = time() + timeout
+    while time() < deadline:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.bind(SERVER_ADDR)
+        except OSError:
+            return
+        finally:
+            s.close()
+        sleep(0.01)
+
 @pytest.fixture
 def server(request):
     cmd = ['python', 'main.py', '5005']
@@ -28,7 +41,7 @@ def server(request):
         stdout=f,
         stderr=subprocess.STDOUT,
         close_fds=True)
-    sleep(0.1)
+    _wait_for_server()
     yield proc
     os.kill(proc.pid, signal.SIGINT)
     proc.wait()
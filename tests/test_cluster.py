@@ -0,0 +1,76 @@
+import json
+import socket
+import time
+
+import pytest
+
+import handlers
+
+from aioserver import AsyncServer
+from cluster import RouteSync
+from utils import MsgType
+
+BUFFER_SIZE = 1024
+
+@pytest.fixture
+def cluster():
+    inboxes = RouteSync.create_inboxes(2)
+    first = AsyncServer('127.0.0.1', 0, ':memory:',
+                        route_sync=RouteSync(0, inboxes))
+    second = AsyncServer('127.0.0.1', first.address[1], ':memory:',
+                         route_sync=RouteSync(1, inboxes))
+    for server in (first, second):
+        server.add_handler(MsgType.MOVE, handlers.handle_movement)
+    yield first, second
+    first.close()
+    second.close()
+
+def _wait_for(condition):
+    for _ in range(100):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+def test_workers_share_port(cluster):
+    first, second = cluster
+    assert first.address == second.address
+
+def test_route_replicated(cluster):
+    first, second = cluster
+    app_addr = ('127.0.0.1', 1111)
+    car_addr = ('127.0.0.1', 2222)
+    first.add_route(app_addr, car_addr)
+    first.set_binary(car_addr, True)
+
+    assert _wait_for(lambda: second.get_destination(app_addr) == car_addr)
+    assert second.get_destination(car_addr) == app_addr
+    assert _wait_for(lambda: second.is_binary(car_addr))
+
+def test_relay_through_other_worker(cluster):
+    first, second = cluster
+    app_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    app_sock.bind(('127.0.0.1', 0))
+    car_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    car_sock.bind(('127.0.0.1', 0))
+    car_sock.settimeout(1)
+
+    first.add_route(app_sock.getsockname(), car_sock.getsockname())
+    assert _wait_for(
+        lambda: second.get_destination(app_sock.getsockname()) is not None)
+
+    req = {'type': MsgType.MOVE, 'x': 1, 'y': 2}
+    second._handle_datagram(json.dumps(req).encode('utf-8'),
+                            app_sock.getsockname())
+    data, _ = car_sock.recvfrom(BUFFER_SIZE)
+    assert json.loads(data) == req
+
+def test_unlink_replicated(cluster):
+    first, second = cluster
+    app_addr = ('127.0.0.1', 1111)
+    car_addr = ('127.0.0.1', 2222)
+    first.add_route(app_addr, car_addr)
+    assert _wait_for(lambda: second.get_destination(app_addr) == car_addr)
+
+    assert first.remove_route(app_addr)
+    assert _wait_for(lambda: second.get_destination(app_addr) is None)
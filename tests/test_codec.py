@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+import codec
+
+from utils import MsgType, Error
+
+BACKENDS = ['json'] + (['orjson'] if codec.orjson is not None else [])
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    previous = codec.backend
+    codec.use(request.param)
+    yield request.param
+    codec.use(previous)
+
+def test_error_is_encoded_once():
+    data = codec.error(Error.BAD_REQ, 'car not connected')
+    assert json.loads(data) == {'type': MsgType.ERROR,
+                                'error_type': Error.BAD_REQ,
+                                'error_msg': 'car not connected'}
+    assert codec.error(Error.BAD_REQ, 'car not connected') is data
+
+def test_error_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(codec, '_errors', {})
+    monkeypatch.setattr(codec, 'ERROR_CACHE_SIZE', 2)
+    for i in range(4):
+        codec.error(Error.BAD_REQ, str(i))
+    assert len(codec._errors) == 2
+    assert json.loads(codec.error(Error.BAD_REQ, '3'))['error_msg'] == '3'
+
+def test_ack(backend):
+    assert json.loads(codec.ACK) == {'type': MsgType.ACK}
+    cars = [{'id': 1, 'name': 'car "1"', 'is_on': True}]
+    data = codec.ack(user_id=7, token='abc', cars=cars)
+    assert json.loads(data) == {'type': MsgType.ACK, 'user_id': 7,
+                                'token': 'abc', 'cars': cars}
+
+def test_round_trip(backend):
+    body = {'type': MsgType.MOVE, 'x': 1, 'y': 1023}
+    assert codec.loads(codec.dumps(body)) == body
+    assert json.loads(codec.dumps({1: 'a'})) == {'1': 'a'}
+
+@pytest.mark.parametrize('data', [b'{"type": 2', b'\xff', b''])
+def test_loads_raises_value_error(backend, data):
+    with pytest.raises(ValueError):
+        codec.loads(data)
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        codec.use('simplejson')
@@ -0,0 +1,161 @@
+import json
+import threading
+
+import pytest
+
+from dispatcher import (Dispatcher, MessageClass, Overload, Scheduling,
+                        reassign)
+from utils import MsgType, Error
+
+# Classes without reserved workers, so that tests can run workers themselves
+CLASSES = (
+    MessageClass('control', (MsgType.MOVE,), weight=2, target=0.005),
+    MessageClass('auth', (MsgType.LOGIN,), weight=1, target=1.0),
+)
+
+class MockServer(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data, address):
+        self.sent.append((json.loads(data), address))
+
+def noop(server, body, source):
+    pass
+
+def test_drop_oldest():
+    dispatcher = Dispatcher(MockServer(), 0, 2, Overload.DROP_OLDEST)
+    for i in range(3):
+        dispatcher.submit(noop, {'type': MsgType.LOGIN, 'i': i}, ('a', i))
+
+    queue = dispatcher.queues[dispatcher.class_of[MsgType.LOGIN]]
+    queued = [job.body['i'] for job in queue]
+    assert queued == [1, 2]
+    assert dispatcher.stats()['dropped'] == 1
+
+def test_drop_newest():
+    dispatcher = Dispatcher(MockServer(), 0, 2, Overload.DROP_NEWEST)
+    for i in range(3):
+        dispatcher.submit(noop, {'type': MsgType.LOGIN, 'i': i}, ('a', i))
+
+    queue = dispatcher.queues[dispatcher.class_of[MsgType.LOGIN]]
+    queued = [job.body['i'] for job in queue]
+    assert queued == [0, 1]
+    assert dispatcher.stats()['dropped'] == 1
+
+def test_reject_replies_busy():
+    server = MockServer()
+    dispatcher = Dispatcher(server, 0, 1, Overload.REJECT)
+    assert dispatcher.submit(noop, {'type': MsgType.LOGIN}, ('a', 1))
+    assert not dispatcher.submit(noop, {'type': MsgType.LOGIN}, ('b', 2))
+
+    body, addr = server.sent[0]
+    assert addr == ('b', 2)
+    assert body['type'] == MsgType.ERROR
+    assert body['error_type'] == Error.SERVER_ERR
+    assert dispatcher.stats()['rejected'] == 1
+
+def test_control_messages_run_first():
+    order = []
+    done = threading.Event()
+
+    def record(server, body, source):
+        order.append(body['type'])
+        if len(order) == 2:
+            done.set()
+
+    dispatcher = Dispatcher(MockServer(), 0, classes=CLASSES)
+    dispatcher.submit(record, {'type': MsgType.LOGIN}, ('a', 1))
+    dispatcher.submit(record, {'type': MsgType.MOVE}, ('a', 1))
+
+    worker = threading.Thread(target=dispatcher._work_forever, daemon=True)
+    worker.start()
+    assert done.wait(1)
+    assert order == [MsgType.MOVE, MsgType.LOGIN]
+
+def _order(dispatcher, count):
+    order = []
+    for _ in range(count):
+        job = dispatcher._next(None)
+        order.append(job.body['type'])
+    return order
+
+def test_strict_scheduling():
+    dispatcher = Dispatcher(MockServer(), 0, classes=CLASSES,
+                            scheduling=Scheduling.STRICT)
+    for msg_type in [MsgType.LOGIN] * 2 + [MsgType.MOVE] * 2:
+        dispatcher.submit(noop, {'type': msg_type}, ('a', 1))
+
+    assert _order(dispatcher, 4) == [MsgType.MOVE] * 2 + [MsgType.LOGIN] * 2
+
+def test_weighted_scheduling():
+    dispatcher = Dispatcher(MockServer(), 0, classes=CLASSES,
+                            scheduling=Scheduling.WEIGHTED)
+    for msg_type in [MsgType.LOGIN] * 3 + [MsgType.MOVE] * 4:
+        dispatcher.submit(noop, {'type': msg_type}, ('a', 1))
+
+    # Twice as many control messages as auth ones while both are waiting
+    assert _order(dispatcher, 6) == [
+        MsgType.MOVE, MsgType.LOGIN, MsgType.MOVE,
+        MsgType.MOVE, MsgType.LOGIN, MsgType.MOVE,
+    ]
+
+def test_reserved_worker_serves_control_while_shared_busy():
+    started = threading.Event()
+    release = threading.Event()
+    moved = threading.Event()
+
+    def block(server, body, source):
+        started.set()
+        release.wait(2)
+
+    def move(server, body, source):
+        moved.set()
+
+    classes = (
+        MessageClass('control', (MsgType.MOVE,), reserved=1),
+        MessageClass('auth', (MsgType.LOGIN,)),
+    )
+    dispatcher = Dispatcher(MockServer(), 1, classes=classes)
+    dispatcher.submit(block, {'type': MsgType.LOGIN}, ('a', 1))
+    assert started.wait(1)
+    dispatcher.submit(move, {'type': MsgType.MOVE}, ('a', 1))
+
+    assert moved.wait(1)
+    release.set()
+
+def test_close_runs_queued_messages():
+    ran = []
+
+    def record(server, body, source):
+        ran.append(body['i'])
+
+    classes = (
+        MessageClass('control', (MsgType.MOVE,), reserved=1),
+        MessageClass('auth', (MsgType.LOGIN,)),
+    )
+    dispatcher = Dispatcher(MockServer(), 2, classes=classes)
+    for i in range(10):
+        dispatcher.submit(record, {'type': MsgType.LOGIN, 'i': i}, ('a', i))
+    dispatcher.close()
+
+    assert sorted(ran) == list(range(10))
+    assert not any(worker.is_alive() for worker in dispatcher.workers)
+
+def test_late_messages_counted():
+    dispatcher = Dispatcher(MockServer(), 0, classes=CLASSES)
+    dispatcher.submit(noop, {'type': MsgType.MOVE}, ('a', 1))
+    dispatcher.queues[0][0].queued -= 1
+    dispatcher._next(None)
+
+    stats = dispatcher.stats()
+    assert stats['late'] == {'control': 1, 'auth': 0}
+    assert stats['max_wait']['control'] >= 1
+
+def test_reassign():
+    classes = reassign(CLASSES, MsgType.LOGIN, 'control')
+
+    assert classes[0].types == {MsgType.MOVE, MsgType.LOGIN}
+    assert classes[1].types == set()
+    with pytest.raises(ValueError):
+        reassign(CLASSES, MsgType.LOGIN, 'bulk')
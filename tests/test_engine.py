@@ -0,0 +1,255 @@
+import json
+import socket
+import time
+
+import pytest
+
+import handlers
+
+from aioserver import AsyncServer
+from server import Server
+from utils import MsgType
+
+BUFFER_SIZE = 1024
+
+@pytest.fixture(params=[Server, AsyncServer])
+def udp_server(request):
+    server = request.param('127.0.0.1', 0, ':memory:')
+    server.add_handler(MsgType.MOVE, handlers.handle_movement)
+    yield server
+    server.close()
+
+def _socket():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    s.settimeout(1)
+    return s
+
+def test_relay_movement(udp_server):
+    app_sock = _socket()
+    car_sock = _socket()
+    udp_server.add_route(app_sock.getsockname(), car_sock.getsockname())
+
+    req = {'type': MsgType.MOVE, 'x': 100, 'y': 200}
+    app_sock.sendto(json.dumps(req).encode('utf-8'), udp_server.address)
+    data, addr = car_sock.recvfrom(BUFFER_SIZE)
+
+    assert addr == udp_server.address
+    assert json.loads(data) == req
+
+def test_worker_handler_reply(udp_server):
+    def handle_login(server, body, source):
+        server.send(b'{"type": 0}', source)
+
+    udp_server.add_handler(MsgType.LOGIN, handle_login)
+    s = _socket()
+    s.sendto(b'{"type": 3}', udp_server.address)
+    data, _ = s.recvfrom(BUFFER_SIZE)
+
+    assert json.loads(data)['type'] == MsgType.ACK
+
+def test_invalid_json(udp_server):
+    s = _socket()
+    s.sendto(b'{"type": 2', udp_server.address)
+    data, _ = s.recvfrom(BUFFER_SIZE)
+
+    assert json.loads(data)['type'] == MsgType.ERROR
+
+def test_malformed_messages_are_rejected(udp_server):
+    s = _socket()
+    for data in (b'[8]', b'{"x": 1}', b'{"type": [8]}',
+                 b'{"type": 8, "x": 1, "y": 1024}'):
+        s.sendto(data, udp_server.address)
+        reply, _ = s.recvfrom(BUFFER_SIZE)
+        assert json.loads(reply)['type'] == MsgType.ERROR
+
+def test_binary_to_json_relay(udp_server):
+    app_sock = _socket()
+    car_sock = _socket()
+    udp_server.add_route(app_sock.getsockname(), car_sock.getsockname())
+    udp_server.set_binary(app_sock.getsockname(), True)
+
+    app_sock.sendto(b'\xa5\x08\x00\x01\x00\x02', udp_server.address)
+    data, _ = car_sock.recvfrom(BUFFER_SIZE)
+
+    assert json.loads(data) == {'type': MsgType.MOVE, 'x': 1, 'y': 2}
+
+def test_binary_to_binary_relay(udp_server):
+    app_sock = _socket()
+    car_sock = _socket()
+    udp_server.add_route(app_sock.getsockname(), car_sock.getsockname())
+    udp_server.set_binary(car_sock.getsockname(), True)
+
+    app_sock.sendto(b'{"type": 8, "x": 1, "y": 2}', udp_server.address)
+    data, _ = car_sock.recvfrom(BUFFER_SIZE)
+    assert data == b'\xa5\x08\x00\x01\x00\x02'
+
+    app_sock.sendto(b'\xa5\x08\x00\x03\x00\x04', udp_server.address)
+    data, _ = car_sock.recvfrom(BUFFER_SIZE)
+    assert data == b'\xa5\x08\x00\x03\x00\x04'
+
+def test_unlink(udp_server):
+    udp_server.add_handler(MsgType.UNLINK, handlers.handle_unlink)
+    app_sock = _socket()
+    car_sock = _socket()
+    udp_server.add_route(app_sock.getsockname(), car_sock.getsockname())
+
+    app_sock.sendto(b'{"type": 12}', udp_server.address)
+    data, _ = app_sock.recvfrom(BUFFER_SIZE)
+    assert json.loads(data)['type'] == MsgType.ACK
+    assert udp_server.get_destination(car_sock.getsockname()) is None
+
+    app_sock.sendto(b'{"type": 12}', udp_server.address)
+    data, _ = app_sock.recvfrom(BUFFER_SIZE)
+    assert json.loads(data)['type'] == MsgType.ERROR
+
+def test_stats(udp_server):
+    udp_server.add_handler(MsgType.STATS, handlers.handle_stats)
+    s = _socket()
+    s.sendto(b'{"type": 13}', udp_server.address)
+    data, _ = s.recvfrom(65536)
+    reply = json.loads(data)
+
+    assert reply['type'] == MsgType.ACK
+    assert reply['stats']['counters']['packets_in'] == {'STATS': 1}
+    assert reply['stats']['gauges']['routes'] == 0
+
+def test_get_cars_pages_and_streams(udp_server):
+    udp_server.add_handler(MsgType.GET_CARS, handlers.handle_get_cars)
+    with udp_server.get_db() as (dbconnect, cursor):
+        cursor.executemany(
+            'insert into cars (name,ip,isOn,userID) values (?,?,0,1)',
+            (('car%03d' % i, '10.0.0.1') for i in range(100)))
+        dbconnect.commit()
+    s = _socket()
+
+    s.sendto(b'{"type": 4, "user_id": 1, "limit": 30}', udp_server.address)
+    page = json.loads(s.recvfrom(65536)[0])
+    assert [car['id'] for car in page['cars']] == list(range(1, 31))
+    assert page['next'] == 30
+
+    s.sendto(b'{"type": 4, "user_id": 1, "after_id": 90}',
+             udp_server.address)
+    page = json.loads(s.recvfrom(65536)[0])
+    assert [car['id'] for car in page['cars']] == list(range(91, 101))
+    assert 'next' not in page
+
+    s.sendto(b'{"type": 4, "user_id": 1, "stream": true}', udp_server.address)
+    cars = []
+    chunk = {'done': False}
+    while not chunk['done']:
+        data = s.recvfrom(65536)[0]
+        assert len(data) <= handlers.STREAM_CHUNK
+        chunk = json.loads(data)
+        assert chunk['seq'] == len(cars) and chunk['cars']
+        cars.append(chunk['cars'])
+    assert len(cars) > 1
+    assert [car['id'] for c in cars for car in c] == list(range(1, 101))
+
+def test_get_cars_stream_is_bounded(udp_server):
+    udp_server.add_handler(MsgType.GET_CARS, handlers.handle_get_cars)
+    with udp_server.get_db() as (dbconnect, cursor):
+        cursor.executemany(
+            'insert into cars (name,ip,isOn,userID) values (?,?,0,1)',
+            (('car%04d' % i, '10.0.0.1') for i in range(1000)))
+        dbconnect.commit()
+    s = _socket()
+
+    ids = []
+    requests = 0
+    after_id = 0
+    while after_id is not None:
+        req = {'type': 4, 'user_id': 1, 'stream': True, 'after_id': after_id}
+        s.sendto(json.dumps(req).encode('utf-8'), udp_server.address)
+        requests += 1
+        for seq in range(handlers.STREAM_CHUNKS):
+            data = s.recvfrom(65536)[0]
+            assert len(data) <= handlers.STREAM_CHUNK
+            chunk = json.loads(data)
+            assert chunk['seq'] == seq
+            ids.extend(car['id'] for car in chunk['cars'])
+            if chunk['done']:
+                break
+        assert chunk['done']
+        after_id = chunk.get('next')
+
+    assert requests > 1
+    assert ids == list(range(1, 1001))
+
+def test_heartbeat(udp_server):
+    udp_server.add_handler(MsgType.HEARTBEAT, handlers.handle_heartbeat)
+    with udp_server.get_db() as (dbconnect, cursor):
+        cursor.executemany(
+            'insert into cars (name,ip,isOn,userID) values (?,?,0,1)',
+            (('local', '127.0.0.1'), ('remote', '10.0.0.1')))
+        dbconnect.commit()
+    s = _socket()
+
+    s.sendto(b'{"type": 14, "car_id": 1}', udp_server.address)
+    for _ in range(100):
+        if udp_server.get_registry().get(1).is_on:
+            break
+        time.sleep(0.01)
+    assert udp_server.get_registry().get(1).is_on
+    assert len(udp_server.get_presence()) == 1
+
+    for data in (b'{"type": 14, "car_id": 2}', b'{"type": 14, "car_id": 3}'):
+        s.sendto(data, udp_server.address)
+        reply, _ = s.recvfrom(BUFFER_SIZE)
+        assert json.loads(reply)['type'] == MsgType.ERROR
+
+def test_replaced_route_state_is_dropped(udp_server):
+    app_sock = _socket()
+    other_app_sock = _socket()
+    car = ('127.0.0.1', 8080)
+    udp_server.add_route(app_sock.getsockname(), car)
+    udp_server.set_binary(app_sock.getsockname(), True)
+
+    # Another app linking to the same car replaces the first app's route
+    udp_server.add_route(other_app_sock.getsockname(), car)
+
+    assert udp_server.get_destination(app_sock.getsockname()) is None
+    assert not udp_server.is_binary(app_sock.getsockname())
+    assert udp_server.binary_peers == set()
+
+def test_relay_is_timed(udp_server):
+    app_sock = _socket()
+    car_sock = _socket()
+    udp_server.add_route(app_sock.getsockname(), car_sock.getsockname())
+
+    for i in range(11):
+        req = {'type': MsgType.MOVE, 'x': i, 'y': 0}
+        app_sock.sendto(json.dumps(req).encode('utf-8'), udp_server.address)
+    for _ in range(100):
+        histograms = udp_server.get_metrics().snapshot()['histograms']
+        handled = histograms.get('handler_seconds', {})
+        moves = handled.get('MOVE', {'count': 0})
+        if moves['count'] == 11:
+            break
+        time.sleep(0.01)
+
+    assert moves['count'] == 11
+
+def test_burst_is_paced(udp_server):
+    app_sock = _socket()
+    car_sock = _socket()
+    udp_server.add_route(app_sock.getsockname(), car_sock.getsockname())
+
+    for i in range(100):
+        req = {'type': MsgType.MOVE, 'x': i, 'y': i}
+        app_sock.sendto(json.dumps(req).encode('utf-8'), udp_server.address)
+    # A batch of other datagrams, so that the threaded server reuses every
+    # receive buffer while the pacer holds the latest position
+    other_sock = _socket()
+    for _ in range(Server.BATCH_SIZE):
+        other_sock.sendto(b'{}', udp_server.address)
+
+    moves = []
+    while not moves or moves[-1]['x'] != 99:
+        moves.append(json.loads(car_sock.recvfrom(BUFFER_SIZE)[0]))
+
+    assert moves[0] == {'type': MsgType.MOVE, 'x': 0, 'y': 0}
+    xs = [move['x'] for move in moves]
+    assert xs == sorted(set(xs))
+    assert all(move['y'] == move['x'] for move in moves)
+    assert len(moves) < 100
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from concurrent.futures.process import BrokenProcessPool
+from hashing import Busy, PasswordHasher
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(queue_size=1, per_source=1, iterations=10)
+    yield hasher
+    hasher.pool.shutdown()
+
+def test_hash_matches_pbkdf2(hasher):
+    expected = hashlib.pbkdf2_hmac('sha256', b'password', b'salt', 10)
+    assert hasher.hash('password', b'salt', ('1.2.3.4', 1)) == expected
+    assert hasher.stats()['pending'] == 0
+
+def test_per_source_limit(hasher):
+    hasher._admit('1.2.3.4')
+    with pytest.raises(Busy):
+        hasher.hash('password', b'salt', ('1.2.3.4', 2))
+
+    # Other sources are still admitted
+    hasher.hash('password', b'salt', ('5.6.7.8', 1))
+    assert hasher.stats()['rejected'] == 1
+
+def test_total_limit(hasher):
+    for i in range(hasher.limit):
+        hasher._admit('10.0.0.%d' % i)
+    with pytest.raises(Busy):
+        hasher.hash('password', b'salt', ('5.6.7.8', 1))
+
+    hasher._release('10.0.0.0')
+    hasher.hash('password', b'salt', ('5.6.7.8', 1))
+
+def test_shared_slots_cap_hashing():
+    slots = PasswordHasher.create_slots()
+    hashers = [PasswordHasher(iterations=10, slots=slots) for _ in range(2)]
+    try:
+        # Every slot is taken, as if by the other server processes
+        for _ in range(hashers[0].processes):
+            slots.acquire()
+        results = []
+        threads = [threading.Thread(
+            target=lambda h: results.append(
+                h.hash('password', b'salt', ('1.2.3.4', 1))),
+            args=(hasher,)) for hasher in hashers]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        assert results == []
+
+        for _ in range(hashers[0].processes):
+            slots.release()
+        for thread in threads:
+            thread.join(5)
+        assert len(results) == 2
+    finally:
+        for hasher in hashers:
+            hasher.pool.shutdown()
+
+def test_broken_pool_replaced(hasher):
+    broken = hasher.pool
+    with pytest.raises(BrokenProcessPool):
+        broken.submit(os._exit, 1).result()
+
+    with pytest.raises(Busy):
+        hasher.hash('password', b'salt', ('1.2.3.4', 1))
+    assert hasher.pool is not broken
+    assert hasher.stats()['restarts'] == 1
+
+    expected = hashlib.pbkdf2_hmac('sha256', b'password', b'salt', 10)
+    assert hasher.hash('password', b'salt', ('1.2.3.4', 1)) == expected
@@ -0,0 +1,78 @@
+import logging
+import queue
+
+import pytest
+
+import logs
+
+from utils import MsgType
+
+def _record(msg='Handled message', level=logging.DEBUG, **extra):
+    record = logging.makeLogRecord({'msg': msg, 'levelno': level,
+                                    'levelname': logging.getLevelName(level)})
+    record.__dict__.update(extra)
+    return record
+
+def test_sampling_keeps_one_in_rate():
+    sampler = logs.SamplingFilter({MsgType.MOVE: 10})
+    kept = [r for r in (_record(msg_type=MsgType.MOVE) for _ in range(100))
+            if sampler.filter(r)]
+
+    assert len(kept) == 10
+    assert all(r.sampled == 10 for r in kept)
+    assert sampler.filter(_record(msg_type=MsgType.LOGIN))
+    assert sampler.filter(_record())
+
+def test_sampling_keeps_every_error():
+    sampler = logs.SamplingFilter({MsgType.MOVE: 100})
+    records = [_record('Handler raised an exception', logging.ERROR,
+                       msg_type=MsgType.MOVE) for _ in range(10)]
+
+    assert all(sampler.filter(r) for r in records)
+
+def test_structured_fields_formatted():
+    formatter = logs.StructuredFormatter('%(message)s%(fields)s')
+    record = _record(**logs.fields(MsgType.LOGIN, ('127.0.0.1', 5000),
+                                   0.0123))
+
+    assert formatter.format(record) == (
+        'Handled message, msg_type=LOGIN source=127.0.0.1:5000 '
+        'latency=12.300ms')
+    assert formatter.format(_record('plain')) == 'plain'
+
+def test_full_queue_drops_and_reports():
+    records = queue.Queue(2)
+    handler = logs.DroppingQueueHandler(records)
+    for msg in ('first', 'second', 'third'):
+        handler.handle(_record(msg))
+    assert handler.dropped == 1
+
+    records.get_nowait()
+    records.get_nowait()
+    handler.handle(_record('fourth'))
+    assert records.get_nowait().getMessage() == 'Dropped 1 log records'
+    assert records.get_nowait().getMessage() == 'fourth'
+    assert handler.dropped == 0
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = root.handlers, root.level
+    yield root
+    root.handlers = handlers
+    root.setLevel(level)
+
+def test_configure_writes_in_background(root_logger, tmp_path):
+    path = tmp_path / 'server.log'
+    listener = logs.configure(str(path), logging.DEBUG, {MsgType.MOVE: 2})
+    for i in range(4):
+        logging.debug('Handled message %d', i,
+                      extra=logs.fields(MsgType.MOVE, ('1.2.3.4', 5)))
+    logging.info('Route expired')
+    listener.stop()
+
+    lines = path.read_text().splitlines()
+    assert len(lines) == 3
+    assert 'msg: Handled message 0, level: DEBUG, msg_type=MOVE' in lines[0]
+    assert lines[0].endswith('sampled=2')
+    assert lines[2].endswith('msg: Route expired, level: INFO')
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+import codec
+import metrics
+
+from metrics import Histogram, Metrics
+from utils import MsgType, Error
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 129, 1000, 123456, 10**9])
+def test_bucket_bounds(value):
+    highest = metrics._highest(metrics._bucket(value))
+    assert value <= highest <= value * 1.016 + 1
+    assert metrics._bucket(highest) == metrics._bucket(value)
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1000)
+
+    assert histogram.count == 1000
+    assert histogram.quantile(0.5) == pytest.approx(0.5, rel=0.02)
+    assert histogram.quantile(0.99) == pytest.approx(0.99, rel=0.02)
+    assert histogram.quantile(1.0) == 1.0
+
+def test_threads_merged_on_read():
+    m = Metrics()
+
+    def record():
+        for _ in range(1000):
+            m.count('packets_in', MsgType.MOVE)
+            m.observe('handler_seconds', MsgType.MOVE, 0.001)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = m.snapshot()
+    assert snapshot['counters']['packets_in'] == {'MOVE': 4000}
+    assert snapshot['histograms']['handler_seconds']['MOVE']['count'] == 4000
+
+def test_sent_counts_types_and_errors():
+    m = Metrics()
+    m.sent(b'{"type": 0}')
+    m.sent(codec.error(Error.UNAUTHORIZED, 'no'))
+    m.sent(bytes((0xA5, MsgType.MOVE, 0, 1, 0, 2)))
+
+    counters = m.snapshot()['counters']
+    assert counters['packets_out'] == {'ACK': 1, 'ERROR': 1, 'MOVE': 1}
+    assert counters['errors'] == {'UNAUTHORIZED': 1}
+
+def test_render_prometheus(tmp_path):
+    m = Metrics()
+    m.count('packets_in', MsgType.LOGIN)
+    m.observe('db_lock_wait_seconds', None, 0.002)
+    m.gauge('routes', lambda: 3, description='Routes')
+    m.gauge('queue_depth', lambda: {'auth': 2}, 'class', 'Depth')
+
+    path = tmp_path / 'rccar.prom'
+    m.dump(str(path))
+    lines = path.read_text().splitlines()
+
+    assert 'rccar_packets_in_total{type="LOGIN"} 1' in lines
+    assert 'rccar_db_lock_wait_seconds_count 1' in lines
+    assert 'rccar_db_lock_wait_seconds{quantile="0.99"} 0.002000' in lines
+    assert 'rccar_routes 3' in lines
+    assert 'rccar_queue_depth{class="auth"} 2' in lines
+    assert '# TYPE rccar_handler_seconds summary' in lines
@@ -0,0 +1,181 @@
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from mjpeg import MJPEGRelay
+
+CAR_ID = 1
+
+class FakeCamera(socketserver.ThreadingTCPServer):
+    """
+    A local MJPEG source, like the stream served on port 8000 of a car, that
+    sends numbered frames of the given size every interval seconds and
+    counts the connections made to it.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, frame_size=100, interval=0.01, content_length=True):
+        super().__init__(('127.0.0.1', 0), _CameraHandler)
+        self.frame_size = frame_size
+        self.interval = interval
+        self.content_length = content_length
+        self.connections = 0
+        self.paths = []
+        threading.Thread(target=self.serve_forever, args=(0.05,),
+                         daemon=True).start()
+
+    def frame(self, number):
+        return b'%08d' % number + b'x' * (self.frame_size - 8)
+
+class _CameraHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        camera = self.server
+        camera.connections += 1
+        camera.paths.append(self.rfile.readline().split()[1])
+        self.wfile.write(b'HTTP/1.0 200 OK\r\nContent-Type: '
+                         b'multipart/x-mixed-replace; boundary=cam\r\n\r\n')
+        number = 0
+        try:
+            while True:
+                jpeg = camera.frame(number)
+                part = b'--cam\r\nContent-Type: image/jpeg\r\n'
+                if camera.content_length:
+                    part += b'Content-Length: %d\r\n' % len(jpeg)
+                self.wfile.write(part + b'\r\n' + jpeg + b'\r\n')
+                number += 1
+                time.sleep(camera.interval)
+        except OSError:
+            pass
+
+@pytest.fixture
+def camera():
+    camera = FakeCamera()
+    yield camera
+    camera.shutdown()
+    camera.server_close()
+
+def _relay(camera, **kwargs):
+    relay = MJPEGRelay('127.0.0.1', 0, camera.server_address[1], **kwargs)
+    relay.load([(CAR_ID, '127.0.0.1')])
+    return relay
+
+@pytest.fixture
+def relay(camera):
+    relay = _relay(camera)
+    yield relay
+    relay.close()
+
+def _get(relay, path, rcvbuf=None):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf is not None:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    s.settimeout(2)
+    s.connect(relay.address)
+    s.sendall(b'GET %s HTTP/1.1\r\nHost: test\r\n\r\n' % path)
+    return s
+
+def _read_frames(s, count):
+    # Read the given number of frames from a stream, returning the frames
+    f = s.makefile('rb')
+    assert f.readline().startswith(b'HTTP/1.1 200')
+    while f.readline() != b'\r\n':
+        pass
+    frames = []
+    while len(frames) < count:
+        assert f.readline() == b'--frame\r\n'
+        length = None
+        while True:
+            line = f.readline()
+            if line == b'\r\n':
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        frames.append(f.read(length))
+        assert f.readline() == b'\r\n'
+    return frames
+
+def _read_response(s):
+    data = b''
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    head, _, body = data.partition(b'\r\n\r\n')
+    return head.split(b'\r\n')[0], body
+
+def test_viewers_share_one_connection(camera, relay):
+    viewers = [_get(relay, b'/%d/' % CAR_ID) for _ in range(3)]
+    for s in viewers:
+        frames = _read_frames(s, 5)
+        assert all(frame[8:] == b'x' * 92 for frame in frames)
+        numbers = [int(frame[:8]) for frame in frames]
+        assert numbers == sorted(numbers)
+        s.close()
+
+    assert camera.connections == 1
+    assert relay.stats()['feeds'] == 1
+
+def test_frames_found_without_content_length(camera, relay):
+    camera.content_length = False
+    s = _get(relay, b'/%d/stream' % CAR_ID)
+    frames = _read_frames(s, 3)
+    assert all(len(frame) == camera.frame_size for frame in frames)
+    s.close()
+
+def test_snapshot(relay):
+    status, body = _read_response(_get(relay, b'/%d/snapshot' % CAR_ID))
+    assert status == b'HTTP/1.1 200 OK'
+    assert len(body) == 100 and body[8:] == b'x' * 92
+
+def test_car_path(camera):
+    relay = _relay(camera, car_path='/?action=stream')
+    try:
+        s = _get(relay, b'/%d/' % CAR_ID)
+        _read_frames(s, 1)
+        s.close()
+    finally:
+        relay.close()
+
+    assert camera.paths == [b'/?action=stream']
+
+def test_unknown_car(relay):
+    status, _ = _read_response(_get(relay, b'/99/'))
+    assert status == b'HTTP/1.1 404 Not Found'
+
+def test_slow_viewer_drops_frames():
+    camera = FakeCamera(frame_size=256 * 1024, interval=0.002)
+    relay = _relay(camera)
+    try:
+        slow = _get(relay, b'/%d/' % CAR_ID, rcvbuf=4096)
+        fast = _get(relay, b'/%d/' % CAR_ID)
+        fast.settimeout(5)
+        _read_frames(fast, 50)
+
+        stats = relay.stats()
+        assert stats['viewers'] == 2
+        assert stats['dropped'] > 0
+        slow.close()
+        fast.close()
+    finally:
+        relay.close()
+        camera.shutdown()
+        camera.server_close()
+
+def test_feed_closed_when_idle(camera):
+    relay = _relay(camera, idle=0.05)
+    try:
+        s = _get(relay, b'/%d/' % CAR_ID)
+        _read_frames(s, 1)
+        s.close()
+        deadline = time.monotonic() + 2
+        while relay.stats()['feeds'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert relay.stats()['feeds'] == 0
+    finally:
+        relay.close()
@@ -0,0 +1,60 @@
+import socket
+
+import pytest
+
+from netio import DatagramReader, DatagramWriter
+
+def _socket():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    return s
+
+@pytest.fixture
+def pair():
+    sender = _socket()
+    receiver = _socket()
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+def test_drain_batch(pair):
+    sender, receiver = pair
+    reader = DatagramReader(receiver, max_datagram=16, batch_size=4)
+    for i in range(6):
+        sender.sendto(b'msg%d' % i, receiver.getsockname())
+
+    assert reader.drain(1000) == 4
+    assert [bytes(reader.datagram(i)) for i in range(4)] == \
+        [b'msg0', b'msg1', b'msg2', b'msg3']
+    assert reader.addresses[0] == sender.getsockname()
+
+    assert reader.drain(1000) == 2
+    assert bytes(reader.datagram(1)) == b'msg5'
+
+def test_drain_timeout(pair):
+    _, receiver = pair
+    reader = DatagramReader(receiver)
+    assert reader.drain(10) == 0
+
+def test_oversized(pair):
+    sender, receiver = pair
+    reader = DatagramReader(receiver, max_datagram=4, batch_size=2)
+    sender.sendto(b'four', receiver.getsockname())
+    sender.sendto(b'fives', receiver.getsockname())
+
+    assert reader.drain(1000) == 2
+    assert bytes(reader.datagram(0)) == b'four'
+    assert reader.datagram(1) is None
+    assert reader.oversized == 1
+
+def test_writer_flush(pair):
+    sender, receiver = pair
+    receiver.settimeout(1)
+    writer = DatagramWriter(sender)
+    writer.queue(b'a', receiver.getsockname())
+    writer.queue(memoryview(b'xbx')[1:2], receiver.getsockname())
+    writer.flush()
+
+    assert receiver.recvfrom(16)[0] == b'a'
+    assert receiver.recvfrom(16)[0] == b'b'
+    assert writer.pending == []
@@ -0,0 +1,60 @@
+import time
+
+from pacing import Pacer
+from utils import MsgType
+
+CAR = ('10.0.1.1', 8080)
+
+class Recorder(object):
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, data, address):
+        self.sent.append((data, address, time.monotonic()))
+
+def _move(x):
+    return b'{"type": 8, "x": %d, "y": 0}' % x
+
+def test_first_message_sent_at_once():
+    recorder = Recorder()
+    pacer = Pacer(recorder, rate=20)
+    pacer.submit(_move(1), CAR, MsgType.MOVE)
+
+    assert [data for data, _, _ in recorder.sent] == [_move(1)]
+
+def test_latest_move_wins():
+    recorder = Recorder()
+    pacer = Pacer(recorder, rate=20)
+    start = time.monotonic()
+    for x in range(5):
+        pacer.submit(_move(x), CAR, MsgType.MOVE)
+    pacer.submit(b'{"type": 11, "state": 1}', CAR, MsgType.SET_LED)
+
+    time.sleep(0.2)
+    assert [data for data, _, _ in recorder.sent] == \
+        [_move(0), _move(4), b'{"type": 11, "state": 1}']
+    # Delayed by about one interval, not by the number of messages
+    assert recorder.sent[1][2] - start < 0.1
+    stats = pacer.stats()
+    assert stats['sent'] == 3
+    assert stats['coalesced'] == 3
+
+def test_destinations_paced_separately():
+    recorder = Recorder()
+    pacer = Pacer(recorder, rate=1)
+    other_car = ('10.0.1.2', 8080)
+    pacer.submit(_move(1), CAR, MsgType.MOVE)
+    pacer.submit(_move(2), other_car, MsgType.MOVE)
+
+    assert [address for _, address, _ in recorder.sent] == [CAR, other_car]
+
+def test_forget_drops_waiting_messages():
+    recorder = Recorder()
+    pacer = Pacer(recorder, rate=20)
+    pacer.submit(_move(1), CAR, MsgType.MOVE)
+    pacer.submit(_move(2), CAR, MsgType.MOVE)
+    pacer.forget(CAR)
+
+    time.sleep(0.1)
+    assert len(recorder.sent) == 1
+    assert pacer.stats()['dropped'] == 1
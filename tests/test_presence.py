@@ -0,0 +1,98 @@
+import pytest
+
+import schema
+
+from presence import Presence
+from registry import CarRegistry
+from utils import Database
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def db():
+    db = Database(':memory:')
+    schema.migrate(db)
+    with db as (dbconnect, cursor):
+        cursor.executemany('insert into cars (name,ip,isOn,userID) '
+                           'values (?,?,?,1)',
+                           [('a', '10.0.0.1', 0), ('b', '10.0.0.2', 1)])
+        dbconnect.commit()
+    return db
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+@pytest.fixture
+def presence(db, clock):
+    return Presence(CarRegistry(db), db, ttl=5, clock=clock)
+
+def _stored(db):
+    with db.read() as (_, cursor):
+        cursor.execute('select id,isOn from cars order by id')
+        return dict(cursor.fetchall())
+
+def test_beat_turns_car_on(db, presence):
+    car = presence.registry.get(1)
+    presence.beat(car)
+
+    assert car.is_on
+    assert _stored(db) == {1: 0, 2: 1}
+    presence.flush().result()
+    assert _stored(db) == {1: 1, 2: 1}
+    assert presence.flush() is None
+
+def test_silent_car_goes_off(db, clock, presence):
+    car = presence.registry.get(1)
+    presence.beat(car)
+
+    clock.now = 4.0
+    presence.beat(car)
+    clock.now = 6.0
+    assert presence.expire() == []
+    assert car.is_on
+
+    clock.now = 9.0
+    assert presence.expire() == [1]
+    assert not car.is_on
+    assert len(presence) == 0
+
+    # On and off again between flushes is not written at all
+    presence.flush().result()
+    assert _stored(db) == {1: 0, 2: 1}
+
+def test_beats_only_write_changes(db, clock, presence):
+    car = presence.registry.get(1)
+    presence.beat(car)
+    presence.flush().result()
+
+    for second in range(1, 20):
+        clock.now = float(second)
+        presence.beat(car)
+        presence.expire()
+        assert presence.flush() is None
+    assert car.is_on
+
+def test_adopted_cars_go_off_without_beats(db, clock, presence):
+    presence.adopt(presence.registry.cars.values())
+    assert len(presence) == 1
+
+    clock.now = 6.0
+    assert presence.expire() == [2]
+    presence.flush().result()
+    assert _stored(db) == {1: 0, 2: 0}
+
+def test_car_turned_off_elsewhere_comes_back_on(presence):
+    car = presence.registry.get(2)
+    presence.beat(car)
+    # Expired by another server process that was receiving its beats
+    presence.registry.apply('set_on', 2, False)
+
+    presence.beat(car)
+    assert car.is_on
+    assert presence.changes == {2: True}
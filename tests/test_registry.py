@@ -0,0 +1,125 @@
+import pytest
+
+import schema
+
+from contextlib import contextmanager
+from registry import CarRegistry
+from types import SimpleNamespace
+from utils import Database
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'test.db'))
+    schema.migrate(db)
+    with db as (dbconnect, cursor):
+        cursor.executemany('insert into cars (name,ip,isOn,userID) '
+                           'values (?,?,?,?)',
+                           [('a', '10.0.0.1', 0, 1), ('b', '10.0.0.2', 1, 1),
+                            ('c', '10.0.0.3', 0, 2)])
+        dbconnect.commit()
+    return db
+
+def test_loads_cars(db):
+    registry = CarRegistry(db)
+    car = registry.get(2)
+
+    assert (car.id, car.name, car.ip, car.user_id, car.is_on) == \
+        (2, 'b', '10.0.0.2', 1, True)
+    assert registry.get(4) is None
+
+def test_user_cars(db):
+    registry = CarRegistry(db)
+
+    assert [car.name for car in registry.get_user_cars(1)] == ['a', 'b']
+    assert registry.get_user_cars(3) == []
+    assert registry.get_user_cars(1)[0] is registry.get(1)
+
+def test_user_cars_evicts_least_recently_used(db):
+    registry = CarRegistry(db, max_users=2)
+    registry.get_user_cars(1)
+    registry.get_user_cars(2)
+    registry.get_user_cars(1)
+    registry.get_user_cars(3)
+
+    assert list(registry.user_cars) == [1, 3]
+
+def test_write_through(db):
+    registry = CarRegistry(db)
+    registry.get_user_cars(2)
+    registry.add(4, 'd', '10.0.0.4', 2)
+    registry.set_on(4, True)
+
+    assert [car.name for car in registry.get_user_cars(2)] == ['c', 'd']
+    assert registry.get(4).is_on
+
+def test_published_changes_applied(db):
+    published = []
+    registry = CarRegistry(db)
+    registry.publish = lambda *args: published.append(args)
+    registry.add(4, 'd', '10.0.0.4', 2)
+    registry.set_on(4, True)
+
+    other = CarRegistry(db)
+    for change in published:
+        other.apply(*change)
+
+    assert other.get(4).is_on
+    assert published == [('add', 4, 'd', '10.0.0.4', 2, False),
+                          ('set_on', 4, True)]
+
+def test_missing_car_loaded_from_database(db):
+    registry = CarRegistry(db)
+    with db as (dbconnect, cursor):
+        cursor.execute("insert into cars (id,name,ip,isOn,userID) "
+                       "values (4,'d','10.0.0.4',0,2)")
+        dbconnect.commit()
+
+    assert registry.get(4).name == 'd'
+
+def test_user_cars_pages(db):
+    registry = CarRegistry(db)
+    with db as (dbconnect, cursor):
+        cursor.executemany('insert into cars (name,ip,isOn,userID) '
+                           'values (?,?,0,3)',
+                           [('car%d' % i, '10.0.1.%d' % i) for i in range(5)])
+        dbconnect.commit()
+
+    page = registry.get_user_cars_page(3, limit=2)
+    assert [car.name for car in page] == ['car0', 'car1']
+    page = registry.get_user_cars_page(3, after_id=page[-1].id, limit=2)
+    assert [car.name for car in page] == ['car2', 'car3']
+    # Too long for one page, so not kept
+    assert 3 not in registry.user_cars
+
+    cars = list(registry.iter_user_cars(3, page_size=2))
+    assert [car.name for car in cars] == ['car%d' % i for i in range(5)]
+    assert cars[0] is registry.get(cars[0].id)
+
+def test_user_cars_pages_sliced_from_kept_list(db):
+    registry = CarRegistry(db)
+    registry.get_user_cars(1)
+    registry.db = None
+
+    assert [car.name for car in registry.get_user_cars_page(1, 1)] == ['b']
+    assert registry.get_user_cars_page(1, 2) == []
+
+def test_car_added_during_read_is_not_lost(db):
+    registry = CarRegistry(db)
+    read = db.read
+
+    @contextmanager
+    def racing_read():
+        with read() as (dbconnect, cursor):
+            yield (dbconnect, cursor)
+        # Registered once the page has been read, but before it is kept
+        with db as (dbconnect, cursor):
+            cursor.execute("insert into cars (id,name,ip,isOn,userID) "
+                           "values (4,'d','10.0.0.4',0,2)")
+            dbconnect.commit()
+        registry.add(4, 'd', '10.0.0.4', 2)
+
+    registry.db = SimpleNamespace(read=racing_read)
+    assert [car.name for car in registry.get_user_cars(2)] == ['c']
+    registry.db = db
+
+    assert [car.name for car in registry.get_user_cars(2)] == ['c', 'd']
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from relay import is_relay, relay_type
+from utils import MsgType
+
+@pytest.mark.parametrize('body', [
+    {'type': MsgType.MOVE, 'x': 0, 'y': 1023},
+    {'type': MsgType.MOVE, 'y': 512, 'x': 1019},
+    {'type': MsgType.SET_LED, 'state': 2},
+    {'type': MsgType.ACK},
+])
+def test_canonical_messages_match(body):
+    assert is_relay(json.dumps(body).encode('utf-8'))
+    assert is_relay(json.dumps(body, separators=(',', ':')).encode('utf-8'))
+
+@pytest.mark.parametrize('data', [
+    b'{"type": 8, "x": 1024, "y": 0}',
+    b'{"type": 8, "x": -1, "y": 0}',
+    b'{"type": 8, "x": 01, "y": 0}',
+    b'{"type": 8, "x": 1.5, "y": 0}',
+    b'{"type": 8, "x": 1, "x": 0}',
+    b'{"type": 8, "x": 1}',
+    b'{"type": 11, "state": 3}',
+    b'{"type": 0, "user_id": 1}',
+    b'{"type": 3, "name": "a", "password": "b"}',
+    b'{"type": 8, "x": 1, "y": 0',
+])
+def test_other_messages_do_not_match(data):
+    assert not is_relay(data)
+
+@pytest.mark.parametrize('data, binary, msg_type', [
+    (b'{"type": 8, "y": 2, "x": 1}', False, MsgType.MOVE),
+    (b'{"type": 11, "state": 0}', False, MsgType.SET_LED),
+    (b'{"type": 0}', False, MsgType.ACK),
+    (b'\xa5\x0b\x01', True, MsgType.SET_LED),
+    (b'{"type": 0}', True, None),
+])
+def test_relay_type(data, binary, msg_type):
+    assert relay_type(memoryview(data), binary) == msg_type
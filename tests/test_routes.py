@@ -0,0 +1,94 @@
+from routes import RouteTable
+from wheel import TimingWheel
+
+APP = ('10.0.0.1', 5000)
+CAR = ('10.0.1.1', 8080)
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_wheel_due_items():
+    wheel = TimingWheel(1.0, 4, 0.0)
+    wheel.schedule('a', 1.5)
+    wheel.schedule('b', 3.0)
+
+    assert wheel.advance(1.0) == []
+    assert wheel.advance(2.0) == ['a']
+    assert wheel.advance(10.0) == ['b']
+    assert wheel.advance(20.0) == []
+
+def test_wheel_far_deadline_due_early():
+    wheel = TimingWheel(1.0, 4, 0.0)
+    wheel.schedule('a', 100.0)
+
+    assert wheel.advance(4.0) == ['a']
+
+def test_destination_both_ways():
+    table = RouteTable()
+    table.link(APP, CAR)
+
+    assert table.get_destination(APP) == CAR
+    assert table.get_destination(CAR) == APP
+    assert table.get_destination(('10.0.0.2', 5000)) is None
+
+def test_idle_route_expires():
+    clock = Clock()
+    table = RouteTable(ttl=10, clock=clock)
+    table.link(APP, CAR)
+
+    clock.now = 8.0
+    table.get_destination(APP)
+    clock.now = 12.0
+    assert table.expire() == []
+    assert table.get_destination(CAR) == APP
+
+    clock.now = 30.0
+    expired = table.expire()
+    assert [(route.app, route.car) for route in expired] == [(APP, CAR)]
+    assert table.get_destination(APP) is None
+    assert len(table) == 0
+
+def test_replica_does_not_expire():
+    clock = Clock()
+    table = RouteTable(ttl=10, clock=clock)
+    table.link(APP, CAR, owned=False)
+
+    clock.now = 30.0
+    assert table.expire() == []
+    assert table.get_destination(APP) == CAR
+
+def test_capacity_evicts_least_recently_used():
+    table = RouteTable(capacity=2)
+    table.link(('10.0.0.1', 1), ('10.0.1.1', 1))
+    table.link(('10.0.0.2', 1), ('10.0.1.2', 1))
+    table.get_destination(('10.0.1.1', 1))
+    evicted = table.link(('10.0.0.3', 1), ('10.0.1.3', 1))
+
+    assert [route.app for route in evicted] == [('10.0.0.2', 1)]
+    assert len(table) == 2
+    assert table.get_destination(('10.0.1.2', 1)) is None
+
+def test_relink_replaces_route():
+    table = RouteTable()
+    table.link(APP, CAR)
+    other_car = ('10.0.1.2', 8080)
+    replaced = table.link(APP, other_car)
+
+    assert [(route.app, route.car) for route in replaced] == [(APP, CAR)]
+
+    assert table.get_destination(APP) == other_car
+    assert table.get_destination(CAR) is None
+    assert len(table) == 1
+
+def test_unlink():
+    table = RouteTable()
+    table.link(APP, CAR)
+
+    assert table.unlink(APP, ('10.0.1.2', 8080)) is None
+    assert table.unlink(CAR).app == APP
+    assert table.get_destination(APP) is None
+    assert table.unlink(APP) is None
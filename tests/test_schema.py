@@ -0,0 +1,73 @@
+import sqlite3
+
+import pytest
+
+import schema
+
+from utils import Database
+
+@pytest.fixture
+def db(tmp_path):
+    return Database(str(tmp_path / 'test.db'))
+
+def _version(db):
+    with db as (_, cursor):
+        return cursor.execute('pragma user_version').fetchone()[0]
+
+def test_migrate_new_database(db):
+    schema.migrate(db)
+
+    assert _version(db) == len(schema.MIGRATIONS)
+    with db as (_, cursor):
+        cursor.execute(schema.INSERT_USER, ('name', 'salt', 'password'))
+        cursor.execute(schema.INSERT_CAR, ('car', '10.0.0.1', 1))
+        cursor.execute(schema.CARS_BY_USER, (1,))
+        assert cursor.fetchall() == [(1, 'car', '10.0.0.1', 1, 0)]
+
+def test_migrate_is_idempotent(db):
+    schema.migrate(db)
+    schema.migrate(db)
+
+    assert _version(db) == len(schema.MIGRATIONS)
+
+def test_migrate_upgrades_in_steps(db):
+    schema.migrate(db, 1)
+    with db as (dbconnect, cursor):
+        cursor.execute(schema.INSERT_USER, ('name', 'salt', 'password'))
+        cursor.execute(schema.INSERT_CAR, ('car', '10.0.0.1', 1))
+        dbconnect.commit()
+    assert _version(db) == 1
+
+    schema.migrate(db)
+
+    assert _version(db) == len(schema.MIGRATIONS)
+    with db as (_, cursor):
+        cursor.execute(schema.CAR_BY_NAME, (1, 'car'))
+        assert cursor.fetchone() == (1,)
+
+def test_car_names_unique_per_user(db):
+    schema.migrate(db)
+    with db as (_, cursor):
+        cursor.execute(schema.INSERT_CAR, ('car', '10.0.0.1', 1))
+        cursor.execute(schema.INSERT_CAR, ('car', '10.0.0.2', 2))
+        with pytest.raises(sqlite3.IntegrityError):
+            cursor.execute(schema.INSERT_CAR, ('car', '10.0.0.3', 1))
+
+def test_car_queries_use_index(db):
+    schema.migrate(db)
+    with db as (_, cursor):
+        for query, params, index in (
+                (schema.CARS_BY_USER, (1,), 'cars_user_id'),
+                (schema.CARS_BY_USER_AFTER, (1, 0, 10), 'cars_user_id'),
+                (schema.CAR_BY_NAME, (1, 'car'), 'cars_user_name')):
+            plan = cursor.execute('explain query plan ' + query,
+                                  params).fetchall()
+            # A search of the index, with no sort afterwards
+            assert len(plan) == 1 and index in plan[0][3]
+
+def test_newer_database_rejected(db):
+    with db as (_, cursor):
+        cursor.execute('pragma user_version=%d' % (len(schema.MIGRATIONS) + 1))
+
+    with pytest.raises(RuntimeError):
+        schema.migrate(db)
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+import schema
+
+from sessions import SessionStore
+from utils import Database
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'test.db'))
+    schema.migrate(db)
+    return db
+
+def test_issue_and_verify(db):
+    store = SessionStore(db)
+    token = store.issue(42)
+
+    assert store.verify(token) == 42
+
+def test_forged_token_rejected(db):
+    store = SessionStore(db)
+    token_id, user_id, expires, signature = store.issue(42).split('.')
+
+    assert store.verify('.'.join((token_id, '43', expires, signature))) is None
+    assert store.verify('.'.join((token_id, user_id, expires, 'x'))) is None
+    assert store.verify('not a token') is None
+    assert store.verify(42) is None
+
+def test_expired_token_rejected(db):
+    store = SessionStore(db, ttl=-1)
+    token = store.issue(42)
+
+    assert store.verify(token) is None
+    assert store.sessions == {}
+
+def test_revoked_token_rejected(db):
+    store = SessionStore(db)
+    token = store.issue(42)
+    store.revoke(token)
+
+    assert store.verify(token) is None
+
+def test_capacity_evicts_oldest(db):
+    store = SessionStore(db, capacity=2)
+    first = store.issue(1)
+    second = store.issue(2)
+    third = store.issue(3)
+
+    assert len(store.sessions) == 2
+    assert store.verify(first) is None
+    assert store.verify(second) == 2
+    assert store.verify(third) == 3
+
+def test_sessions_survive_restart(db):
+    token = SessionStore(db).issue(42)
+
+    assert SessionStore(db).verify(token) == 42
+
+def test_session_from_other_process(db):
+    # Another server process shares the database but not the memory
+    first = SessionStore(db)
+    second = SessionStore(db)
+    token = first.issue(42)
+
+    assert second.verify(token) == 42
@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+
+from utils import Database
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / 'test.db'), readers=2)
+    with db as (dbconnect, cursor):
+        cursor.execute('create table t(x integer)')
+        dbconnect.commit()
+    return db
+
+def test_wal_mode(db):
+    with db as (_, cursor):
+        cursor.execute('pragma journal_mode')
+        assert cursor.fetchone()[0] == 'wal'
+
+def test_read_sees_committed_writes(db):
+    with db as (dbconnect, cursor):
+        cursor.execute('insert into t values (1)')
+        dbconnect.commit()
+
+    with db.read() as (_, cursor):
+        cursor.execute('select x from t')
+        assert cursor.fetchall() == [(1,)]
+
+def test_readers_are_read_only(db):
+    with db.read() as (_, cursor):
+        with pytest.raises(Exception):
+            cursor.execute('insert into t values (1)')
+
+def test_reads_do_not_wait_for_writer(db):
+    results = []
+    with db as (_, cursor):
+        cursor.execute('insert into t values (1)')
+
+        # Both readers are used at once while the writer lock is held and
+        # its transaction is still open
+        def read():
+            with db.read() as (_, cursor):
+                cursor.execute('select count(*) from t')
+                results.append(cursor.fetchone()[0])
+
+        threads = [threading.Thread(target=read) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(1)
+
+    assert results == [0, 0]
+
+def test_memory_database_reads_use_writer():
+    db = Database(':memory:')
+    with db as (dbconnect, cursor):
+        cursor.execute('create table t(x integer)')
+        cursor.execute('insert into t values (1)')
+        dbconnect.commit()
+
+    with db.read() as (_, cursor):
+        cursor.execute('select x from t')
+        assert cursor.fetchall() == [(1,)]
+
+def test_submit_commits_group(db):
+    futures = [db.submit(lambda cursor, i=i: cursor.execute(
+        'insert into t values (?)', (i,)).lastrowid) for i in range(10)]
+
+    assert [f.result(1) for f in futures] == list(range(1, 11))
+    with db.read() as (_, cursor):
+        cursor.execute('select count(*) from t')
+        assert cursor.fetchone()[0] == 10
+
+def test_failed_mutation_does_not_affect_group(db):
+    def fail(cursor):
+        cursor.execute('insert into t values (100)')
+        raise ValueError('bad mutation')
+
+    first = db.submit(lambda cursor: cursor.execute('insert into t values (1)'))
+    failed = db.submit(fail)
+    last = db.submit(lambda cursor: cursor.execute('insert into t values (2)'))
+
+    first.result(1)
+    last.result(1)
+    with pytest.raises(ValueError):
+        failed.result(1)
+    with db.read() as (_, cursor):
+        cursor.execute('select x from t order by x')
+        assert cursor.fetchall() == [(1,), (2,)]
+
+def test_submit_groups_by_size(tmp_path):
+    db = Database(str(tmp_path / 'test.db'), commit_interval=10,
+                  commit_size=2)
+    with db as (dbconnect, cursor):
+        cursor.execute('create table t(x integer)')
+        dbconnect.commit()
+
+    # A full group is committed without waiting out the interval
+    futures = [db.submit(lambda cursor: cursor.execute(
+        'insert into t values (1)')) for _ in range(2)]
+    for future in futures:
+        future.result(1)
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+import validation
+
+from utils import MAX_ID, MsgType, Error, Field
+
+def _error(data):
+    body = json.loads(data)
+    assert body['type'] == MsgType.ERROR
+    assert body['error_type'] == Error.BAD_REQ
+    return body['error_msg']
+
+@pytest.mark.parametrize('body', [
+    {'type': MsgType.MOVE, 'x': 0, 'y': 1023},
+    {'type': MsgType.SET_LED, 'state': 2, 'extra': None},
+    {'type': MsgType.LINK, 'car_id': 1, 'binary': True, 'token': 't'},
+    {'type': MsgType.LOGIN},
+    {'type': 99},
+])
+def test_valid(body):
+    assert validation.validate(body) is None
+
+@pytest.mark.parametrize('body, message', [
+    ([], 'message must be a JSON object'),
+    ({'x': 1}, 'missing field: "type" required'),
+    ({'type': '8'}, 'invalid message type'),
+    ({'type': True}, 'invalid message type'),
+    ({'type': MsgType.MOVE, 'x': 1}, 'missing field: "x", "y" required'),
+    ({'type': MsgType.MOVE, 'x': 1, 'y': 1024},
+     '"y" must be an integer in the range [0, 1023]'),
+    ({'type': MsgType.MOVE, 'x': True, 'y': 0},
+     '"x" must be an integer in the range [0, 1023]'),
+    ({'type': MsgType.LINK, 'car_id': 1, 'binary': None},
+     '"binary" must be a boolean'),
+    ({'type': MsgType.REG_CAR, 'name': 1}, '"name" must be a string'),
+    ({'type': MsgType.GET_CARS, 'user_id': '1'},
+     '"user_id" must be an integer in the range [0, %d]' % MAX_ID),
+    ({'type': MsgType.GET_CARS, 'user_id': 2**63},
+     '"user_id" must be an integer in the range [0, %d]' % MAX_ID),
+    ({'type': MsgType.CONN_CAR, 'car_id': 2**63},
+     '"car_id" must be an integer in the range [0, %d]' % MAX_ID),
+    ({'type': MsgType.LINK, 'car_id': -1, 'user_id': 1},
+     '"car_id" must be an integer in the range [0, %d]' % MAX_ID),
+    ({'type': MsgType.HEARTBEAT, 'car_id': 2**63},
+     '"car_id" must be an integer in the range [0, %d]' % MAX_ID),
+])
+def test_invalid(body, message):
+    assert _error(validation.validate(body)) == message
+
+def test_errors_are_pre_encoded():
+    body = {'type': MsgType.SET_LED, 'state': 3}
+    assert validation.validate(body) is validation.validate(body)
+
+def test_compile_schema():
+    validate = validation.compile_schema('TEST', (
+        Field('a', str), Field('b', int, required=False, low=1, high=2)))
+    assert validate({'a': ''}) is None
+    assert validate({'a': '', 'b': 2}) is None
+    assert _error(validate({'b': 1})) == 'missing field: "a" required'
+    assert _error(validate({'a': '', 'b': 0})) == \
+        '"b" must be an integer in the range [1, 2]'
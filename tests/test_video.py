@@ -0,0 +1,97 @@
+import socket
+import threading
+
+import pytest
+
+from video import HAProxyError, RuntimeAPI, VideoRouter
+
+class FakeRuntimeAPI(object):
+    """
+    A unix socket that records the commands sent to it and replies to each
+    one like haproxy's runtime API would.
+    """
+
+    def __init__(self, path, reply=b'\n'):
+        self.path = path
+        self.reply = reply
+        self.commands = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        threading.Thread(target=self._serve_forever, daemon=True).start()
+
+    def _serve_forever(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                self.commands.append(conn.makefile('rb').readline().decode())
+                conn.sendall(self.reply)
+
+    def close(self):
+        self.sock.close()
+
+@pytest.fixture
+def haproxy(tmp_path):
+    api = FakeRuntimeAPI(str(tmp_path / 'admin.sock'))
+    yield api
+    api.close()
+
+@pytest.fixture
+def router(tmp_path, haproxy):
+    router = VideoRouter(str(tmp_path / 'cars.map'), haproxy.path,
+                         debounce=0.05)
+    router.reloads = 0
+    def reload():
+        router.reloads += 1
+    router.reload = reload
+    return router
+
+def test_runtime_api_error(haproxy):
+    haproxy.reply = b'Unknown map identifier\n\n'
+
+    with pytest.raises(HAProxyError):
+        RuntimeAPI(haproxy.path).execute('add map x 1 2')
+
+def test_load_renders_map(router):
+    router.load([(10, '10.0.0.10'), (2, '10.0.0.2')])
+
+    with open(router.map_file) as f:
+        assert f.read() == '2 10.0.0.2\n10 10.0.0.10\n'
+
+def test_add_car_uses_runtime_api(router, haproxy):
+    router.load([(1, '10.0.0.1')])
+    router.add_car(2, '10.0.0.2')
+
+    assert router.wait(1)
+    assert haproxy.commands == ['add map %s 2 10.0.0.2\n' % router.map_file]
+    assert router.reloads == 0
+    with open(router.map_file) as f:
+        assert f.read() == '1 10.0.0.1\n2 10.0.0.2\n'
+
+def test_burst_applied_as_one_batch(router, haproxy):
+    router.load([])
+    for car_id in range(1, 4):
+        router.add_car(car_id, '10.0.0.%d' % car_id)
+
+    assert router.wait(1)
+    assert haproxy.commands == [';'.join(
+        'add map %s %d 10.0.0.%d' % (router.map_file, car_id, car_id)
+        for car_id in range(1, 4)) + '\n']
+    stats = router.stats()
+    assert stats['batches'] == 1
+    assert stats['applied'] == stats['largest_batch'] == 3
+    assert stats['max_latency'] >= router.debounce
+
+def test_add_car_reloads_without_runtime_api(router, tmp_path):
+    router.runtime.path = str(tmp_path / 'missing.sock')
+    router.load([])
+    router.add_car(1, '10.0.0.1')
+    router.add_car(2, '10.0.0.2')
+
+    assert router.wait(1)
+    assert router.reloads == 1
+    with open(router.map_file) as f:
+        assert f.read() == '1 10.0.0.1\n2 10.0.0.2\n'
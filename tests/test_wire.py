@@ -0,0 +1,42 @@
+import pytest
+
+import wire
+
+from relay import is_relay
+from utils import MsgType
+
+@pytest.mark.parametrize('body', [
+    {'type': MsgType.MOVE, 'x': 1023, 'y': 0},
+    {'type': MsgType.SET_LED, 'state': 2},
+    {'type': MsgType.ACK},
+])
+def test_round_trip(body):
+    data = wire.encode(body)
+
+    assert wire.is_binary(data)
+    assert wire.is_relay(data)
+    assert wire.decode(data) == body
+
+def test_move_size():
+    data = wire.encode({'type': MsgType.MOVE, 'x': 1, 'y': 2})
+    assert data == b'\xa5\x08\x00\x01\x00\x02'
+
+@pytest.mark.parametrize('data', [
+    b'\xa5',
+    b'\xa5\x02',
+    b'\xa5\x08\x00\x01',
+    b'\xa5\x08\x00\x01\x00\x02\x00',
+])
+def test_decode_malformed(data):
+    with pytest.raises(ValueError):
+        wire.decode(data)
+
+def test_out_of_range_is_not_relayed():
+    data = wire.encode({'type': MsgType.MOVE, 'x': 1024, 'y': 0})
+    assert not wire.is_relay(data)
+
+def test_relay_requires_matching_encoding():
+    data = wire.encode({'type': MsgType.ACK})
+    assert is_relay(data, binary=True)
+    assert not is_relay(data, binary=False)
+    assert not is_relay(b'{"type": 0}', binary=True)
@@ -1,7 +1,13 @@
-import json
+import logging
+import queue
 import sqlite3
 import threading
+import time
+import urllib.parse
 
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
 from enum import IntEnum
 
 class MsgType(IntEnum):
@@ -15,26 +21,219 @@ class MsgType(IntEnum):
     CONN_CAR = 7
     MOVE = 8
     SET_LED = 11
+    UNLINK = 12
+    STATS = 13
+    HEARTBEAT = 14
 
 class Error(IntEnum):
     BAD_REQ = 0
     UNAUTHORIZED = 1
     SERVER_ERR = 2
+    TRY_AGAIN = 3
 
-    @staticmethod
-    def json(errType, errMsg):
-        body = { 'type': MsgType.ERROR, 'error_type': errType,
-                'error_msg': errMsg }
-        return json.dumps(body).encode('utf-8')
+class Field(object):
+    """
+    A field of a message body: its name, the type its JSON value decodes to
+    (int, str or bool), whether it must be present and, for integers, the
+    inclusive range of values allowed.
+    """
+
+    def __init__(self, name, kind, required=True, low=None, high=None):
+        self.name = name
+        self.kind = kind
+        self.required = required
+        self.low = low
+        self.high = high
+
+# Largest row ID sqlite can store
+MAX_ID = 2**63 - 1
+
+_USER = (Field('user_id', int, required=False, low=0, high=MAX_ID),
+         Field('token', str, required=False))
+
+# The fields of each message type, checked by validation.validate before a
+# handler is picked. Fields that are not declared are passed through
+# unchecked, and rules across fields, such as a LOGIN needing either a token
+# or a name and password, are left to the handlers.
+SCHEMAS = {
+    MsgType.ACK: (),
+    MsgType.REG_USER: (Field('name', str), Field('password', str)),
+    MsgType.LOGIN: (Field('name', str, required=False),
+                    Field('password', str, required=False)) + _USER,
+    MsgType.GET_CARS: (Field('after_id', int, required=False,
+                             low=0, high=MAX_ID),
+                       Field('limit', int, required=False, low=1, high=100),
+                       Field('stream', bool, required=False)) + _USER,
+    MsgType.LINK: (Field('car_id', int, low=0, high=MAX_ID),
+                   Field('binary', bool, required=False)) + _USER,
+    MsgType.REG_CAR: (Field('name', str),) + _USER,
+    MsgType.CONN_CAR: (Field('car_id', int, low=0, high=MAX_ID),
+                       Field('binary', bool, required=False)),
+    MsgType.MOVE: (Field('x', int, low=0, high=1023),
+                   Field('y', int, low=0, high=1023)),
+    MsgType.SET_LED: (Field('state', int, low=0, high=2),),
+    MsgType.UNLINK: (),
+    MsgType.STATS: (),
+    MsgType.HEARTBEAT: (Field('car_id', int, low=0, high=MAX_ID),),
+}
 
 class Database():
-    def __init__(self, db_name):
-        self._db_conn = sqlite3.connect(db_name, check_same_thread=False)
+    """
+    Access to the server's sqlite database. A single writer connection is
+    shared behind a lock and used through the object's own context manager,
+    which gives a (connection, cursor) pair. Queries that only read can use
+    read() instead, which gives the same pair for one of a pool of read-only
+    connections, so readers run concurrently with each other and with the
+    writer thanks to sqlite's WAL journal mode. An in-memory database cannot
+    be shared between connections, so its reads use the writer connection.
+
+    Mutations that do not need to hold the writer themselves can be given to
+    submit(), which commits them in groups so that many of them share the
+    cost of one fsync.
+
+    If metrics is set to a metrics.Metrics, the time spent waiting for and
+    holding the writer is recorded.
+    """
+
+    def __init__(self, db_name, readers=4, cache_size=8192, mmap_size=2**26,
+            commit_interval=0.005, commit_size=256):
+        """
+        Open the database with the given number of read-only connections, a
+        page cache of cache_size KiB per connection and up to mmap_size bytes
+        memory-mapped. Submitted mutations are committed at most
+        commit_interval seconds after the first of a group arrives, or as soon
+        as commit_size of them are waiting.
+        """
+
+        self._db_conn = self._connect(db_name, cache_size, mmap_size)
         self._db_lock = threading.Lock()
+        self._acquired = 0.0
+        self.metrics = None
+        self._readers = queue.LifoQueue()
+        self._pooled = db_name != ':memory:' and readers > 0
+
+        if self._pooled:
+            # Commits are grouped, so every one of them can afford an fsync
+            self._db_conn.execute('pragma journal_mode=WAL')
+            self._db_conn.execute('pragma synchronous=FULL')
+            uri = 'file:%s?mode=ro' % urllib.parse.quote(db_name)
+            for _ in range(readers):
+                self._readers.put(
+                    self._connect(uri, cache_size, mmap_size, uri=True))
+
+        self._commit_interval = commit_interval
+        self._commit_size = commit_size
+        self._pending = deque()
+        self._pending_cond = threading.Condition()
+        committer = threading.Thread(
+            target=self._commit_forever,
+            name='db-commit',
+            daemon=True
+        )
+        committer.start()
+
+    @staticmethod
+    def _connect(db_name, cache_size, mmap_size, uri=False):
+        conn = sqlite3.connect(db_name, check_same_thread=False, uri=uri)
+        conn.execute('pragma cache_size=%d' % -cache_size)
+        conn.execute('pragma mmap_size=%d' % mmap_size)
+        return conn
 
     def __enter__(self):
-        self._db_lock.acquire()
+        if self.metrics is None:
+            self._db_lock.acquire()
+        else:
+            start = time.perf_counter()
+            self._db_lock.acquire()
+            self._acquired = time.perf_counter()
+            self.metrics.observe('db_lock_wait_seconds', None,
+                                 self._acquired - start)
         return (self._db_conn, self._db_conn.cursor())
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.metrics is not None:
+            self.metrics.observe('db_lock_hold_seconds', None,
+                                 time.perf_counter() - self._acquired)
         self._db_lock.release()
+
+    @contextmanager
+    def read(self):
+        """
+        Borrow a read-only connection for the duration of a with block. Blocks
+        until one is free.
+        """
+
+        if not self._pooled:
+            with self as (conn, cursor):
+                yield (conn, cursor)
+            return
+
+        conn = self._readers.get()
+        try:
+            yield (conn, conn.cursor())
+        finally:
+            self._readers.put(conn)
+
+    def submit(self, mutation):
+        """
+        Queue a mutation to be run on the writer connection as part of the
+        next group commit. The mutation is called with a cursor and must not
+        commit. Returns a concurrent.futures.Future that receives the
+        mutation's return value, or its exception, only once the group has
+        been committed.
+        """
+
+        future = Future()
+        with self._pending_cond:
+            self._pending.append((mutation, future))
+            self._pending_cond.notify()
+        return future
+
+    def _next_group(self):
+        with self._pending_cond:
+            while not self._pending:
+                self._pending_cond.wait()
+
+            # Give other mutations a chance to join the group
+            deadline = time.monotonic() + self._commit_interval
+            while len(self._pending) < self._commit_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._pending_cond.wait(remaining)
+
+            count = min(len(self._pending), self._commit_size)
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _commit_forever(self):
+        """
+        Start an infinite loop that runs groups of submitted mutations in one
+        transaction each. Every mutation runs in its own savepoint, so one
+        that fails is rolled back without affecting the rest of its group.
+        """
+
+        while True:
+            group = self._next_group()
+            results = []
+            with self as (dbconnect, cursor):
+                try:
+                    cursor.execute('begin')
+                    for mutation, future in group:
+                        cursor.execute('savepoint mutation')
+                        try:
+                            results.append((future, mutation(cursor), None))
+                        except Exception as e:
+                            cursor.execute('rollback to mutation')
+                            results.append((future, None, e))
+                        cursor.execute('release mutation')
+                    dbconnect.commit()
+                except sqlite3.Error as e:
+                    logging.exception('Group commit failed')
+                    dbconnect.rollback()
+                    results = [(future, None, e) for _, future in group]
+
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
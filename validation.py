@@ -0,0 +1,85 @@
+import codec
+
+from utils import Error, SCHEMAS
+
+_KINDS = {int: 'an integer', str: 'a string', bool: 'a boolean'}
+
+NOT_OBJECT = codec.error(Error.BAD_REQ, 'message must be a JSON object')
+MISSING_TYPE = codec.error(Error.BAD_REQ, 'missing field: "type" required')
+INVALID_TYPE = codec.error(Error.BAD_REQ, 'invalid message type')
+
+def _describe(field):
+    # The message of the error sent when a field has the wrong type or value
+    if field.low is not None:
+        return '"%s" must be an integer in the range [%d, %d]' % (
+            field.name, field.low, field.high)
+    return '"%s" must be %s' % (field.name, _KINDS[field.kind])
+
+def compile_schema(name, fields):
+    """
+    Compile the fields of a message type into a validation function that
+    takes a decoded message body and returns None if it is valid, or the
+    encoded BAD_REQ error to reply with. The function's source is generated
+    with every check inlined, so a message is checked in a single pass with
+    no loop over the fields or lookups of their rules.
+    """
+
+    namespace = {}
+    lines = ['def validate_%s(body):' % name]
+
+    required = [f for f in fields if f.required]
+    if required:
+        # Getting every required field at once costs a single exception,
+        # and only for messages that are missing one
+        lines.append('    try:')
+        for i, field in enumerate(fields):
+            if field.required:
+                lines.append('        v%d = body[%r]' % (i, field.name))
+        lines.append('    except KeyError:')
+        lines.append('        return missing')
+        namespace['missing'] = codec.error(
+            Error.BAD_REQ, 'missing field: %s required' %
+            ', '.join('"%s"' % f.name for f in required))
+
+    for i, field in enumerate(fields):
+        indent = '    '
+        if not field.required:
+            lines.append('    if %r in body:' % field.name)
+            lines.append('        v%d = body[%r]' % (i, field.name))
+            indent = '        '
+        # An exact type check, so that booleans are not taken as integers
+        condition = 'type(v%d) is not kind%d' % (i, i)
+        if field.low is not None:
+            condition += ' or not %d <= v%d <= %d' % (field.low, i,
+                                                      field.high)
+        lines.append('%sif %s:' % (indent, condition))
+        lines.append('%s    return invalid%d' % (indent, i))
+        namespace['kind%d' % i] = field.kind
+        namespace['invalid%d' % i] = codec.error(Error.BAD_REQ,
+                                                 _describe(field))
+
+    lines.append('    return None')
+    exec('\n'.join(lines), namespace)
+    return namespace['validate_%s' % name]
+
+# Every schema is compiled once, when the server starts
+VALIDATORS = {msg_type: compile_schema(msg_type.name, fields)
+              for msg_type, fields in SCHEMAS.items()}
+
+def validate(body):
+    """
+    Check that a decoded message is an object with an integer "type" and,
+    if its type has a schema, that it matches it. Returns None if it is
+    valid, or the encoded BAD_REQ error to reply with. Messages of a type
+    without a schema are left for the server to reject or handle.
+    """
+
+    if type(body) is not dict:
+        return NOT_OBJECT
+    msg_type = body.get('type')
+    if isinstance(msg_type, bool) or not isinstance(msg_type, int):
+        return MISSING_TYPE if msg_type is None else INVALID_TYPE
+    validator = VALIDATORS.get(msg_type)
+    if validator is None:
+        return None
+    return validator(body)
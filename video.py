@@ -0,0 +1,260 @@
+import logging
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from collections import deque
+
+class HAProxyError(Exception):
+    """
+    Raised when a command sent to haproxy's runtime API fails.
+    """
+
+class RuntimeAPI(object):
+    """
+    A client for haproxy's runtime API, served on the unix socket named by
+    the "stats socket" line of its configuration. Each command is sent on a
+    new connection, which haproxy closes once it has replied.
+    """
+
+    def __init__(self, path, timeout=1.0):
+        """
+        Create a client for the runtime API socket at the given path.
+        """
+
+        self.path = path
+        self.timeout = timeout
+
+    def execute(self, command):
+        """
+        Run a command and return haproxy's reply. Raises OSError if the
+        socket cannot be reached and HAProxyError if the command fails.
+        Several commands can be run at once by separating them with ";".
+        """
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            sock.sendall(command.encode('utf-8') + b'\n')
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+        # Commands that change state reply with nothing but blank lines
+        reply = b''.join(chunks).decode('utf-8', 'replace')
+        if reply.strip():
+            raise HAProxyError(reply.strip())
+        return reply
+
+class VideoRouter(object):
+    """
+    Keeps haproxy routing each car's live video stream, requested as
+    "/<car_id>/...", to port 8000 of the car. Rather than one backend per
+    car, haproxy.cfg looks the car ID up in a map file of car IDs to IP
+    addresses, which is rendered from the router's state.
+
+    Newly registered cars are queued and applied by a background thread, so
+    registration does not wait for haproxy. The thread waits a short
+    debounce window after the first queued car so that a burst of
+    registrations is applied together: the map file is rewritten once,
+    atomically, and the whole batch is added to the running haproxy through
+    its runtime API, so no stream is interrupted. If the runtime API cannot
+    be reached, haproxy is reloaded gracefully instead, with -sf, so that the
+    old process finishes serving the streams it has open.
+    """
+
+    MAP_FILE = '/etc/haproxy/cars.map'
+    SOCKET = '/run/haproxy/admin.sock'
+    CONFIG = '/etc/haproxy/haproxy.cfg'
+    PID_FILE = '/run/haproxy.pid'
+
+    # Keeps each runtime API request well within haproxy's line length limit
+    COMMANDS_PER_REQUEST = 100
+
+    def __init__(self, map_file=MAP_FILE, socket_path=SOCKET, config=CONFIG,
+            pid_file=PID_FILE, debounce=0.05):
+        """
+        Create a router for the haproxy instance using the given map file,
+        runtime API socket, configuration file and PID file, which applies
+        the cars queued within debounce seconds of each other together.
+        """
+
+        self.map_file = map_file
+        self.runtime = RuntimeAPI(socket_path)
+        self.config = config
+        self.pid_file = pid_file
+        self.debounce = debounce
+        self.cars = {}
+
+        self._pending = deque()
+        self._pending_cond = threading.Condition()
+        self._applying = False
+        self._batches = 0
+        self._applied = 0
+        self._largest_batch = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        applier = threading.Thread(
+            target=self._apply_forever,
+            name='video-router',
+            daemon=True
+        )
+        applier.start()
+
+    def load(self, cars):
+        """
+        Replace the router's state with the given (car ID, IP address) pairs
+        and rewrite the map file from it. haproxy picks the file up when it
+        next starts or reloads.
+        """
+
+        self.cars = dict(cars)
+        self._write_map()
+
+    def render(self):
+        """
+        Get the contents of the map file for the router's state.
+        """
+
+        return ''.join('%d %s\n' % car for car in sorted(self.cars.items()))
+
+    def _write_map(self):
+        # Write to a temporary file next to the map and rename it over the
+        # map, so haproxy never reads a partly written map
+        directory, name = os.path.split(os.path.abspath(self.map_file))
+        fd, path = tempfile.mkstemp(prefix='.' + name, dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(path, 0o644)
+            os.replace(path, self.map_file)
+        except BaseException:
+            os.unlink(path)
+            raise
+
+    def add_car(self, car_id, ip):
+        """
+        Queue the video stream of a newly registered car to be routed.
+        """
+
+        with self._pending_cond:
+            self._pending.append((car_id, ip, time.monotonic()))
+            self._pending_cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds (or forever if None) until every queued
+        car has been applied. Returns False on timeout.
+        """
+
+        with self._pending_cond:
+            return self._pending_cond.wait_for(
+                lambda: not self._pending and not self._applying, timeout)
+
+    def _next_batch(self):
+        with self._pending_cond:
+            while not self._pending:
+                self._pending_cond.wait()
+
+            # Give a burst of registrations a chance to join the batch
+            deadline = time.monotonic() + self.debounce
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._pending_cond.wait(remaining)
+
+            batch = list(self._pending)
+            self._pending.clear()
+            self._applying = True
+            return batch
+
+    def _apply_forever(self):
+        """
+        Start an infinite loop that applies queued cars in batches.
+        """
+
+        while True:
+            batch = self._next_batch()
+            try:
+                self._apply(batch)
+            except Exception:
+                logging.exception('Failed to apply video routes')
+
+            now = time.monotonic()
+            with self._pending_cond:
+                latencies = [now - queued for _, _, queued in batch]
+                self._batches += 1
+                self._applied += len(batch)
+                self._largest_batch = max(self._largest_batch, len(batch))
+                self._total_latency += sum(latencies)
+                self._max_latency = max(self._max_latency, max(latencies))
+                self._applying = False
+                self._pending_cond.notify_all()
+
+    def _apply(self, batch):
+        for car_id, ip, _ in batch:
+            self.cars[car_id] = ip
+        try:
+            self._write_map()
+        except OSError as e:
+            logging.error('Failed to write haproxy map: %s', e)
+
+        commands = ['add map %s %d %s' % (self.map_file, car_id, ip)
+                    for car_id, ip, _ in batch]
+        try:
+            for i in range(0, len(commands), self.COMMANDS_PER_REQUEST):
+                self.runtime.execute(
+                    ';'.join(commands[i:i + self.COMMANDS_PER_REQUEST]))
+        except (OSError, HAProxyError) as e:
+            logging.debug('haproxy runtime API failed, reloading: %s', e)
+            self.reload()
+        logging.debug('Applied %d video routes', len(batch))
+
+    def stats(self):
+        """
+        Get a snapshot of the router's queue and counters. Latencies are the
+        seconds from a car being queued to its batch being applied.
+        """
+
+        with self._pending_cond:
+            return {
+                'pending': len(self._pending),
+                'batches': self._batches,
+                'applied': self._applied,
+                'largest_batch': self._largest_batch,
+                'mean_latency': self._total_latency / self._applied
+                                if self._applied else 0.0,
+                'max_latency': self._max_latency,
+            }
+
+    def reload(self):
+        """
+        Gracefully reload haproxy, so that it reads the map file again.
+        """
+
+        try:
+            with open(self.pid_file) as f:
+                pids = f.read().split()
+        except OSError:
+            pids = []
+
+        command = ['haproxy', '-f', self.config, '-p', self.pid_file]
+        if pids:
+            command += ['-sf'] + pids
+        try:
+            result = subprocess.run(command)
+        except OSError as e:
+            logging.error('haproxy reload failed: %s', e)
+            return
+        if result.returncode != 0:
+            logging.error('haproxy reload failed with exit status %d',
+                          result.returncode)
@@ -0,0 +1,48 @@
+import math
+
+class TimingWheel(object):
+    """
+    Schedules items to come due at a deadline at a constant cost per item,
+    however many are scheduled. Time is divided into ticks and the wheel is a
+    ring of slots, one per tick; an item is put in the slot of the tick its
+    deadline falls in, and advancing the wheel empties the slots of the
+    ticks that have passed. Deadlines more than one turn of the wheel away
+    come due early, so callers must check the item's real deadline and
+    schedule it again if it has not passed yet. The wheel is not thread-safe.
+    """
+
+    def __init__(self, tick, slots, now):
+        """
+        Create a wheel of the given number of slots, each covering tick
+        seconds, starting at time now.
+        """
+
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(now // tick)
+
+    def schedule(self, item, deadline):
+        """
+        Schedule an item to come due once the wheel has advanced past the
+        given deadline.
+        """
+
+        due = max(math.ceil(deadline / self.tick), self.current + 1)
+        due = min(due, self.current + len(self.slots))
+        self.slots[due % len(self.slots)].append(item)
+
+    def advance(self, now):
+        """
+        Advance the wheel to time now and return the items that came due.
+        """
+
+        target = int(now // self.tick)
+        due = []
+        # Every slot is emptied at most once, however long since the last call
+        for _ in range(min(target - self.current, len(self.slots))):
+            self.current += 1
+            slot = self.current % len(self.slots)
+            due.extend(self.slots[slot])
+            self.slots[slot] = []
+        self.current = max(self.current, target)
+        return due
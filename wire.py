@@ -0,0 +1,76 @@
+import struct
+
+from utils import MsgType
+
+# First byte of every binary message. JSON messages always start with '{' or
+# whitespace, so the two encodings can share the server's single socket.
+MAGIC = 0xA5
+MAGIC_BYTE = bytes((MAGIC,))
+
+# Every binary message is a fixed (magic, type) header followed by a payload
+# whose layout depends on the type.
+HEADER = struct.Struct('!BB')
+
+_FORMATS = {
+    MsgType.ACK: (struct.Struct('!BB'), ()),
+    MsgType.MOVE: (struct.Struct('!BBHH'), ('x', 'y')),
+    MsgType.SET_LED: (struct.Struct('!BBB'), ('state',)),
+}
+
+_SIZES = {msg_type: fmt.size for msg_type, (fmt, _) in _FORMATS.items()}
+
+def is_binary(data):
+    """
+    Check whether a datagram uses the binary encoding rather than JSON.
+    """
+
+    return data[:1] == MAGIC_BYTE
+
+def is_relay(data):
+    """
+    Check whether a binary datagram is a well-formed MOVE, SET_LED or ACK
+    message that can be forwarded as-is to a peer that also uses the binary
+    encoding.
+    """
+
+    if len(data) < HEADER.size or _SIZES.get(data[1]) != len(data):
+        return False
+    if data[1] == MsgType.MOVE:
+        _, _, x, y = _FORMATS[MsgType.MOVE][0].unpack(data)
+        return x <= 1023 and y <= 1023
+    if data[1] == MsgType.SET_LED:
+        return data[2] <= 2
+    return True
+
+def decode(data):
+    """
+    Decode a binary message into the same dict a JSON message would produce.
+    Raises ValueError if the message is malformed.
+    """
+
+    if len(data) < HEADER.size:
+        raise ValueError('message too short')
+    magic, msg_type = HEADER.unpack_from(data)
+    if magic != MAGIC or msg_type not in _FORMATS:
+        raise ValueError('unknown message type')
+
+    fmt, fields = _FORMATS[msg_type]
+    if len(data) != fmt.size:
+        raise ValueError('invalid message length')
+
+    body = dict(zip(fields, fmt.unpack(data)[2:]))
+    body['type'] = msg_type
+    return body
+
+def encode(body):
+    """
+    Encode a MOVE, SET_LED or ACK message body. Fields that the binary format
+    does not carry are dropped. Raises ValueError if the message cannot be
+    encoded.
+    """
+
+    try:
+        fmt, fields = _FORMATS[body['type']]
+        return fmt.pack(MAGIC, body['type'], *(body[f] for f in fields))
+    except (KeyError, struct.error) as e:
+        raise ValueError('cannot encode message: %s' % e)